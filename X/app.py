@@ -5,21 +5,53 @@ ChatGPT API を使用した対話アプリ
 import os
 import sys
 import json
+import csv
 import time
 import re
+import hashlib
+import tempfile
+import threading
+import collections
+import math
+import bisect
+import unicodedata
+import multiprocessing
+import concurrent.futures
+import contextlib
+import atexit
+import sqlite3
+import secrets
+import asyncio
+import io
 import urllib.request
 import urllib.error
 import urllib.parse
 
+# プロセス間のファイルロック（POSIX は fcntl、Windows は msvcrt）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 # Windows で日本語を扱うときの ASCII エンコードエラーを防ぐ
 if sys.platform == "win32":
-    import io
     for name in ("stdout", "stderr"):
         stream = getattr(sys, name)
         if hasattr(stream, "buffer"):
             setattr(sys, name, io.TextIOWrapper(stream.buffer, encoding="utf-8", errors="replace"))
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+
+# HTTP 取得・LLM API の接続とキャッシュ・レート制限・スクレイピングの流れ・ASGI の入口は scrape-bot と共通（common.py）
+from common import (
+    LLM_EXPECTED_OUTPUT_TOKENS, LLM_HTTP_PREWARM, LLM_TEMPERATURE, SCRAPE_JOBS_ENABLED, SCRAPE_JOB_MAX_PENDING,
+    SCRAPE_JOB_TTL, SCRAPE_JOB_WORKERS, SCRAPE_STREAM_HEADERS, SCRAPE_STREAM_TYPES, ScrapeJobManager,
+    ScrapePipeline, ScrapeSite, _acached_reply, _acall_with_retries, _accept_encoding, _asgi_send_json,
+    _astore_reply, _cached_reply, _call_with_retries, _detail_chunk_index, _fetch_detail_pages, _store_reply,
+    allm_http, decode_html, http_cache, llm_cache, llm_http, llm_scheduler, make_asgi_app, scrape_throttle,
+    start_llm_http_prewarm,
+)
 
 # PDF / DOCX / PPTX 用（オプション：ライブラリが無い場合は該当形式をスキップ）
 try:
@@ -38,6 +70,19 @@ try:
     from bs4 import BeautifulSoup
 except ImportError:
     BeautifulSoup = None
+# トークン数の見積もり用（オプション：無ければ文字種から概算）
+try:
+    import tiktoken
+    _token_encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _token_encoding = None
+# context フォルダの変更検知（オプション：無ければポーリング）
+try:
+    from watchdog.observers import Observer as WatchdogObserver
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    WatchdogObserver = None
+    FileSystemEventHandler = object
 
 app = Flask(__name__)
 # 日本語などをそのまま JSON で返すため（ASCII に変換しない）
@@ -45,8 +90,30 @@ app.config["JSON_AS_ASCII"] = False
 
 # コンテキスト用フォルダ（app.py と同じ場所の context/）
 CONTEXT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "context")
-CONTEXT_MAX_CHARS = 30000  # トークン制限を考慮した上限
 CONTEXT_EXTENSIONS = (".txt", ".md", ".pdf", ".docx", ".pptx")
+# 抽出テキストのキャッシュ先（環境変数 CONTEXT_CACHE_DIR で変更可能。Vercel でも書ける一時フォルダを既定にする）
+EXTRACT_CACHE_DIR = os.environ.get("CONTEXT_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "sales-proposal-app", "extract"
+)
+EXTRACT_CACHE_VERSION = 2  # 抽出処理を変えたら上げる（古いディスクキャッシュを使わないため）
+# context フォルダを監視する間隔（秒）。watchdog が無いときのポーリング間隔。0 でリクエストごとに走査
+CONTEXT_WATCH_INTERVAL = float(os.environ.get("CONTEXT_WATCH_INTERVAL", "2"))
+# 起動時に context フォルダを並列抽出しておくか（CONTEXT_WARMUP=1 で有効。プロセス数は省略時 CPU 数）
+CONTEXT_WARMUP = os.environ.get("CONTEXT_WARMUP") == "1"
+CONTEXT_WARMUP_WORKERS = int(os.environ.get("CONTEXT_WARMUP_WORKERS", "0")) or None
+# 検索用に分割するチャンクの目安トークン数と、1回の質問で候補にするチャンク数（環境変数で変更可能）
+CONTEXT_CHUNK_TOKENS = int(os.environ.get("CONTEXT_CHUNK_TOKENS", "400"))
+CONTEXT_TOP_K = int(os.environ.get("CONTEXT_TOP_K", "20"))
+# フォルダコンテキストに使うトークン数の上限（モデル名の前方一致。環境変数 CONTEXT_MAX_TOKENS で一律に上書き）
+CONTEXT_TOKEN_BUDGETS = (
+    ("gpt-3.5", 3000),
+    ("gpt-4-turbo", 12000),
+    ("gpt-4o", 12000),
+    ("gpt-4", 3000),
+    ("gpt-5", 16000),
+    ("gemini-", 16000),
+)
+CONTEXT_DEFAULT_TOKEN_BUDGET = 8000
 
 # 常に含める固定コンテキスト（Xアカウント情報など）
 FIXED_CONTEXT = "X（旧Twitter）の @threee_sales はスリーグッドの田中祐貴のアカウントである。"
@@ -55,22 +122,148 @@ FIXED_CONTEXT = "X（旧Twitter）の @threee_sales はスリーグッドの田
 PROMPTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts.json")
 
 
-def load_presets():
-    """prompts.json から用途別プロンプトを読み込む。失敗時は標準のみ"""
+def _read_presets_file(path):
+    """prompts.json から (用途別プロンプトのリスト, 保存の版) を読み込む。失敗時は標準のみ"""
     default_presets = [{"id": "default", "name": "標準", "prompt": ""}]
-    if not os.path.isfile(PROMPTS_FILE):
-        return default_presets
+    if not os.path.isfile(path):
+        return default_presets, 0
     try:
-        with open(PROMPTS_FILE, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             data = json.load(f)
         presets = data.get("presets") or default_presets
-        return [p for p in presets if p.get("id") and p.get("name") is not None]
+        return [p for p in presets if p.get("id") and p.get("name") is not None], int(data.get("version") or 0)
     except Exception:
-        return default_presets
+        return default_presets, 0
+
+
+@contextlib.contextmanager
+def _interprocess_lock(lock_path):
+    """gunicorn の複数ワーカーなど、プロセスをまたいで排他するためのファイルロック"""
+    with open(lock_path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _atomic_write_json(path, data):
+    """同じフォルダの一時ファイルに書いて fsync し、rename で置き換える（読む側に書きかけを見せない）"""
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+class PresetRegistry:
+    """
+    prompts.json のプリセットをメモリに保持し、ID の dict で引けるようにする。
+    ファイルの状態（更新日時・サイズ・inode）は check_interval 秒に1回だけ確認し、変わったときだけ読み直す。
+    中身は丸ごと差し替えるので、読む側はロック無しで一貫した状態を見られる。
+    保存はプロセス間ロックの中で「読む → 書き換え → 一時ファイル + rename」を行い、版（version）を1つ上げる。
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.check_interval = check_interval
+        self.version = 0  # このプロセスで読み直し・更新するたびに増える（プロンプトのメモ化キーに使う）
+        self.store_version = 0  # prompts.json に保存されている版（保存のたびに全ワーカー共通で増える）
+        self._lock = threading.Lock()
+        self._presets = ()
+        self._by_id = {}
+        self._signature = None
+        self._checked_at = None
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    def _replace(self, presets, store_version, signature):
+        by_id = {}
+        for p in presets:
+            by_id.setdefault((p.get("id") or "").strip(), p)
+        self._presets = tuple(presets)
+        self._by_id = by_id
+        self.store_version = store_version
+        self._signature = signature
+        self.version += 1
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            signature = self._file_signature()
+            if self.version and signature == self._signature:
+                return
+            self._replace(*_read_presets_file(self.path), signature)
+
+    def all(self):
+        """プリセットの一覧（ファイル内の順）"""
+        self._refresh()
+        return list(self._presets)
+
+    def get(self, preset_id):
+        """ID に対応するプリセット（dict）。無ければ None"""
+        self._refresh()
+        return self._by_id.get(preset_id)
+
+    def save_prompt(self, preset_id, prompt):
+        """指定プリセットの prompt を保存する。該当なし・読めないファイルなら False（ファイルは変更しない）"""
+        if not os.path.isfile(self.path):
+            return False
+        with _interprocess_lock(self.lock_path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            presets = data.get("presets") or []
+            for p in presets:
+                if (p.get("id") or "").strip() == preset_id:
+                    p["prompt"] = prompt
+                    break
+            else:
+                return False
+            store_version = int(data.get("version") or 0) + 1
+            _atomic_write_json(self.path, {"version": store_version, "presets": presets})
+            with self._lock:
+                valid = [p for p in presets if p.get("id") and p.get("name") is not None]
+                self._replace(valid, store_version, self._file_signature())
+                self._checked_at = time.monotonic()
+        return True
+
+
+_preset_registry = PresetRegistry(PROMPTS_FILE)
+
+
+def load_presets():
+    """用途別プロンプトの一覧を返す（PresetRegistry 経由。ファイルが変わったときだけ読み直す）"""
+    return _preset_registry.all()
 
 
-def fetch_url_html(url, max_bytes=2 * 1024 * 1024, timeout=15):
-    """URL を GET して HTML を文字列で返す。最大 max_bytes、タイムアウト timeout 秒"""
+def fetch_url_html(url, max_bytes=2 * 1024 * 1024, timeout=15, throttle=None):
+    """
+    URL を GET して HTML を文字列で返す（http_cache 経由）。最大 max_bytes、タイムアウト timeout 秒。
+    throttle（scrape_throttle.slot など）はキャッシュで済まずサーバーに送るときだけ入る
+    """
     url = (url or "").strip()
     if not url.startswith("http://") and not url.startswith("https://"):
         url = "https://" + url
@@ -78,18 +271,13 @@ def fetch_url_html(url, max_bytes=2 * 1024 * 1024, timeout=15):
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
         "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
+        "Accept-Encoding": _accept_encoding(),
     }
     if "tabelog.com" in url.lower():
         headers["Referer"] = "https://tabelog.com/"
     req = urllib.request.Request(url, data=None, method="GET", headers=headers)
-    with urllib.request.urlopen(req, timeout=timeout) as res:
-        raw = res.read(max_bytes)
-    for enc in ("utf-8", "cp932", "shift_jis", "iso-8859-1"):
-        try:
-            return raw.decode(enc, errors="replace")
-        except Exception:
-            continue
-    return raw.decode("utf-8", errors="replace")
+    raw, content_type = http_cache.fetch(req, max_bytes, timeout, throttle)
+    return decode_html(raw, content_type, url)
 
 
 def _resolve_url(base_url, href):
@@ -409,51 +597,56 @@ def _parse_tabelog_detail_page(html):
     return out
 
 
-def _build_tabelog_csv_from_chunks(chunks):
+# プログラムでパースできるサイト。一覧・詳細ページの HTML から CSV の行を作る（それ以外のサイトは AI で抽出する）
+def _csv_line(values):
+    def q(s):
+        s = str(s).replace('"', '""')
+        return f'"{s}"' if "," in s or "\n" in s or '"' in s else s
+    return ",".join(q(v) for v in values)
+
+
+def _tabelog_row(html, listing):
+    """食べログの詳細ページ1件を、同じ順の一覧ブロックと突き合わせて1行にする"""
+    det = _parse_tabelog_detail_page(html)
+    return [
+        det.get("name") or listing.get("name") or "",
+        det.get("phone") or "",
+        det.get("address") or "",
+        listing.get("area") or "",
+        listing.get("genre") or "",
+        listing.get("rating") or "",
+        listing.get("review_count") or "",
+        listing.get("price_range") or "",
+    ]
+
+
+# プログラムでパースできるサイト（ScrapeSite の各項目は common.py を参照）
+SCRAPE_SITES = (
+    ScrapeSite("tabelog.com", ("店名", "電話番号", "住所", "地域", "ジャンル", "評価", "口コミ数", "価格帯"), _parse_tabelog_list_blocks, _tabelog_row),
+)
+
+
+def _build_site_csv_from_chunks(site, chunks):
     """
     chunks = [(label, html), ...] のうち「一覧」「詳細」をパースしてCSV文字列を返す。
-    詳細ページの順序で行を並べ、一覧は同じ順のブロックと突き合わせる。
+    詳細ページの順序で行を並べ、一覧は詳細ページの URL の番号で突き合わせる（ジョブと同じ）。
     """
     list_rows = []
-    detail_rows = []
+    lines = []
+    num_detail = 0
     for label, html in chunks:
-        if "一覧" in label:
-            list_rows.extend(_parse_tabelog_list_blocks(html))
+        if "一覧" in label and site.parse_listing:
+            list_rows.extend(site.parse_listing(html))
         if "詳細" in label:
-            detail_rows.append(_parse_tabelog_detail_page(html))
-    # 詳細が N 件なら N 行出力。一覧は先頭から対応（足りなければ空で補う）
-    rows = []
-    for i, det in enumerate(detail_rows):
-        lst = list_rows[i] if i < len(list_rows) else {}
-        name = det.get("name") or lst.get("name") or ""
-        phone = det.get("phone") or ""
-        address = det.get("address") or ""
-        area = lst.get("area") or ""
-        genre = lst.get("genre") or ""
-        rating = lst.get("rating") or ""
-        review_count = lst.get("review_count") or ""
-        price_range = lst.get("price_range") or ""
-        rows.append({
-            "店名": name,
-            "電話番号": phone,
-            "住所": address,
-            "地域": area,
-            "ジャンル": genre,
-            "評価": rating,
-            "口コミ数": review_count,
-            "価格帯": price_range,
-        })
-    if not rows:
+            # 詳細が N 件なら N 行出力。取得できなかった詳細ページがあっても、一覧は同じ番号のブロックと対応させる（足りなければ空で補う）
+            index = _detail_chunk_index(label, num_detail)
+            row = site.parse_row(html, list_rows[index] if index < len(list_rows) else {})
+            num_detail += 1
+            if row is not None:
+                lines.append(_csv_line(row))
+    if not lines:
         return ""
-    buf = []
-    header = ["店名", "電話番号", "住所", "地域", "ジャンル", "評価", "口コミ数", "価格帯"]
-    buf.append(",".join(header))
-    for r in rows:
-        def q(s):
-            s = str(s).replace('"', '""')
-            return f'"{s}"' if "," in s or "\n" in s or '"' in s else s
-        buf.append(",".join(q(r.get(k, "")) for k in header))
-    return "\r\n".join(buf)
+    return "\r\n".join([",".join(site.header)] + lines)
 
 
 def _fetch_pages_for_scrape(
@@ -463,11 +656,16 @@ def _fetch_pages_for_scrape(
     follow_pages=True,
     max_pages=3,
     delay_sec=0.5,
+    observer=None,
+    keep_details=True,
 ):
     """
     開始URLから一覧を取得し、必要に応じて次ページ・詳細ページをたどり、
     (ラベル付きHTMLのリスト, エラーメッセージ) を返す。
+    observer があれば listing_fetched(HTML)・details_found(URLリスト)・detail_fetched(番号, URL, HTML か None) で進み具合を知らせ、
+    observer.cancel（threading.Event）が立ったらそこで打ち切る。keep_details=False なら詳細ページは observer に渡すだけで返さない
     """
+    cancel = observer.cancel if observer else None
     if not start_url.strip():
         return [], "URL が空です"
     base = start_url.strip()
@@ -479,18 +677,23 @@ def _fetch_pages_for_scrape(
     next_url = base
     page_count = 0
     while next_url and page_count < max_pages:
+        if cancel is not None and cancel.is_set():
+            return all_html_chunks, "キャンセルされました"
         page_count += 1
         try:
-            html = fetch_url_html(next_url, max_bytes=1 * 1024 * 1024, timeout=20)
+            html = fetch_url_html(
+                next_url, max_bytes=1 * 1024 * 1024, timeout=20, throttle=scrape_throttle.slot(next_url, delay_sec)
+            )
         except Exception as e:
             return all_html_chunks, f"一覧の取得に失敗: {e}"
         all_html_chunks.append(("[一覧ページ " + str(page_count) + "] " + next_url + "\n", html))
+        if observer:
+            observer.listing_fetched(html)
         if follow_pages and BeautifulSoup:
             next_link = _extract_next_page_link(html, next_url)
             if next_link and next_link not in visited_listing:
                 visited_listing.add(next_link)
                 next_url = next_link
-                time.sleep(delay_sec)
                 continue
         break
     detail_urls = []
@@ -499,11 +702,13 @@ def _fetch_pages_for_scrape(
             detail_urls.extend(_extract_detail_links(html, base, limit=max_detail_pages))
         # 重複除去しつつ順序を保ち、上限まで採用（食べログは30件等まとめて取得）
         detail_urls = list(dict.fromkeys(detail_urls))[:max_detail_pages]
-    for i, durl in enumerate(detail_urls):
-        time.sleep(delay_sec)
-        try:
-            html = fetch_url_html(durl, max_bytes=500 * 1024, timeout=15)
-        except Exception:
+    # 同じホストへは delay_sec 間隔・同時 SCRAPE_PER_HOST_CONCURRENCY 本までで並列に取得（取得できなかったページは飛ばす）
+    if observer:
+        observer.details_found(detail_urls)
+    on_page = observer.detail_fetched if observer else None
+    pages = _fetch_detail_pages(detail_urls, fetch_url_html, delay_sec, max_bytes=500 * 1024, timeout=15, on_page=on_page, cancel=cancel, keep=keep_details)
+    for i, (durl, html) in enumerate(zip(detail_urls, pages)):
+        if html is None:
             continue
         all_html_chunks.append(("[詳細ページ " + str(i + 1) + "] " + durl + "\n", html))
     return all_html_chunks, None
@@ -513,10 +718,8 @@ def get_preset_prompt(preset_id):
     """preset_id に対応するプロンプト文を返す。なければ空文字"""
     if not preset_id or not (preset_id := str(preset_id).strip()):
         return ""
-    for p in load_presets():
-        if (p.get("id") or "").strip() == preset_id:
-            return (p.get("prompt") or "").strip()
-    return ""
+    p = _preset_registry.get(preset_id)
+    return (p.get("prompt") or "").strip() if p else ""
 
 
 def save_preset_prompt(preset_id, prompt):
@@ -526,26 +729,13 @@ def save_preset_prompt(preset_id, prompt):
         return False
     prompt = (prompt or "").strip() if prompt is not None else ""
     try:
-        if not os.path.isfile(PROMPTS_FILE):
-            return False
-        with open(PROMPTS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        presets = data.get("presets") or []
-        for p in presets:
-            if (p.get("id") or "").strip() == preset_id:
-                p["prompt"] = prompt
-                break
-        else:
-            return False
-        with open(PROMPTS_FILE, "w", encoding="utf-8") as f:
-            json.dump({"presets": presets}, f, ensure_ascii=False, indent=2)
-        return True
+        return _preset_registry.save_prompt(preset_id, prompt)
     except Exception:
         return False
 
 
-def _extract_text_from_pdf(path):
-    """PDF からテキストを抽出する"""
+def _extract_sections_from_pdf(path):
+    """PDF からページごとのテキストを抽出する"""
     if PdfReader is None:
         return None
     reader = PdfReader(path)
@@ -554,11 +744,11 @@ def _extract_text_from_pdf(path):
         t = page.extract_text()
         if t:
             parts.append(t)
-    return "\n".join(parts) if parts else ""
+    return parts
 
 
-def _extract_text_from_docx(path):
-    """DOCX からテキストを抽出する"""
+def _extract_sections_from_docx(path):
+    """DOCX から段落ごと・表ごとのテキストを抽出する"""
     if DocxDocument is None:
         return None
     doc = DocxDocument(path)
@@ -567,74 +757,569 @@ def _extract_text_from_docx(path):
         if p.text.strip():
             parts.append(p.text)
     for table in doc.tables:
-        for row in table.rows:
-            parts.append("\t".join(cell.text for cell in row.cells))
-    return "\n".join(parts) if parts else ""
+        rows = ["\t".join(cell.text for cell in row.cells) for row in table.rows]
+        if rows:
+            parts.append("\n".join(rows))
+    return parts
 
 
-def _extract_text_from_pptx(path):
-    """PPTX からテキストを抽出する"""
+def _extract_sections_from_pptx(path):
+    """PPTX からスライドごとのテキストを抽出する"""
     if Presentation is None:
         return None
     prs = Presentation(path)
     parts = []
     for slide in prs.slides:
-        for shape in slide.shapes:
-            if shape.has_text_frame:
-                parts.append(shape.text)
-    return "\n".join(parts) if parts else ""
+        texts = [shape.text for shape in slide.shapes if shape.has_text_frame]
+        if texts:
+            parts.append("\n".join(texts))
+    return parts
 
 
-def _read_file_text(path):
-    """拡張子に応じてファイルからテキストを読み込む。失敗時は None"""
+def _read_file_sections(path):
+    """拡張子に応じてファイルを構造単位（段落・表・ページ・スライド）のリストで読み込む。失敗時は None"""
     name = os.path.basename(path)
     lower = name.lower()
     try:
         if lower.endswith(".txt") or lower.endswith(".md"):
             with open(path, "r", encoding="utf-8", errors="replace") as f:
-                return f.read()
+                return [p for p in re.split(r"\n\s*\n", f.read()) if p.strip()]
         if lower.endswith(".pdf"):
-            return _extract_text_from_pdf(path)
+            return _extract_sections_from_pdf(path)
         if lower.endswith(".docx"):
-            return _extract_text_from_docx(path)
+            return _extract_sections_from_docx(path)
         if lower.endswith(".pptx"):
-            return _extract_text_from_pptx(path)
+            return _extract_sections_from_pptx(path)
     except Exception:
         pass
     return None
 
 
-def get_context_text():
-    """context フォルダ内の .txt / .md / .pdf / .docx / .pptx を更新日時の新しい順に読み込み、1つの文字列にする"""
-    if not os.path.isdir(CONTEXT_DIR):
-        return ""
-    parts = []
+# path -> (サイズ, 更新日時ns, 内容の SHA-256, 抽出セクションのリスト)
+_extract_mem_cache = {}
+_extract_cache_lock = threading.Lock()
+
+
+def _file_sha256(path):
+    """ファイル内容の SHA-256（16進）を返す"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _extract_cache_path(digest, path):
+    """内容ハッシュに対応するディスクキャッシュのパス（拡張子で抽出方法が変わるため含める）"""
+    ext = os.path.splitext(path)[1].lower()
+    return os.path.join(EXTRACT_CACHE_DIR, f"v{EXTRACT_CACHE_VERSION}-{digest}{ext}.json")
+
+
+def _load_extract_cache(cache_path):
+    """ディスクキャッシュから抽出セクションを読む。無ければ None"""
     try:
-        files = []
-        for name in os.listdir(CONTEXT_DIR):
-            if any(name.lower().endswith(ext) for ext in CONTEXT_EXTENSIONS):
-                path = os.path.join(CONTEXT_DIR, name)
-                if os.path.isfile(path):
-                    files.append((path, os.path.getmtime(path)))
-        files.sort(key=lambda x: -x[1])  # 新しい順
-        total = 0
-        for path, _ in files:
-            if total >= CONTEXT_MAX_CHARS:
-                break
-            text = _read_file_text(path)
-            if text is None or not text.strip():
-                continue
-            name = os.path.basename(path)
-            chunk = f"\n--- {name} ---\n{text}\n"
-            if total + len(chunk) > CONTEXT_MAX_CHARS:
-                chunk = chunk[: CONTEXT_MAX_CHARS - total]
-            parts.append(chunk)
-            total += len(chunk)
-    except Exception:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("sections")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _save_extract_cache(cache_path, sections):
+    """抽出セクションをディスクキャッシュに書く（一時ファイル → rename で途中状態を見せない）"""
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"sections": sections}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError:
         pass
+
+
+def _read_file_sections_cached(path):
+    """
+    _read_file_sections のキャッシュ版。
+    (パス, サイズ, 更新日時) が同じならメモリから返し、変わっていれば内容ハッシュで
+    ディスクキャッシュを探す。どちらにも無いときだけ PDF / DOCX / PPTX を解析する。
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    cached = _extract_mem_cache.get(path)
+    if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+        return cached[3]
+    try:
+        digest = _file_sha256(path)
+    except OSError:
+        return None
+    if cached and cached[2] == digest:
+        # 更新日時だけ変わった（内容は同じ）
+        sections = cached[3]
+    else:
+        cache_path = _extract_cache_path(digest, path)
+        sections = _load_extract_cache(cache_path)
+        if sections is None:
+            sections = _read_file_sections(path)
+            if sections is not None:
+                _save_extract_cache(cache_path, sections)
+    with _extract_cache_lock:
+        _extract_mem_cache[path] = (st.st_size, st.st_mtime_ns, digest, sections)
+    return sections
+
+
+def _prune_extract_cache(paths):
+    """context フォルダから消えたファイルのメモリキャッシュを捨てる"""
+    keep = set(paths)
+    with _extract_cache_lock:
+        for path in [p for p in _extract_mem_cache if p not in keep]:
+            del _extract_mem_cache[path]
+
+
+# 組み立て済みコンテキストの不変スナップショット。差し替えはポインタ（_context_snapshot）の代入のみ
+# files: ((ファイル名, サイズ, 更新日時), ...) 新しい順 / documents: ((ファイル名, テキスト), ...)
+# chunks / index: 質問に関係する部分だけを選ぶための分割テキストと BM25 索引
+ContextSnapshot = collections.namedtuple(
+    "ContextSnapshot", ["version", "digest", "files", "documents", "text", "chunks", "index", "signature"]
+)
+_context_snapshot = None
+_context_snapshot_lock = threading.Lock()
+_context_changed = threading.Event()
+_context_watcher_pid = None
+_context_warmup_done = threading.Event()
+_context_warmup_done.set()  # ウォームアップ中だけ clear される
+
+
+def _scan_context_dir():
+    """context フォルダの対象ファイルを (path, size, mtime_ns) のリストで返す（更新日時の新しい順）"""
+    if not os.path.isdir(CONTEXT_DIR):
+        return []
+    files = []
+    try:
+        with os.scandir(CONTEXT_DIR) as it:
+            for entry in it:
+                if not any(entry.name.lower().endswith(ext) for ext in CONTEXT_EXTENSIONS):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((entry.path, st.st_size, st.st_mtime_ns))
+    except OSError:
+        return []
+    files.sort(key=lambda x: -x[2])  # 新しい順
+    return files
+
+
+def _build_context_snapshot(files, version):
+    """走査結果からスナップショットを組み立てる（抽出はキャッシュ経由）"""
+    _prune_extract_cache(path for path, _, _ in files)
+    documents = []
+    digest = hashlib.sha256()
+    chunks = []
+    for path, _, _ in files:
+        sections = _read_file_sections_cached(path)
+        text = "\n".join(sections or [])
+        if not text.strip():
+            continue
+        name = os.path.basename(path)
+        documents.append((name, text))
+        chunks.extend(_chunk_sections(name, sections))
+        cached = _extract_mem_cache.get(path)
+        digest.update(f"{name}\0{cached[2] if cached else ''}\0".encode("utf-8"))
+    chunks = tuple(chunks)
+    return ContextSnapshot(
+        version=version,
+        digest=digest.hexdigest()[:16],
+        files=tuple((os.path.basename(path), size, mtime_ns / 1e9) for path, size, mtime_ns in files),
+        documents=tuple(documents),
+        text=format_context_chunks(fill_token_budget(chunks, CONTEXT_DEFAULT_TOKEN_BUDGET)),
+        chunks=chunks,
+        index=_build_bm25_index(chunks),
+        signature=tuple(files),
+    )
+
+
+# tokens: estimate_tokens(text) を分割時に1回だけ計算して持たせる / digest: 内容ハッシュ（並び順の固定用）
+ContextChunk = collections.namedtuple("ContextChunk", ["doc", "text", "tokens", "digest"])
+Bm25Index = collections.namedtuple("Bm25Index", ["postings", "lengths", "avgdl"])
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def estimate_tokens(text):
+    """テキストのトークン数。tiktoken があれば正確に、無ければ英数字 4 文字 ≒ 1、日本語 1 文字 ≒ 1 で概算"""
+    if not text:
+        return 0
+    if _token_encoding is not None:
+        return len(_token_encoding.encode(text, disallowed_special=()))
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars))
+
+
+def _split_sentences(text):
+    """文末（。！？ や改行）で区切る。区切り文字は前の文に残す"""
+    return [s for s in re.split(r"(?<=[。！？!?\n])", text) if s.strip()]
+
+
+def _make_chunk(name, text):
+    return ContextChunk(name, text, estimate_tokens(text), hashlib.sha256(f"{name}\0{text}".encode("utf-8")).hexdigest()[:16])
+
+
+def _chunk_sections(name, sections):
+    """
+    構造単位（段落・表・ページ・スライド）を CONTEXT_CHUNK_TOKENS 以内にまとめてチャンクにする。
+    1つのセクションが大きすぎるときは文の区切りで分ける（文の途中では切らない）。
+    """
+    pieces = []
+    for section in sections or []:
+        section = section.strip()
+        if not section:
+            continue
+        tokens = estimate_tokens(section)
+        if tokens <= CONTEXT_CHUNK_TOKENS:
+            pieces.append((section, tokens))
+            continue
+        for sentence in _split_sentences(section):
+            sentence = sentence.strip()
+            tokens = estimate_tokens(sentence)
+            while tokens > CONTEXT_CHUNK_TOKENS:
+                # 句点の無い長文だけは目安の長さで切る
+                cut = max(1, len(sentence) * CONTEXT_CHUNK_TOKENS // tokens)
+                pieces.append((sentence[:cut], estimate_tokens(sentence[:cut])))
+                sentence = sentence[cut:]
+                tokens = estimate_tokens(sentence)
+            if sentence:
+                pieces.append((sentence, tokens))
+    chunks = []
+    buf = []
+    size = 0
+    for piece, tokens in pieces:
+        if buf and size + tokens > CONTEXT_CHUNK_TOKENS:
+            chunks.append(_make_chunk(name, "\n".join(buf)))
+            buf, size = [], 0
+        buf.append(piece)
+        size += tokens
+    if buf:
+        chunks.append(_make_chunk(name, "\n".join(buf)))
+    return chunks
+
+
+def context_token_budget(model):
+    """モデルごとのフォルダコンテキスト用トークン上限"""
+    override = os.environ.get("CONTEXT_MAX_TOKENS")
+    if override:
+        return int(override)
+    model = (model or get_chat_model()).strip().lower()
+    for prefix, budget in CONTEXT_TOKEN_BUDGETS:
+        if model.startswith(prefix):
+            return budget
+    return CONTEXT_DEFAULT_TOKEN_BUDGET
+
+
+def fill_token_budget(chunks, budget):
+    """先頭（優先度の高い順）からトークン上限に収まるだけチャンクを選ぶ。入らないものは飛ばして次を試す"""
+    selected = []
+    used = 0
+    for chunk in chunks:
+        cost = chunk.tokens + 8  # 見出し行（--- ファイル名 ---）のぶん
+        if used + cost > budget:
+            continue
+        selected.append(chunk)
+        used += cost
+    return selected
+
+
+def format_context_chunks(chunks):
+    """チャンク列をシステムプロンプト用の文字列にする（同じファイルが続くときは見出しをまとめる）"""
+    parts = []
+    prev_doc = None
+    for chunk in chunks:
+        if chunk.doc != prev_doc:
+            parts.append(f"\n--- {chunk.doc} ---\n")
+            prev_doc = chunk.doc
+        parts.append(chunk.text + "\n")
     return "".join(parts)
 
 
+def _ngram_tokens(text):
+    """
+    検索用のトークン列。形態素解析を使わず、英数字は単語、それ以外（日本語など）は
+    文字 bigram にする（1文字だけの語はそのまま）。
+    """
+    tokens = []
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    for run in re.findall(r"\w+", text):
+        for part in re.findall(r"[a-z0-9_]+|[^a-z0-9_]+", run):
+            if part.isascii() or len(part) == 1:
+                tokens.append(part)
+            else:
+                tokens.extend(part[i:i + 2] for i in range(len(part) - 1))
+    return tokens
+
+
+def _build_bm25_index(chunks):
+    """チャンク列から転置索引（語 → [(チャンク番号, 出現回数), ...]）を作る"""
+    postings = collections.defaultdict(list)
+    lengths = []
+    for i, chunk in enumerate(chunks):
+        counts = collections.Counter(_ngram_tokens(chunk.text))
+        for term, tf in counts.items():
+            postings[term].append((i, tf))
+        lengths.append(sum(counts.values()))
+    avgdl = (sum(lengths) / len(lengths)) if lengths else 0.0
+    return Bm25Index(postings=dict(postings), lengths=tuple(lengths), avgdl=avgdl)
+
+
+def search_context(snapshot, query, top_k=None):
+    """BM25 で質問に関係するチャンクを上位から返す。[(スコア, ContextChunk), ...]"""
+    top_k = CONTEXT_TOP_K if top_k is None else top_k
+    index = snapshot.index
+    n = len(index.lengths)
+    if not n or top_k <= 0:
+        return []
+    scores = collections.defaultdict(float)
+    for term in set(_ngram_tokens(query)):
+        postings = index.postings.get(term)
+        if not postings:
+            continue
+        idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+        for i, tf in postings:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * index.lengths[i] / index.avgdl)
+            scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+    ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:top_k]
+    return [(score, snapshot.chunks[i]) for i, score in ranked]
+
+
+def select_context_chunks(query, model=None):
+    """質問に関係するチャンクをモデルのトークン上限まで選ぶ。ヒットが無ければ新しい順に選ぶ"""
+    snapshot = get_context_snapshot()
+    hits = search_context(snapshot, query)
+    candidates = [chunk for _, chunk in hits] if hits else snapshot.chunks
+    return fill_token_budget(candidates, context_token_budget(model))
+
+
+# /api/upload で受け取った追加コンテキスト（議事録・X のやり取り・スクレイピング結果など）の保存先。
+# 内容の SHA-256 で1回だけ保存し、/api/chat からは handle（"sha256:<16進>"）で参照する
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR") or os.path.join(tempfile.gettempdir(), "sales-proposal-app", "uploads")
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_MB", "5")) * 1024 * 1024  # 1件の上限
+UPLOAD_CONTEXT_TOKENS = int(os.environ.get("UPLOAD_CONTEXT_TOKENS", "4000"))  # 1回の質問で添付から入れるトークン数
+UPLOAD_INDEX_CACHE_SIZE = 32  # チャンク・索引をメモリに持っておく添付の数
+UPLOAD_HANDLE_RE = re.compile(r"^sha256:([0-9a-f]{64})$")
+
+# 添付1件分のチャンクと BM25 索引（search_context にフォルダのスナップショットと同じように渡せる）
+UploadedBlob = collections.namedtuple("UploadedBlob", ["handle", "name", "size", "chunks", "index"])
+
+
+class UploadStore:
+    """
+    テキストを内容の SHA-256 をファイル名にして保存する（同じ内容は何度送られても1つ）。
+    読み出すときはフォルダのファイルと同じ方法でチャンクに分けて索引を作る。内容は変わらないので結果は LRU で持つ
+    """
+
+    def __init__(self, directory, cache_size):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()  # handle -> UploadedBlob
+        self._lock = threading.Lock()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + ".json")
+
+    def put(self, text, name=""):
+        """保存して handle を返す（既にあれば書かない）"""
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _atomic_write_json(path, {"name": name, "text": text})
+        return "sha256:" + digest
+
+    def get(self, handle):
+        """UploadedBlob を返す。handle の形式が違う・保存されていなければ None"""
+        m = UPLOAD_HANDLE_RE.match(handle or "")
+        if not m:
+            return None
+        with self._lock:
+            blob = self._cache.get(handle)
+            if blob is not None:
+                self._cache.move_to_end(handle)
+                return blob
+        try:
+            with open(self._path(m.group(1)), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        text = data.get("text") or ""
+        name = data.get("name") or f"添付 {m.group(1)[:8]}"
+        chunks = tuple(_chunk_sections(name, [p for p in re.split(r"\n\s*\n", text) if p.strip()]))
+        blob = UploadedBlob(handle, name, len(text.encode("utf-8")), chunks, _build_bm25_index(chunks))
+        with self._lock:
+            self._cache[handle] = blob
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return blob
+
+
+upload_store = UploadStore(UPLOAD_DIR, UPLOAD_INDEX_CACHE_SIZE)
+
+
+def select_upload_chunks(blobs, query, budget=None):
+    """
+    添付のチャンクを質問に関係するものから budget まで選ぶ（全部入るなら全部）。
+    選んだチャンクは元の並び順で返す（同じ組み合わせなら同じプロンプトになる）
+    """
+    budget = UPLOAD_CONTEXT_TOKENS if budget is None else budget
+    chunks = [chunk for blob in blobs for chunk in blob.chunks]
+    if sum(chunk.tokens + 8 for chunk in chunks) <= budget:
+        return chunks
+    hits = sorted((hit for blob in blobs for hit in search_context(blob, query)), key=lambda h: -h[0])
+    selected = {id(chunk) for chunk in fill_token_budget([chunk for _, chunk in hits] if hits else chunks, budget)}
+    return [chunk for chunk in chunks if id(chunk) in selected]
+
+
+def refresh_context_snapshot():
+    """context フォルダを走査し、変化があればスナップショットを差し替える。差し替えたら True"""
+    global _context_snapshot
+    with _context_snapshot_lock:
+        files = _scan_context_dir()
+        current = _context_snapshot
+        if current is not None and current.signature == tuple(files):
+            return False
+        version = current.version + 1 if current is not None else 1
+        _context_snapshot = _build_context_snapshot(files, version)
+        return True
+
+
+class _ContextChangeHandler(FileSystemEventHandler):
+    """watchdog のイベントを受けたら監視スレッドを起こす"""
+
+    def on_any_event(self, event):
+        _context_changed.set()
+
+
+def _context_watch_loop(poll_interval):
+    """変更通知（またはポーリング間隔の経過）ごとにスナップショットを更新する"""
+    while True:
+        if _context_changed.wait(poll_interval):
+            time.sleep(0.3)  # 連続した書き込みをまとめてから読む
+            _context_changed.clear()
+        try:
+            refresh_context_snapshot()
+        except Exception:
+            pass
+
+
+def _start_context_watcher():
+    """プロセスごとに1回だけ監視スレッドを起動する（gunicorn の fork 後も各ワーカーで起動）"""
+    global _context_watcher_pid
+    if CONTEXT_WATCH_INTERVAL <= 0 or _context_watcher_pid == os.getpid():
+        return
+    _context_watcher_pid = os.getpid()
+    poll_interval = CONTEXT_WATCH_INTERVAL
+    if WatchdogObserver is not None and os.path.isdir(CONTEXT_DIR):
+        try:
+            observer = WatchdogObserver()
+            observer.daemon = True
+            observer.schedule(_ContextChangeHandler(), CONTEXT_DIR, recursive=False)
+            observer.start()
+            poll_interval = max(poll_interval, 60.0)  # 通知の取りこぼし対策として低頻度の走査は残す
+        except Exception:
+            pass
+    threading.Thread(target=_context_watch_loop, args=(poll_interval,), daemon=True).start()
+
+
+def get_context_snapshot():
+    """現在のコンテキストスナップショットを返す。監視スレッドが動いていればファイルシステムに触れない"""
+    if not _context_warmup_done.is_set():
+        _context_warmup_done.wait()
+    snapshot = _context_snapshot
+    if snapshot is None or CONTEXT_WATCH_INTERVAL <= 0:
+        refresh_context_snapshot()
+        snapshot = _context_snapshot
+    if _context_watcher_pid != os.getpid():
+        _start_context_watcher()
+    return snapshot
+
+
+def _extract_for_warmup(path):
+    """プロセスプールの子プロセスで1ファイルを抽出し、(セクション, 所要秒数) を返す"""
+    start = time.perf_counter()
+    sections = _read_file_sections(path)
+    return sections, time.perf_counter() - start
+
+
+def warm_context_cache(workers=None):
+    """
+    context フォルダの未キャッシュのファイルをプロセスプールで並列に抽出し、スナップショットを作っておく。
+    PDF / DOCX の解析は CPU を使う純 Python 処理のため、スレッドではなくプロセスで並列化する。
+    返り値: [(ファイル名, 抽出秒数 or None（キャッシュ済み）), ...]
+    """
+    started = time.perf_counter()
+    pending = []
+    report = []
+    for path, size, mtime_ns in _scan_context_dir():
+        try:
+            digest = _file_sha256(path)
+        except OSError:
+            continue
+        cache_path = _extract_cache_path(digest, path)
+        if os.path.isfile(cache_path):
+            report.append((os.path.basename(path), None))
+        else:
+            pending.append((path, size, mtime_ns, digest, cache_path))
+
+    def _store(item, sections, elapsed):
+        path, size, mtime_ns, digest, cache_path = item
+        if sections is not None:
+            _save_extract_cache(cache_path, sections)
+            with _extract_cache_lock:
+                _extract_mem_cache[path] = (size, mtime_ns, digest, sections)
+        report.append((os.path.basename(path), elapsed))
+
+    if pending:
+        try:
+            workers = min(workers or os.cpu_count() or 1, len(pending))
+            # fork だと import 途中のモジュールの状態を子が引き継いで固まることがあるため spawn を使う
+            mp_context = multiprocessing.get_context("spawn")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+                futures = {pool.submit(_extract_for_warmup, item[0]): item for item in pending}
+                for future in concurrent.futures.as_completed(futures):
+                    _store(futures[future], *future.result())
+        except (OSError, NotImplementedError, concurrent.futures.process.BrokenProcessPool):
+            # プロセスを作れない環境（一部のサーバーレス等）では順番に抽出する
+            stored = {name for name, _ in report}
+            for item in pending:
+                if os.path.basename(item[0]) not in stored:
+                    _store(item, *_extract_for_warmup(item[0]))
+    refresh_context_snapshot()
+    for name, elapsed in sorted(report, key=lambda r: -(r[1] or 0)):
+        print(f"[warmup] {name}: {'キャッシュ済み' if elapsed is None else f'{elapsed:.2f}s'}", flush=True)
+    print(f"[warmup] {len(pending)}/{len(report)} ファイルを抽出（{time.perf_counter() - started:.2f}s）", flush=True)
+    return report
+
+
+def start_context_warmup():
+    """
+    warm_context_cache を別スレッドで始める。
+    import の途中ではこのモジュールの関数を子プロセスに渡せない（pickle が import 完了を待つ）ため、
+    スレッドで待たせておき、終わるまでは get_context_snapshot() が完了を待つ。
+    """
+    _context_warmup_done.clear()
+
+    def _run():
+        try:
+            warm_context_cache(CONTEXT_WARMUP_WORKERS)
+        except Exception as e:
+            print(f"[warmup] 失敗: {e!r}", flush=True)
+        finally:
+            _context_warmup_done.set()
+
+    threading.Thread(target=_run, daemon=True).start()
+
+
 # 環境変数 OPENAI_API_KEY からAPIキーを取得
 def get_api_key():
     api_key = os.environ.get("OPENAI_API_KEY")
@@ -663,37 +1348,106 @@ def get_chat_model():
     return os.environ.get("OPENAI_CHAT_MODEL", "gpt-4o-mini").strip() or "gpt-4o-mini"
 
 
-def call_gemini_api(messages, api_key, model):
-    """Google Gemini API を呼び出す。messages は OpenAI 形式 [{"role":"system|user|assistant","content":"..."}]"""
-    model = (model or "gemini-2.0-flash").strip()
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
-    system_parts = []
+# LLM_HTTP_PREWARM のとき起動時に接続を張っておく LLM API のホスト
+LLM_API_HOSTS = ("api.openai.com", "generativelanguage.googleapis.com")
+
+
+def _estimate_request_tokens(messages):
+    return sum(estimate_tokens(m.get("content") or "") for m in messages) + LLM_EXPECTED_OUTPUT_TOKENS
+
+
+_SSE_DONE = object()
+
+
+def _sse_data_from_line(line):
+    """SSE の1行から data: の JSON を取り出す（data 以外の行は None、OpenAI の [DONE] は _SSE_DONE）"""
+    line = line.decode("utf-8").rstrip("\r\n")
+    if not line.startswith("data:"):
+        return None
+    payload = line[5:].strip()
+    if payload == "[DONE]":
+        return _SSE_DONE
+    return json.loads(payload) if payload else None
+
+
+def _iter_sse_data(res):
+    """SSE のレスポンスから data: の JSON を順に返す（OpenAI の [DONE] で終了）"""
+    while True:
+        line = res.readline()
+        if not line:
+            return
+        data = _sse_data_from_line(line)
+        if data is _SSE_DONE:
+            res.read()  # 終端まで読んで接続を再利用できるようにする
+            return
+        if data is not None:
+            yield data
+
+
+async def _aiter_sse_data(res):
+    """_iter_sse_data の async 版"""
+    buf = b""
+    done = False
+    async for chunk in res.iter_chunks():
+        if done:
+            continue  # [DONE] の後は終端まで読み捨てる（接続を再利用できるように）
+        buf += chunk
+        while not done and b"\n" in buf:
+            line, buf = buf.split(b"\n", 1)
+            data = _sse_data_from_line(line)
+            if data is _SSE_DONE:
+                done = True
+            elif data is not None:
+                yield data
+
+
+def _gemini_request_body(messages):
+    """
+    OpenAI 形式の messages [{"role":"system|user|assistant","content":"..."}] を Gemini のリクエスト本文にする。
+    systemInstruction は contents より前に置かれるので、入れるのは先頭の（固定の）system だけにする。
+    2つ目以降の system（要約・毎ターン変わる参考情報）は同じ位置に user として入れ、暗黙キャッシュの効く先頭を変えない
+    """
+    system_text = None
     contents = []
     for m in messages:
         role = (m.get("role") or "").strip().lower()
         content = (m.get("content") or "").strip()
         if not content:
             continue
-        if role == "system":
-            system_parts.append(content)
+        if role == "system" and system_text is None and not contents:
+            system_text = content
             continue
         gemini_role = "model" if role == "assistant" else "user"
-        contents.append({"role": gemini_role, "parts": [{"text": content}]})
+        if contents and contents[-1]["role"] == gemini_role:
+            # 同じ役割が続くとき（参考情報 → 今回の質問など）は1つの content にまとめる
+            contents[-1]["parts"].append({"text": content})
+        else:
+            contents.append({"role": gemini_role, "parts": [{"text": content}]})
     body = {
         "contents": contents,
-        "generationConfig": {"temperature": 0.7},
+        "generationConfig": {"temperature": LLM_TEMPERATURE},
     }
-    if system_parts:
-        body["systemInstruction"] = {"parts": [{"text": "\n\n".join(system_parts)}]}
-    body_bytes = json.dumps(body, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(
-        url,
-        data=body_bytes,
-        method="POST",
-        headers={"Content-Type": "application/json; charset=utf-8"},
-    )
-    with urllib.request.urlopen(req) as res:
-        data = json.loads(res.read().decode("utf-8"))
+    if system_text:
+        body["systemInstruction"] = {"parts": [{"text": system_text}]}
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+GEMINI_HEADERS = {"Content-Type": "application/json; charset=utf-8"}
+
+
+def _gemini_model(model):
+    return (model or "gemini-2.0-flash").strip()
+
+
+def _gemini_url(model, api_key, stream=False):
+    model = _gemini_model(model)
+    if stream:
+        return f"https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
+    return f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
+
+
+def _gemini_reply(data):
+    """generateContent のレスポンスから (本文, 利用量) を取り出す"""
     if "candidates" not in data or not data["candidates"]:
         raise RuntimeError(data.get("error", {}).get("message", "Gemini が応答を返しませんでした。") or str(data))
     parts = data["candidates"][0].get("content", {}).get("parts", [])
@@ -705,39 +1459,250 @@ def call_gemini_api(messages, api_key, model):
     return text, usage
 
 
+def _gemini_stream_delta(data):
+    """streamGenerateContent の1イベントから (文字列のリスト, 利用量 or None) を取り出す"""
+    if data.get("error"):
+        raise RuntimeError(data["error"].get("message") or str(data["error"]))
+    texts = []
+    for cand in (data.get("candidates") or [])[:1]:
+        for part in (cand.get("content") or {}).get("parts") or []:
+            if part.get("text"):
+                texts.append(part["text"])
+    return texts, (_gemini_usage_from_response(data) if data.get("usageMetadata") else None)
+
+
+def call_gemini_api(messages, api_key, model, use_cache=True):
+    """
+    Google Gemini API を呼び出す。messages は OpenAI 形式 [{"role":"system|user|assistant","content":"..."}]
+    use_cache=True なら同じ内容の応答を応答キャッシュから返す。レート枠を待ち、429・5xx はリトライする
+    """
+    model = _gemini_model(model)
+    key, hit = _cached_reply("gemini", model, messages, use_cache)
+    if hit:
+        return hit
+    est_tokens = _estimate_request_tokens(messages)
+    _, _, raw = _call_with_retries(model, est_tokens, lambda: llm_http.request(
+        "POST", _gemini_url(model, api_key), body=_gemini_request_body(messages), headers=GEMINI_HEADERS
+    ))
+    reply, usage = _gemini_reply(json.loads(raw.decode("utf-8")))
+    llm_scheduler.settle(model, est_tokens, usage)
+    _store_reply(key, "gemini", model, reply, usage)
+    return reply, usage
+
+
+async def acall_gemini_api(messages, api_key, model, use_cache=True):
+    """call_gemini_api の async 版"""
+    model = _gemini_model(model)
+    key, hit = await _acached_reply("gemini", model, messages, use_cache)
+    if hit:
+        return hit
+    est_tokens = _estimate_request_tokens(messages)
+    _, _, raw = await _acall_with_retries(model, est_tokens, lambda: allm_http.request(
+        "POST", _gemini_url(model, api_key), body=_gemini_request_body(messages), headers=GEMINI_HEADERS
+    ))
+    reply, usage = _gemini_reply(json.loads(raw.decode("utf-8")))
+    llm_scheduler.settle(model, est_tokens, usage)
+    await _astore_reply(key, "gemini", model, reply, usage)
+    return reply, usage
+
+
+def stream_gemini_api(messages, api_key, model, use_cache=True):
+    """
+    Gemini の streamGenerateContent（SSE）を呼び出す。
+    ("delta", 文字列) を届いた順に返し、最後に ("usage", 利用量) を返すジェネレーター。
+    応答キャッシュにあれば全文を1回の delta で返す。リトライは最初の応答ヘッダーまで
+    """
+    model = _gemini_model(model)
+    key, hit = _cached_reply("gemini", model, messages, use_cache)
+    if hit:
+        yield "delta", hit[0]
+        yield "usage", hit[1]
+        return
+    est_tokens = _estimate_request_tokens(messages)
+    parts = []
+    usage = {}
+    with contextlib.ExitStack() as stack:
+        res = _call_with_retries(model, est_tokens, lambda: stack.enter_context(llm_http.stream(
+            "POST", _gemini_url(model, api_key, stream=True), body=_gemini_request_body(messages), headers=GEMINI_HEADERS
+        )))
+        for data in _iter_sse_data(res):
+            texts, chunk_usage = _gemini_stream_delta(data)
+            for text in texts:
+                parts.append(text)
+                yield "delta", text
+            usage = chunk_usage or usage
+    llm_scheduler.settle(model, est_tokens, usage)
+    _store_reply(key, "gemini", model, "".join(parts).strip(), usage)
+    yield "usage", usage
+
+
+async def astream_gemini_api(messages, api_key, model, use_cache=True):
+    """stream_gemini_api の async 版"""
+    model = _gemini_model(model)
+    key, hit = await _acached_reply("gemini", model, messages, use_cache)
+    if hit:
+        yield "delta", hit[0]
+        yield "usage", hit[1]
+        return
+    est_tokens = _estimate_request_tokens(messages)
+    parts = []
+    usage = {}
+    async with contextlib.AsyncExitStack() as stack:
+        res = await _acall_with_retries(model, est_tokens, lambda: stack.enter_async_context(allm_http.stream(
+            "POST", _gemini_url(model, api_key, stream=True), body=_gemini_request_body(messages), headers=GEMINI_HEADERS
+        )))
+        async for data in _aiter_sse_data(res):
+            texts, chunk_usage = _gemini_stream_delta(data)
+            for text in texts:
+                parts.append(text)
+                yield "delta", text
+            usage = chunk_usage or usage
+    llm_scheduler.settle(model, est_tokens, usage)
+    await _astore_reply(key, "gemini", model, "".join(parts).strip(), usage)
+    yield "usage", usage
+
+
 def _gemini_usage_from_response(data):
     """Gemini API レスポンスから利用量を抽出。input/output/total トークン数"""
     um = data.get("usageMetadata") or data.get("usage_metadata") or {}
     prompt = um.get("promptTokenCount") or um.get("prompt_token_count") or 0
     candidates = um.get("candidatesTokenCount") or um.get("candidates_token_count") or 0
     total = um.get("totalTokenCount") or um.get("total_token_count") or (prompt + candidates)
-    return {"input_tokens": prompt, "output_tokens": candidates, "total_tokens": total}
+    cached = um.get("cachedContentTokenCount") or um.get("cached_content_token_count") or 0
+    return {"input_tokens": prompt, "output_tokens": candidates, "total_tokens": total, "cached_tokens": cached}
 
 
-def call_chatgpt_api(messages, api_key, model=None):
-    """UTF-8 で明示的にリクエストを送り、Windows の ASCII エンコードエラーを防ぐ"""
-    url = "https://api.openai.com/v1/chat/completions"
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+
+def _openai_headers(api_key):
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json; charset=utf-8",
+    }
+
+
+def _openai_model(model):
+    return (model or get_chat_model()).strip() or get_chat_model()
+
+
+def _openai_request_body(messages, model, stream=False):
     body = {
-        "model": (model or get_chat_model()).strip() or get_chat_model(),
+        "model": _openai_model(model),
         "messages": messages,
-        "temperature": 0.7,
+        "temperature": LLM_TEMPERATURE,
     }
+    if stream:
+        body["stream"] = True
+        body["stream_options"] = {"include_usage": True}  # 最後のチャンクで利用量を受け取る
     # 日本語をそのまま送るため ensure_ascii=False、バイト列は UTF-8 で作成
-    body_bytes = json.dumps(body, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(
-        url,
-        data=body_bytes,
-        method="POST",
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json; charset=utf-8",
-        },
-    )
-    with urllib.request.urlopen(req) as res:
-        data = json.loads(res.read().decode("utf-8"))
-    content = data["choices"][0]["message"]["content"]
-    usage = _openai_usage_from_response(data)
-    return content, usage
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def _openai_reply(data):
+    """Chat Completions のレスポンスから (本文, 利用量) を取り出す"""
+    return data["choices"][0]["message"]["content"], _openai_usage_from_response(data)
+
+
+def _openai_stream_delta(data):
+    """stream: true の1チャンクから (文字列のリスト, 利用量 or None) を取り出す"""
+    texts = []
+    for choice in data.get("choices") or []:
+        text = (choice.get("delta") or {}).get("content")
+        if text:
+            texts.append(text)
+    return texts, (_openai_usage_from_response(data) if data.get("usage") else None)
+
+
+def call_chatgpt_api(messages, api_key, model=None, use_cache=True):
+    """
+    UTF-8 で明示的にリクエストを送り、Windows の ASCII エンコードエラーを防ぐ。
+    use_cache=True なら同じ内容の応答を応答キャッシュから返す。レート枠を待ち、429・5xx はリトライする
+    """
+    model = _openai_model(model)
+    key, hit = _cached_reply("openai", model, messages, use_cache)
+    if hit:
+        return hit
+    est_tokens = _estimate_request_tokens(messages)
+    _, _, raw = _call_with_retries(model, est_tokens, lambda: llm_http.request(
+        "POST", OPENAI_CHAT_URL, body=_openai_request_body(messages, model), headers=_openai_headers(api_key)
+    ))
+    reply, usage = _openai_reply(json.loads(raw.decode("utf-8")))
+    llm_scheduler.settle(model, est_tokens, usage)
+    _store_reply(key, "openai", model, reply, usage)
+    return reply, usage
+
+
+async def acall_chatgpt_api(messages, api_key, model=None, use_cache=True):
+    """call_chatgpt_api の async 版"""
+    model = _openai_model(model)
+    key, hit = await _acached_reply("openai", model, messages, use_cache)
+    if hit:
+        return hit
+    est_tokens = _estimate_request_tokens(messages)
+    _, _, raw = await _acall_with_retries(model, est_tokens, lambda: allm_http.request(
+        "POST", OPENAI_CHAT_URL, body=_openai_request_body(messages, model), headers=_openai_headers(api_key)
+    ))
+    reply, usage = _openai_reply(json.loads(raw.decode("utf-8")))
+    llm_scheduler.settle(model, est_tokens, usage)
+    await _astore_reply(key, "openai", model, reply, usage)
+    return reply, usage
+
+
+def stream_chatgpt_api(messages, api_key, model=None, use_cache=True):
+    """
+    OpenAI Chat API を stream: true で呼び出す。
+    ("delta", 文字列) を届いた順に返し、最後に ("usage", 利用量) を返すジェネレーター。
+    応答キャッシュにあれば全文を1回の delta で返す。リトライは最初の応答ヘッダーまで
+    """
+    model = _openai_model(model)
+    key, hit = _cached_reply("openai", model, messages, use_cache)
+    if hit:
+        yield "delta", hit[0]
+        yield "usage", hit[1]
+        return
+    est_tokens = _estimate_request_tokens(messages)
+    parts = []
+    usage = {}
+    with contextlib.ExitStack() as stack:
+        res = _call_with_retries(model, est_tokens, lambda: stack.enter_context(llm_http.stream(
+            "POST", OPENAI_CHAT_URL, body=_openai_request_body(messages, model, stream=True), headers=_openai_headers(api_key)
+        )))
+        for data in _iter_sse_data(res):
+            texts, chunk_usage = _openai_stream_delta(data)
+            for text in texts:
+                parts.append(text)
+                yield "delta", text
+            usage = chunk_usage or usage
+    llm_scheduler.settle(model, est_tokens, usage)
+    _store_reply(key, "openai", model, "".join(parts), usage)
+    yield "usage", usage
+
+
+async def astream_chatgpt_api(messages, api_key, model=None, use_cache=True):
+    """stream_chatgpt_api の async 版"""
+    model = _openai_model(model)
+    key, hit = await _acached_reply("openai", model, messages, use_cache)
+    if hit:
+        yield "delta", hit[0]
+        yield "usage", hit[1]
+        return
+    est_tokens = _estimate_request_tokens(messages)
+    parts = []
+    usage = {}
+    async with contextlib.AsyncExitStack() as stack:
+        res = await _acall_with_retries(model, est_tokens, lambda: stack.enter_async_context(allm_http.stream(
+            "POST", OPENAI_CHAT_URL, body=_openai_request_body(messages, model, stream=True), headers=_openai_headers(api_key)
+        )))
+        async for data in _aiter_sse_data(res):
+            texts, chunk_usage = _openai_stream_delta(data)
+            for text in texts:
+                parts.append(text)
+                yield "delta", text
+            usage = chunk_usage or usage
+    llm_scheduler.settle(model, est_tokens, usage)
+    await _astore_reply(key, "openai", model, "".join(parts), usage)
+    yield "usage", usage
 
 
 def _openai_usage_from_response(data):
@@ -746,7 +1711,658 @@ def _openai_usage_from_response(data):
     prompt = u.get("prompt_tokens", 0)
     completion = u.get("completion_tokens", 0)
     total = u.get("total_tokens", 0) or (prompt + completion)
-    return {"input_tokens": prompt, "output_tokens": completion, "total_tokens": total}
+    cached = (u.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+    return {"input_tokens": prompt, "output_tokens": completion, "total_tokens": total, "cached_tokens": cached}
+
+
+# ヘッジ（主モデルの応答が遅いとき、別のプロバイダーのモデルにも同じリクエストを送って先に返った方を使う）。
+# /api/chat に "hedge": true を付けたとき、または LLM_HEDGE=1 のとき有効。待つ時間は主モデルの応答時間の p95
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_MODEL = os.environ.get("LLM_HEDGE_MODEL", "").strip()  # 未設定なら OpenAI ⇔ gemini-2.0-flash
+LLM_HEDGE_QUANTILE = float(os.environ.get("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_SAMPLES = 20  # これより計測が少ないうちは既定の待ち時間を使う
+LLM_HEDGE_DEFAULT_DELAY = {"reply": 8.0, "first_token": 2.0}  # 秒
+LLM_HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", "0.3"))  # p95 がこれより短くてもこれだけは待つ（秒）
+
+
+class LatencyHistogram:
+    """
+    応答時間の分布を対数間隔のバケツ（50ms から 1.25 倍ずつ、約 5 分まで）で数える。
+    decay_every 件ごとに全体を半分にして、古い分布の影響を薄める
+    """
+
+    BOUNDS = tuple(0.05 * 1.25 ** i for i in range(40))
+
+    def __init__(self, decay_every=1000):
+        self.counts = [0.0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+        self.decay_every = decay_every
+        self._since_decay = 0
+
+    def observe(self, sec):
+        self.counts[bisect.bisect_left(self.BOUNDS, sec)] += 1
+        self.total += 1
+        self._since_decay += 1
+        if self._since_decay >= self.decay_every:
+            self.counts = [c / 2 for c in self.counts]
+            self.total /= 2
+            self._since_decay = 0
+
+    def quantile(self, q):
+        """q 分位点の秒数（そのバケツの上端なので少し長めに出る）。計測が無ければ None"""
+        if not self.total:
+            return None
+        target = q * self.total
+        seen = 0.0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return self.BOUNDS[min(i, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+class LatencyTracker:
+    """モデルと種類（reply: 応答全体 / first_token: 最初の文字まで）ごとの LatencyHistogram と、ヘッジの回数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hists = {}  # (model, kind) -> LatencyHistogram
+        self._hedges = {}  # 主モデル -> 回数
+
+    def observe(self, model, kind, sec):
+        with self._lock:
+            hist = self._hists.get((model, kind))
+            if hist is None:
+                hist = self._hists[(model, kind)] = LatencyHistogram()
+            hist.observe(sec)
+
+    def hedge_delay(self, model, kind):
+        """主モデルの応答をこれだけ待っても返らなければヘッジを出す、という秒数"""
+        with self._lock:
+            hist = self._hists.get((model, kind))
+            p = hist.quantile(LLM_HEDGE_QUANTILE) if hist and hist.total >= LLM_HEDGE_MIN_SAMPLES else None
+        if p is None:
+            return LLM_HEDGE_DEFAULT_DELAY[kind]
+        return max(LLM_HEDGE_MIN_DELAY, p)
+
+    def record_hedge(self, model, event):
+        """event: hedged（しきい値を超えて副モデルにも送った）/ failover（主モデルが失敗した）/ secondary_won"""
+        with self._lock:
+            st = self._hedges.setdefault(model, {"hedged": 0, "failover": 0, "secondary_won": 0})
+            st[event] += 1
+
+    def stats(self):
+        def ms(sec):
+            return round(sec * 1000) if sec is not None else None
+
+        with self._lock:
+            models = {}
+            for (model, kind), hist in self._hists.items():
+                models.setdefault(model, {})[kind] = {
+                    "samples": round(hist.total),
+                    "p50_ms": ms(hist.quantile(0.5)),
+                    "p95_ms": ms(hist.quantile(0.95)),
+                    "p99_ms": ms(hist.quantile(0.99)),
+                }
+            hedges = {model: dict(st) for model, st in self._hedges.items()}
+        return {"models": models, "hedge": hedges}
+
+
+llm_latency = LatencyTracker()
+
+
+# モデルごとの利用統計（プロンプトキャッシュの効き具合と応答時間を測るため）
+_llm_stats = {}
+_llm_stats_lock = threading.Lock()
+
+
+def record_llm_usage(model, usage, elapsed_sec, first_token_sec=None):
+    """1回の LLM 呼び出しのトークン数・キャッシュ済みトークン数・所要時間（ストリーミング時は最初の文字までの時間も）を集計に加える"""
+    usage = usage or {}
+    cached = usage.get("cached_tokens") or 0
+    with _llm_stats_lock:
+        st = _llm_stats.setdefault(model, {
+            "calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0,
+            "cache_hit_calls": 0, "latency_sec_cache_hit": 0.0, "latency_sec_cache_miss": 0.0,
+            "stream_calls": 0, "first_token_sec": 0.0,
+            "response_cache_hits": 0, "saved_tokens": 0, "latency_sec_response_cache": 0.0,
+        })
+        st["calls"] += 1
+        if usage.get("response_cache") == "hit":
+            st["response_cache_hits"] += 1
+            st["saved_tokens"] += usage.get("saved_tokens") or 0
+            st["latency_sec_response_cache"] += elapsed_sec
+            return
+        llm_latency.observe(model, "reply", elapsed_sec)
+        if first_token_sec:
+            llm_latency.observe(model, "first_token", first_token_sec)
+        st["input_tokens"] += usage.get("input_tokens") or 0
+        st["cached_tokens"] += cached
+        st["output_tokens"] += usage.get("output_tokens") or 0
+        if cached:
+            st["cache_hit_calls"] += 1
+            st["latency_sec_cache_hit"] += elapsed_sec
+        else:
+            st["latency_sec_cache_miss"] += elapsed_sec
+        if first_token_sec is not None:
+            st["stream_calls"] += 1
+            st["first_token_sec"] += first_token_sec
+
+
+def llm_stats_summary():
+    """record_llm_usage の集計をモデルごとに返す（キャッシュ率・キャッシュ有無別の平均応答時間・応答キャッシュのヒット数つき）"""
+    with _llm_stats_lock:
+        stats = {model: dict(st) for model, st in _llm_stats.items()}
+    out = {}
+    for model, st in stats.items():
+        misses = st["calls"] - st["cache_hit_calls"] - st["response_cache_hits"]
+        out[model] = {
+            "calls": st["calls"],
+            "input_tokens": st["input_tokens"],
+            "cached_tokens": st["cached_tokens"],
+            "output_tokens": st["output_tokens"],
+            "cached_token_ratio": round(st["cached_tokens"] / st["input_tokens"], 3) if st["input_tokens"] else 0.0,
+            "cache_hit_calls": st["cache_hit_calls"],
+            "avg_latency_ms_cache_hit": round(st["latency_sec_cache_hit"] * 1000 / st["cache_hit_calls"]) if st["cache_hit_calls"] else None,
+            "avg_latency_ms_cache_miss": round(st["latency_sec_cache_miss"] * 1000 / misses) if misses else None,
+            "stream_calls": st["stream_calls"],
+            "avg_first_token_ms": round(st["first_token_sec"] * 1000 / st["stream_calls"]) if st["stream_calls"] else None,
+            "response_cache_hits": st["response_cache_hits"],
+            "saved_tokens": st["saved_tokens"],
+            "avg_latency_ms_response_cache": round(st["latency_sec_response_cache"] * 1000 / st["response_cache_hits"], 1) if st["response_cache_hits"] else None,
+        }
+    return out
+
+
+def _api_key_for(model):
+    return get_gemini_api_key() if is_gemini_model(model) else get_api_key()
+
+
+def _hedge_model_for(data, primary):
+    """ヘッジ先のモデル名を返す（ヘッジしない・副モデルの API キーが無いときは None）"""
+    if not data.get("hedge", LLM_HEDGE):
+        return None
+    secondary = (data.get("hedge_model") or LLM_HEDGE_MODEL).strip()
+    if not secondary:
+        secondary = get_chat_model() if is_gemini_model(primary) else "gemini-2.0-flash"
+    if secondary == primary:
+        return None
+    try:
+        _api_key_for(secondary)
+    except ValueError:
+        return None
+    return secondary
+
+
+async def _acall_model(messages, model, use_cache):
+    if is_gemini_model(model):
+        return await acall_gemini_api(messages, _api_key_for(model), model, use_cache=use_cache)
+    return await acall_chatgpt_api(messages, _api_key_for(model), model=model, use_cache=use_cache)
+
+
+def _astream_model(messages, model, use_cache):
+    if is_gemini_model(model):
+        return astream_gemini_api(messages, _api_key_for(model), model, use_cache=use_cache)
+    return astream_chatgpt_api(messages, _api_key_for(model), model=model, use_cache=use_cache)
+
+
+async def _cancel_all(tasks):
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def acall_hedged(messages, primary, secondary, use_cache=True):
+    """
+    primary に送り、応答時間の p95 を過ぎても返らなければ（または失敗したら）secondary にも同じ内容を送る。
+    先に成功した方を (応答, 利用量, モデル, そのモデルに送り始めた時刻) で返し、もう一方はキャンセルする
+    """
+    tasks = {}
+
+    def launch(model):
+        tasks[asyncio.ensure_future(_acall_model(messages, model, use_cache))] = (model, time.perf_counter())
+
+    launch(primary)
+    delay = llm_latency.hedge_delay(primary, "reply")
+    hedged = False
+    errors = []
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(tasks, timeout=None if hedged else delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                llm_latency.record_hedge(primary, "hedged")
+                hedged = True
+                launch(secondary)
+                continue
+            for task in done:
+                model, started = tasks.pop(task)
+                if task.exception() is None:
+                    if model != primary:
+                        llm_latency.record_hedge(primary, "secondary_won")
+                    reply, usage = task.result()
+                    return reply, usage, model, started
+                errors.append(task.exception())
+                if not hedged:
+                    llm_latency.record_hedge(primary, "failover")
+                    hedged = True
+                    launch(secondary)
+        raise errors[0]
+    finally:
+        await _cancel_all(list(tasks))
+
+
+async def astream_hedged(messages, primary, secondary, use_cache=True):
+    """
+    astream_*_api のヘッジ版。最初の文字が p95 を過ぎても届かなければ（または失敗したら）secondary でもストリームを開き、
+    先に書き始めた方だけを流す。最初に ("model", (モデル, そのモデルに送り始めた時刻)) を返す
+    """
+    streams = {}
+    tasks = {}
+
+    def launch(model):
+        streams[model] = (_astream_model(messages, model, use_cache), time.perf_counter())
+        tasks[asyncio.ensure_future(streams[model][0].__anext__())] = model
+
+    launch(primary)
+    delay = llm_latency.hedge_delay(primary, "first_token")
+    hedged = False
+    errors = []
+    winner = first = None
+    try:
+        while tasks and winner is None:
+            done, _ = await asyncio.wait(tasks, timeout=None if hedged else delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                llm_latency.record_hedge(primary, "hedged")
+                hedged = True
+                launch(secondary)
+                continue
+            for task in done:
+                model = tasks.pop(task)
+                if task.exception() is None or isinstance(task.exception(), StopAsyncIteration):
+                    winner = model
+                    first = task.result() if task.exception() is None else None
+                    break
+                errors.append(task.exception())
+                if not hedged:
+                    llm_latency.record_hedge(primary, "failover")
+                    hedged = True
+                    launch(secondary)
+    finally:
+        await _cancel_all(list(tasks))
+        for model, (stream, _) in streams.items():
+            if model != winner:
+                await stream.aclose()
+    if winner is None:
+        raise errors[0]
+    if winner != primary:
+        llm_latency.record_hedge(primary, "secondary_won")
+    stream, started = streams[winner]
+    try:
+        yield "model", (winner, started)
+        if first is not None:
+            yield first
+            async for item in stream:
+                yield item
+    finally:
+        await stream.aclose()
+
+
+# 同期の Flask から async の処理（ヘッジ）を使うためのイベントループ。専用スレッドで1つだけ動かす
+_background_loop = None
+_background_loop_pid = None
+_background_loop_lock = threading.Lock()
+
+
+def _get_background_loop():
+    global _background_loop, _background_loop_pid
+    with _background_loop_lock:
+        if _background_loop is None or _background_loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-async-loop", daemon=True).start()
+            _background_loop, _background_loop_pid = loop, os.getpid()
+            atexit.register(_stop_background_loop, loop)
+        return _background_loop
+
+
+def _stop_background_loop(loop):
+    """プロセスの終了時に、バックグラウンドのループで張った LLM の接続を閉じてループを止める"""
+    if loop is not _background_loop or _background_loop_pid != os.getpid():
+        return  # fork 前の親のループ（このプロセスでは動いていない）
+    with contextlib.suppress(Exception):
+        asyncio.run_coroutine_threadsafe(allm_http.aclose(), loop).result(timeout=5)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def _run_async(coro):
+    """コルーチンをバックグラウンドのイベントループで実行し、結果を待って返す"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_background_loop()).result()
+
+
+def _iter_async(agen):
+    """async ジェネレーターを普通のジェネレーターとして読む（途中で閉じられたら async 側も閉じる）"""
+    loop = _get_background_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+# チャットの固定の指示（毎ターン同じバイト列になるよう定数にしておく）
+CHAT_SYSTEM_HEADER = (
+    "【重要】以下と、会話の末尾のシステムメッセージ（参考情報）にコンテキスト情報を記載します。\n"
+    "・質問がコンテキストに記載されている内容（会社概要・議事録・会話メモ・Xのやり取り等）に関係する場合は、必ずコンテキストを読み込み、その内容を参照して回答すること。\n"
+    "・コンテキストにない話題や一般論の質問の場合はその限りではない。\n"
+    "・「用途・指示」がある場合は、その役割・トーンに従って応答すること。\n\n"
+    "--- コンテキスト ---\n\n"
+)
+
+
+# 組み立て済みシステムプロンプトの LRU キャッシュ（環境変数 PROMPT_CACHE_SIZE で件数を変更可能）
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", "256"))
+_prompt_cache = collections.OrderedDict()
+_prompt_cache_lock = threading.Lock()
+
+
+def _short_hash(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()[:16]
+
+
+def _prompt_cache_get_or_build(key, build):
+    """key に対応する組み立て済み文字列を返す。無ければ build() で作って入れる（古いものから追い出す）"""
+    with _prompt_cache_lock:
+        value = _prompt_cache.get(key)
+        if value is not None:
+            _prompt_cache.move_to_end(key)
+            return value
+    value = build()
+    with _prompt_cache_lock:
+        _prompt_cache[key] = value
+        _prompt_cache.move_to_end(key)
+        while len(_prompt_cache) > PROMPT_CACHE_SIZE:
+            _prompt_cache.popitem(last=False)
+    return value
+
+
+def _build_static_system(preset_prompt):
+    static_parts = ["【常に参照する情報】\n" + FIXED_CONTEXT]
+    if preset_prompt:
+        static_parts.append("【用途・指示】\n" + preset_prompt)
+    return CHAT_SYSTEM_HEADER + "\n\n".join(static_parts)
+
+
+def _build_volatile_system(context_chunks, extra_context, upload_chunks=()):
+    volatile_parts = []
+    if extra_context:
+        volatile_parts.append("【この会話で追加された参考情報】\n" + extra_context)
+    if upload_chunks:
+        volatile_parts.append("【この会話で追加された参考情報（添付から抜粋）】\n" + format_context_chunks(upload_chunks))
+    if context_chunks:
+        ordered = sorted(context_chunks, key=lambda c: c.digest)
+        volatile_parts.append("【参考情報（フォルダから読み込み）】\n" + format_context_chunks(ordered))
+    return "--- 参考情報 ---\n\n" + "\n\n".join(volatile_parts)
+
+
+def build_system_prompts(preset_id, prompt_override, context_chunks, extra_context, upload_chunks=()):
+    """
+    (固定部分, 参考情報部分 or None) のシステムプロンプトを返す。どちらも LRU でメモ化する。
+    固定部分のキー: プリセット ID とプリセットの版（UI で編集したプロンプトならその内容ハッシュ）。
+    参考情報部分のキー: 選ばれたチャンク（フォルダ・添付）の内容ハッシュと extra_context のハッシュ
+    （context フォルダが変わればチャンクのハッシュも変わるので、古い組み立て結果は使われない）。
+    """
+    if prompt_override:
+        static_key = ("static", "override", _short_hash(prompt_override))
+    else:
+        static_key = ("static", "preset", preset_id, _preset_registry.version)
+    static_system = _prompt_cache_get_or_build(
+        static_key, lambda: _build_static_system(prompt_override or get_preset_prompt(preset_id))
+    )
+    if not context_chunks and not extra_context and not upload_chunks:
+        return static_system, None
+    digests = tuple(sorted(c.digest for c in context_chunks))
+    volatile_key = ("volatile", digests, _short_hash(extra_context), tuple(c.digest for c in upload_chunks))
+    volatile_system = _prompt_cache_get_or_build(
+        volatile_key, lambda: _build_volatile_system(context_chunks, extra_context, upload_chunks)
+    )
+    return static_system, volatile_system
+
+
+def build_chat_messages(static_system, volatile_system, history, user_message, summary=""):
+    """
+    プロバイダのプロンプトキャッシュ（OpenAI の自動キャッシュ・Gemini の暗黙キャッシュ）が効くよう、
+    先頭ほど変わりにくい順に並べる: 固定の指示・情報・用途 → 古い会話の要約 → 会話履歴 → 毎ターン変わる参考情報 → 今回の質問。
+    フォルダのチャンクは関連度順ではなく内容ハッシュ順に並べ、同じ組み合わせなら同じバイト列にする。
+    """
+    messages = [{"role": "system", "content": static_system}]
+    if summary:
+        messages.append({"role": "system", "content": "【これまでの会話の要約】\n" + summary})
+    for h in history:
+        messages.append({"role": "user", "content": h.get("user", "")})
+        messages.append({"role": "assistant", "content": h.get("assistant", "")})
+    if volatile_system:
+        messages.append({"role": "system", "content": volatile_system})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+# サーバー側の会話セッション（クライアントは session_id と新しいメッセージだけを送る）
+SESSION_DB_PATH = os.environ.get("SESSION_DB") or os.path.join(tempfile.gettempdir(), "sales-proposal-app", "sessions.sqlite3")
+SESSION_TTL = float(os.environ.get("SESSION_TTL", str(7 * 24 * 3600)))  # 最後の発言からこれだけ経ったセッションは消す（秒）
+SESSION_HISTORY_TOKENS = int(os.environ.get("SESSION_HISTORY_TOKENS", "4000"))  # 要約＋履歴をこのトークン数以内に保つ
+SESSION_SUMMARY_TOKENS = int(os.environ.get("SESSION_SUMMARY_TOKENS", "1000"))  # 要約の上限（超えたら古い行から捨てる）
+SESSION_KEEP_TURNS = 4  # 直近のターンは要約せずそのまま残す
+SESSION_SEED_TURNS = 20  # セッションを作り直すときに引き継ぐクライアントの履歴の上限
+
+_SESSION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_sessions (
+    id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL DEFAULT '',
+    summary_tokens INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chat_sessions_updated ON chat_sessions (updated);
+CREATE TABLE IF NOT EXISTS chat_turns (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    assistant TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    PRIMARY KEY (session_id, seq)
+);
+"""
+
+
+def _summarize_turn(user, assistant):
+    """1ターンを要約の1行にする（質問と回答それぞれの先頭の文だけを残す）"""
+    def head(text, limit):
+        sentences = _split_sentences(text or "")
+        first = " ".join(sentences[0].split()) if sentences else ""
+        return first[:limit] + "…" if len(first) > limit else first
+
+    return f"・Q: {head(user, 80)} → A: {head(assistant, 160)}"
+
+
+def _trim_summary(summary, max_tokens):
+    lines = summary.split("\n")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class ChatSessionStore:
+    """
+    会話履歴を SQLite に保存する。要約＋履歴が history_tokens を超えたら、直近 keep_turns ターンを残して
+    古いターンから要約に畳む。一度に予算の半分まで畳むので、要約（プロンプトの前半）が変わるのは時々だけ
+    """
+
+    def __init__(self, path, ttl, history_tokens, summary_tokens, keep_turns):
+        self.path = path
+        self.ttl = ttl
+        self.history_tokens = history_tokens
+        self.summary_tokens = summary_tokens
+        self.keep_turns = keep_turns
+        self._local = threading.local()  # sqlite3 の接続はスレッドごと
+        self._lock = threading.Lock()
+        self._stats = {"created": 0, "turns": 0, "compactions": 0, "folded_turns": 0}
+        self._last_purge = 0.0
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SESSION_SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _purge_expired(self, conn, now):
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        expired = [row[0] for row in conn.execute("SELECT id FROM chat_sessions WHERE updated < ?", (now - self.ttl,))]
+        for session_id in expired:
+            self.delete(session_id)
+
+    def open(self, session_id=None):
+        """
+        (session_id, 要約, 履歴) を返す。session_id が無ければ新しい ID を払い出す。
+        行は最初のターンを保存するときに作るので、LLM の呼び出しが失敗しても空のセッションは残らない。
+        指定された ID が見つからない・期限切れなら None（別のインスタンスで作られたセッションも見つからない）
+        """
+        conn = self._conn()
+        now = time.time()
+        if session_id:
+            row = conn.execute("SELECT summary, updated FROM chat_sessions WHERE id = ?", (session_id,)).fetchone()
+            if row and now - row[1] < self.ttl:
+                turns = conn.execute(
+                    "SELECT user, assistant FROM chat_turns WHERE session_id = ? ORDER BY seq", (session_id,)
+                ).fetchall()
+                return session_id, row[0], [{"user": u, "assistant": a} for u, a in turns]
+            return None
+        self._purge_expired(conn, now)
+        return secrets.token_urlsafe(16), "", []
+
+    def _fold(self, summary, summary_tokens, turns):
+        """
+        turns は (トークン数, ユーザー, アシスタント) のリスト（古い順）。要約＋履歴が予算を超えていれば、
+        直近 keep_turns ターンを残して古いほうから予算の半分まで要約に畳む。(要約, 畳んだターン数) を返す
+        """
+        total = summary_tokens + sum(t[0] for t in turns)
+        lines = []
+        if total > self.history_tokens:
+            for tokens, u, a in turns[:max(0, len(turns) - self.keep_turns)]:
+                if total <= self.history_tokens // 2:
+                    break
+                lines.append(_summarize_turn(u, a))
+                total -= tokens
+        if lines:
+            summary = _trim_summary("\n".join(([summary] if summary else []) + lines), self.summary_tokens)
+        return summary, len(lines)
+
+    def fold_history(self, history):
+        """まだ保存していない履歴（[{"user", "assistant"}]）を、保存したときと同じように畳んで (要約, 残りの履歴) を返す"""
+        turns = [(estimate_tokens(h["user"]) + estimate_tokens(h["assistant"]), h["user"], h["assistant"]) for h in history]
+        summary, folded = self._fold("", 0, turns)
+        return summary, history[folded:]
+
+    def append_turn(self, session_id, user, assistant, seed=None):
+        """
+        1ターン追加し、予算を超えていれば古いターンを要約に畳む。
+        seed はまだ保存していない新しいセッションのとき（[{"user", "assistant"}]、引き継ぐ履歴が無ければ []）。
+        そのときはセッションの行を作り、seed を今回のターンの前に入れる
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT summary, summary_tokens FROM chat_sessions WHERE id = ?", (session_id,)).fetchone()
+            new_turns = [(user, assistant)]
+            created = row is None
+            if created:
+                if seed is None:  # 応答を待っている間に削除された
+                    conn.execute("ROLLBACK")
+                    return
+                conn.execute("INSERT INTO chat_sessions (id, updated) VALUES (?, ?)", (session_id, time.time()))
+                row = ("", 0)
+                new_turns = [(h["user"], h["assistant"]) for h in seed] + new_turns
+            summary, summary_tokens = row
+            for u, a in new_turns:
+                conn.execute(
+                    "INSERT INTO chat_turns (session_id, seq, user, assistant, tokens) "
+                    "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM chat_turns WHERE session_id = ?), ?, ?, ?)",
+                    (session_id, session_id, u, a, estimate_tokens(u) + estimate_tokens(a)),
+                )
+            turns = conn.execute(
+                "SELECT seq, tokens, user, assistant FROM chat_turns WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+            summary, folded = self._fold(summary, summary_tokens, [t[1:] for t in turns])
+            if folded:
+                summary_tokens = estimate_tokens(summary)
+                conn.execute("DELETE FROM chat_turns WHERE session_id = ? AND seq <= ?", (session_id, turns[folded - 1][0]))
+            conn.execute(
+                "UPDATE chat_sessions SET summary = ?, summary_tokens = ?, updated = ? WHERE id = ?",
+                (summary, summary_tokens, time.time(), session_id),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if created:
+            self._count("created")
+        self._count("turns", len(new_turns))
+        if folded:
+            self._count("compactions")
+            self._count("folded_turns", folded)
+
+    def get(self, session_id):
+        """画面の復元用に {"summary", "history"} を返す（無ければ None）"""
+        conn = self._conn()
+        row = conn.execute("SELECT summary, updated FROM chat_sessions WHERE id = ?", (session_id,)).fetchone()
+        if not row or time.time() - row[1] >= self.ttl:
+            return None
+        turns = conn.execute("SELECT user, assistant FROM chat_turns WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        return {"summary": row[0], "history": [{"user": u, "assistant": a} for u, a in turns]}
+
+    def delete(self, session_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM chat_turns WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def stats(self):
+        conn = self._conn()
+        with self._lock:
+            out = dict(self._stats)
+        out["sessions"] = conn.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0]
+        out["stored_turns"] = conn.execute("SELECT COUNT(*) FROM chat_turns").fetchone()[0]
+        return out
+
+
+chat_sessions = ChatSessionStore(SESSION_DB_PATH, SESSION_TTL, SESSION_HISTORY_TOKENS, SESSION_SUMMARY_TOKENS, SESSION_KEEP_TURNS)
+
+
+def _session_saver(session_id, user_message, seed=None):
+    """
+    応答が返ったらセッションに1ターン追加する関数（セッションを使わないときは None）。
+    seed はまだ保存していない新しいセッションに引き継ぐ履歴（ChatSessionStore.append_turn を参照）
+    """
+    if not session_id:
+        return None
+    return lambda reply: chat_sessions.append_turn(session_id, user_message, reply, seed)
 
 
 @app.route("/")
@@ -757,25 +2373,46 @@ def index():
 
 @app.route("/api/context", methods=["GET"])
 def api_context():
-    """現在読み込まれているコンテキスト（ファイル一覧と先頭のプレビュー）を返す"""
-    text = get_context_text()
-    files = []
-    if os.path.isdir(CONTEXT_DIR):
-        try:
-            for name in sorted(os.listdir(CONTEXT_DIR)):
-                if any(name.lower().endswith(ext) for ext in CONTEXT_EXTENSIONS):
-                    path = os.path.join(CONTEXT_DIR, name)
-                    if os.path.isfile(path):
-                        files.append({"name": name, "mtime": os.path.getmtime(path)})
-            files.sort(key=lambda x: -x["mtime"])
-        except Exception:
-            pass
-    preview = text[:500] + "…" if len(text) > 500 else text
+    """
+    現在読み込まれているコンテキスト（ファイル一覧と先頭のプレビュー）を返す。
+    スナップショットの一覧だけで応答し、ETag が一致すれば 304 を返す。?preview=0 ならプレビューを省く。
+    """
+    snapshot = get_context_snapshot()
+    with_preview = request.args.get("preview", "1") != "0"
+    model = get_chat_model()
+    etag = hashlib.sha256(repr((snapshot.digest, snapshot.files, model, with_preview)).encode("utf-8")).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        body = {
+            "files": [name for name, _, _ in snapshot.files],
+            "entries": [{"name": name, "size": size, "mtime": mtime} for name, size, mtime in snapshot.files],
+            "version": snapshot.digest,
+            "length": len(snapshot.text),
+            "model": model,
+        }
+        if with_preview:
+            text = snapshot.text
+            body["preview"] = text[:500] + "…" if len(text) > 500 else text
+        resp = jsonify(body)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+@app.route("/api/stats", methods=["GET"])
+def api_stats():
+    """LLM 呼び出しの集計（プロンプトキャッシュ率・平均応答時間・接続の再利用状況など）を返す"""
     return jsonify({
-        "files": [f["name"] for f in files],
-        "preview": preview,
-        "length": len(text),
-        "model": get_chat_model(),
+        "llm": llm_stats_summary(),
+        "llm_cache": llm_cache.stats(),
+        "scheduler": llm_scheduler.stats(),
+        "http": llm_http.stats(),
+        "http_async": allm_http.stats(),
+        "http_cache": http_cache.stats(),
+        "latency": llm_latency.stats(),
+        "sessions": chat_sessions.stats(),
+        "scrape_jobs": scrape_jobs.stats(),
     })
 
 
@@ -783,20 +2420,20 @@ def api_context():
 def api_presets():
     """用途別プロンプト（Gem 風）の一覧を返す"""
     presets = [{"id": p.get("id", ""), "name": p.get("name", "")} for p in load_presets()]
-    return jsonify({"presets": presets})
+    return jsonify({"presets": presets, "version": _preset_registry.store_version})
 
 
 @app.route("/api/preset/<preset_id>", methods=["GET"])
 def api_preset_detail(preset_id):
     """指定した用途のプロンプト全文を返す（選択時に読み込んで表示用）"""
     preset_id = (preset_id or "").strip()
-    for p in load_presets():
-        if (p.get("id") or "").strip() == preset_id:
-            return jsonify({
-                "id": p.get("id", ""),
-                "name": p.get("name", ""),
-                "prompt": (p.get("prompt") or "").strip(),
-            })
+    p = _preset_registry.get(preset_id)
+    if p:
+        return jsonify({
+            "id": p.get("id", ""),
+            "name": p.get("name", ""),
+            "prompt": (p.get("prompt") or "").strip(),
+        })
     return jsonify({"id": preset_id, "name": "", "prompt": ""})
 
 
@@ -813,52 +2450,151 @@ def api_preset_update(preset_id):
     return jsonify({"ok": True, "id": preset_id})
 
 
-# スクレイピング結果を AI に CSV で抽出させる最大 HTML 文字数（複数ページ結合時は多め）
-SCRAPE_HTML_MAX_CHARS = 280000
+@app.route("/api/upload", methods=["POST"])
+def api_upload():
+    """
+    追加コンテキストのテキストを保存して handle を返す（JSON の {"text", "name"} か、text/plain の本文）。
+    /api/chat の context_handles に渡すと、毎回本文を送らずに済み、質問に関係する部分だけがプロンプトに入る
+    """
+    if (request.content_length or 0) > UPLOAD_MAX_BYTES * 2:  # JSON の \uXXXX エスケープで日本語は最大2倍になる
+        return jsonify({"error": "添付が大きすぎます"}), 413
+    if request.is_json:
+        data = request.get_json() or {}
+        text, name = data.get("text") or "", data.get("name") or ""
+    else:
+        text, name = request.get_data(as_text=True), request.args.get("name", "")
+    if not text.strip():
+        return jsonify({"error": "text が必要です"}), 400
+    if len(text.encode("utf-8")) > UPLOAD_MAX_BYTES:
+        return jsonify({"error": "添付が大きすぎます"}), 413
+    return jsonify(_upload_info(upload_store.get(upload_store.put(text, name.strip()))))
+
+
+@app.route("/api/upload/<handle>", methods=["GET"])
+def api_upload_info(handle):
+    """保存済みかどうか（とチャンク数・トークン数）を返す。無ければ 404"""
+    blob = upload_store.get(handle)
+    if blob is None:
+        return jsonify({"error": "添付が見つかりません"}), 404
+    return jsonify(_upload_info(blob))
+
+
+def _upload_info(blob):
+    return {
+        "handle": blob.handle,
+        "name": blob.name,
+        "bytes": blob.size,
+        "chunks": len(blob.chunks),
+        "tokens": sum(chunk.tokens for chunk in blob.chunks),
+    }
+
+
+@app.route("/api/session/<session_id>", methods=["GET"])
+def api_session_detail(session_id):
+    """サーバー側に保存した会話（要約と履歴）を返す（画面の復元用）"""
+    session = chat_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "セッションが見つかりません（期限切れの可能性があります）"}), 404
+    return jsonify({"session_id": session_id, **session})
 
 
-@app.route("/api/scrape", methods=["POST"])
-def api_scrape():
-    """URL を取得し、指示に従って AI でデータを抽出し CSV で返す。下層・次ページ対応あり"""
-    data = request.get_json() or {}
+@app.route("/api/session/<session_id>", methods=["DELETE"])
+def api_session_delete(session_id):
+    """会話セッションを削除する（新しいチャットを始めたとき）"""
+    chat_sessions.delete(session_id)
+    return jsonify({"ok": True})
+
+
+# スクレイピング結果を AI に CSV で抽出させる HTML の最大トークン数（複数ページ結合時は多め）
+SCRAPE_HTML_MAX_TOKENS = int(os.environ.get("SCRAPE_HTML_MAX_TOKENS", "100000"))
+
+
+def _combine_pages_within_budget(chunks, budget):
+    """ラベル付きHTMLをページ単位でトークン上限まで結合する。入りきらないページは丸ごと省く"""
+    parts = []
+    used = 0
+    skipped = 0
+    for label, html in chunks:
+        page = label + html + "\n\n"
+        tokens = estimate_tokens(page)
+        if used + tokens > budget:
+            if not parts:
+                # 1ページ目だけで上限を超える場合は、タグの切れ目で詰められるだけ入れる
+                cut = page[: len(page) * budget // max(tokens, 1)]
+                parts.append(cut[: cut.rfind(">") + 1] or cut)
+                used = budget
+            else:
+                skipped += 1
+            continue
+        parts.append(page)
+        used += tokens
+    if skipped:
+        parts.append(f"... (トークン上限のため {skipped} ページ省略)")
+    return "".join(parts)
+
+
+def _scrape_params(data):
+    """
+    /api/scrape・/api/scrape/jobs の入力チェック（API キーの確認を含む）。
+    (params, None) か、エラーなら (None, (JSON, ステータス)) を返す
+    """
     url = (data.get("url") or "").strip()
     instruction = (data.get("instruction") or "").strip()
-    follow_details = data.get("follow_details", True)
-    follow_pages = data.get("follow_pages", True)
     is_tabelog_url = "tabelog.com" in (url or "").lower()
     default_details = 50 if is_tabelog_url else 15
-    max_detail_pages = min(max(1, int(data.get("max_detail_pages", default_details))), 1000)
-    max_pages = min(max(1, int(data.get("max_pages", 3))), 10)
     if not url:
-        return jsonify({"error": "url を入力してください"}), 400
+        return None, ({"error": "url を入力してください"}, 400)
     if not instruction:
-        return jsonify({"error": "指示を入力してください（例: 店名・電話番号・住所を取得）"}), 400
+        return None, ({"error": "指示を入力してください（例: 店名・電話番号・住所を取得）"}, 400)
     try:
         api_key = get_api_key()
     except ValueError as e:
-        return jsonify({"error": str(e)}), 500
+        return None, ({"error": str(e)}, 500)
+    return {
+        "url": url,
+        "instruction": instruction,
+        "follow_details": data.get("follow_details", True),
+        "follow_pages": data.get("follow_pages", True),
+        "max_detail_pages": min(max(1, int(data.get("max_detail_pages", default_details))), 1000),
+        "max_pages": min(max(1, int(data.get("max_pages", 3))), 10),
+        "use_cache": not data.get("no_cache"),
+        "api_key": api_key,
+    }, None
+
+
+def _prepare_scrape(data):
+    """
+    /api/scrape の前半（入力チェック・ページ取得・食べログのプログラム抽出）。
+    そのまま返せる結果があれば ((JSON, ステータス), None)、AI 抽出が必要なら (None, (messages, api_key)) を返す
+    """
+    params, error = _scrape_params(data)
+    if error:
+        return error, None
     chunks, err = _fetch_pages_for_scrape(
-        url,
-        follow_details=follow_details,
-        max_detail_pages=max_detail_pages,
-        follow_pages=follow_pages,
-        max_pages=max_pages,
+        params["url"],
+        follow_details=params["follow_details"],
+        max_detail_pages=params["max_detail_pages"],
+        follow_pages=params["follow_pages"],
+        max_pages=params["max_pages"],
     )
     if err and not chunks:
-        return jsonify({"error": err}), 500
-    is_tabelog = "tabelog.com" in url.lower()
+        return ({"error": err}, 500), None
     # 食べログはプログラムでパースしてCSVを組み立て（全件確実に出力）
-    if is_tabelog:
-        programmatic_csv = _build_tabelog_csv_from_chunks(chunks)
-        num_detail = sum(1 for label, _ in chunks if "詳細" in label)
+    site = scrape_pipeline.site(params["url"])
+    if site:
+        programmatic_csv = _build_site_csv_from_chunks(site, chunks)
         # 1行以上取れていればプログラム結果を返す（AIは行数が安定しないため）
-        if programmatic_csv and programmatic_csv.count("\n") >= 1:
-            return jsonify({"csv": programmatic_csv})
-    combined = ""
-    for label, html in chunks:
-        combined += label + html + "\n\n"
-    if len(combined) > SCRAPE_HTML_MAX_CHARS:
-        combined = combined[:SCRAPE_HTML_MAX_CHARS] + "\n\n... (省略)"
+        if programmatic_csv:
+            return ({"csv": programmatic_csv}, 200), None
+    return _scrape_llm_request(params, chunks)
+
+
+def _scrape_llm_request(params, chunks):
+    """AI 抽出のリクエスト (None, (messages, api_key)) を組み立てる"""
+    instruction = params["instruction"]
+    api_key = params["api_key"]
+    is_tabelog = "tabelog.com" in params["url"].lower()
+    combined = _combine_pages_within_budget(chunks, SCRAPE_HTML_MAX_TOKENS)
     if is_tabelog:
         num_detail = sum(1 for label, _ in chunks if "詳細" in label)
         system_content = (
@@ -885,35 +2621,124 @@ def api_scrape():
         {"role": "system", "content": system_content},
         {"role": "user", "content": user_content},
     ]
+    return None, (messages, api_key)
+
+
+# /api/scrape（stream あり・なし）・ジョブ・ASGI で共通の流れ（common.py）に、このアプリのパーサーと取得・抽出を渡す
+scrape_pipeline = ScrapePipeline(
+    SCRAPE_SITES, _csv_line, _fetch_pages_for_scrape, _scrape_params, _prepare_scrape, _scrape_llm_request,
+    call_chatgpt_api, acall_chatgpt_api,
+)
+
+
+@app.route("/api/scrape", methods=["POST"])
+def api_scrape():
+    """
+    URL を取得し、指示に従って AI でデータを抽出し CSV で返す。下層・次ページ対応あり。
+    stream: "csv" / "ndjson" なら JSON ではなくその形式で返す（食べログは詳細ページを取得するたびに1行ずつ）
+    """
+    data = request.get_json() or {}
+    chunks, result = scrape_pipeline.respond(data)
+    if chunks:
+        return Response(chunks, content_type=SCRAPE_STREAM_TYPES[data["stream"]], headers=SCRAPE_STREAM_HEADERS)
+    return jsonify(result[0]), result[1]
+
+
+scrape_jobs = ScrapeJobManager(scrape_pipeline, SCRAPE_JOB_WORKERS, SCRAPE_JOB_MAX_PENDING, SCRAPE_JOB_TTL)
+
+
+@app.route("/api/scrape/jobs", methods=["POST"])
+def api_scrape_job_create():
+    """/api/scrape と同じ入力でジョブを始め、すぐに job_id を返す（進み具合は GET /api/scrape/jobs/<job_id>）"""
+    if not SCRAPE_JOBS_ENABLED:
+        return jsonify({"error": "この環境ではジョブを使えません。/api/scrape を使ってください"}), 501
+    params, error = _scrape_params(request.get_json() or {})
+    if error:
+        return jsonify(error[0]), error[1]
+    job = scrape_jobs.submit(params)
+    if job is None:
+        return jsonify({"error": "実行中のスクレイピングが多すぎます。しばらくしてから再実行してください"}), 429
+    return jsonify(job.snapshot()), 202
+
+
+@app.route("/api/scrape/jobs/<job_id>", methods=["GET"])
+def api_scrape_job(job_id):
+    """ジョブの状態・取得ページ数・行数・残り時間の見込みと、ここまでの CSV を返す"""
+    job = scrape_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません（期限切れの可能性があります）"}), 404
+    return jsonify(job.snapshot())
+
+
+@app.route("/api/scrape/jobs/<job_id>", methods=["DELETE"])
+def api_scrape_job_cancel(job_id):
+    """ジョブを止める。それまでに取れた行は csv に残る"""
+    job = scrape_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません（期限切れの可能性があります）"}), 404
+    return jsonify(job.snapshot())
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def stream_chat_events(messages, api_key, model_override, use_cache=True, on_reply=None):
+    """
+    チャットの応答を SSE のイベント列として返すジェネレーター。
+    delta（届いた文字列）を順に送り、最後に done（全文と利用量）、失敗時は error を送る。
+    on_reply があれば done の前に全文を渡して呼ぶ（セッションへの保存用）
+    """
+    model = model_override or get_chat_model()
+    yield ": stream\n\n"  # ヘッダーをすぐ返してブラウザ側の待ちを終わらせる
+    started = time.perf_counter()
+    first_token_sec = None
+    parts = []
+    usage = {}
     try:
-        csv_content, _ = call_chatgpt_api(messages, api_key, model="gpt-4o-mini")
-        csv_content = (csv_content or "").strip()
-        for prefix in ("```csv", "```CSV", "```"):
-            if csv_content.startswith(prefix):
-                csv_content = csv_content[len(prefix):].lstrip("\r\n")
-                break
-        if csv_content.endswith("```"):
-            csv_content = csv_content[:-3].rstrip("\r\n")
-        if not csv_content:
-            return jsonify({"error": "抽出結果が空でした"}), 500
-        return jsonify({"csv": csv_content})
+        if is_gemini_model(model_override):
+            stream = stream_gemini_api(messages, api_key, model_override, use_cache=use_cache)
+        else:
+            stream = stream_chatgpt_api(messages, api_key, model=model_override or None, use_cache=use_cache)
+        for kind, value in stream:
+            if kind == "usage":
+                usage = value
+                continue
+            if first_token_sec is None:
+                first_token_sec = time.perf_counter() - started
+            parts.append(value)
+            yield _sse_event("delta", {"text": value})
     except urllib.error.HTTPError as e:
         err_body = e.read().decode("utf-8", errors="replace")
-        return jsonify({"error": f"APIエラー: {err_body}"}), 500
+        yield _sse_event("error", {"error": f"APIエラー: {err_body}"})
+        return
     except Exception as e:
-        return jsonify({"error": f"抽出エラー: {str(e)}"}), 500
+        yield _sse_event("error", {"error": f"APIエラー: {str(e)}"})
+        return
+    record_llm_usage(model, usage, time.perf_counter() - started, first_token_sec or 0.0)
+    reply = "".join(parts).strip()
+    if on_reply:
+        on_reply(reply)
+    yield _sse_event("done", {"reply": reply, "usage": usage})
 
 
-@app.route("/api/chat", methods=["POST"])
-def chat():
-    """ユーザーメッセージを受け取り、ChatGPTの応答を返す"""
-    data = request.get_json()
+def _prepare_chat(data):
+    """
+    /api/chat のリクエストから LLM に送る messages を組み立てる。
+    成功時は ((messages, api_key, model_override, session_id, on_reply), None)、入力エラー時は (None, (JSON, ステータス)) を返す。
+    session: true（または session_id）ならサーバー側のセッションの履歴を使う（session_id と on_reply はセッションを使わないとき None）。
+    session_id が見つからなければ 404（session_expired: true）。session_id なしで history を渡すと、それを引き継いだセッションを作る。
+    新しいセッションは on_reply で最初の応答を保存するときに作る
+    """
     if not data or "message" not in data:
-        return jsonify({"error": "message が必要です"}), 400
+        return None, ({"error": "message が必要です"}, 400)
 
     user_message = data["message"]
     history = data.get("history", [])  # 会話履歴（オプション）
     extra_context = (data.get("extra_context") or "").strip()  # 画面から渡す追加コンテキスト
+    context_handles = data.get("context_handles") or []  # /api/upload で保存した追加コンテキストの handle
+    if isinstance(context_handles, str):
+        context_handles = [context_handles]
     model_override = (data.get("model") or "").strip()  # 画面で選択したモデル（任意）
     preset_id = (data.get("preset_id") or "").strip()  # 用途別プロンプト（Gem 風）
     prompt_override = (data.get("prompt_override") or "").strip()  # UIで編集したプロンプト（あれば優先）
@@ -922,42 +2747,79 @@ def chat():
     try:
         api_key = get_gemini_api_key() if use_gemini else get_api_key()
     except ValueError as e:
-        return jsonify({"error": str(e)}), 500
+        return None, ({"error": str(e)}, 500)
+
+    blobs = [upload_store.get(handle) for handle in context_handles]
+    missing = [handle for handle, blob in zip(context_handles, blobs) if blob is None]
+    if missing:
+        return None, ({"error": "添付が見つかりません。もう一度アップロードしてください", "missing": missing}, 400)
+
+    session_id = None
+    seed = None
+    summary = ""
+    if data.get("session") or data.get("session_id"):
+        opened = chat_sessions.open((data.get("session_id") or "").strip())
+        if opened is None:
+            # 黙って空のセッションにすると会話の途中で文脈が消えるので、クライアントに history 付きで送り直してもらう
+            return None, ({"error": "会話セッションが見つかりません（期限切れか、別のサーバーで作られたものです）", "session_expired": True}, 404)
+        session_id, summary, history = opened
+        if not data.get("session_id"):
+            # 新しいセッションにはクライアントの履歴を引き継ぐ（保存は最初の応答と一緒。予算を超えた分は保存時と同じく要約に畳む）
+            seed = [
+                {"user": str(h.get("user") or ""), "assistant": str(h.get("assistant") or "")}
+                for h in (data.get("history") or [])[-SESSION_SEED_TURNS:] if isinstance(h, dict)
+            ]
+            summary, history = chat_sessions.fold_history(seed)
+
+    # 直近の質問に関係するフォルダのチャンクだけを参考情報にする
+    recent_questions = [h.get("user", "") for h in history[-2:] if isinstance(h, dict)]
+    query = "\n".join(recent_questions + [user_message])
+    context_chunks = select_context_chunks(query, model_override)
+    upload_chunks = select_upload_chunks(blobs, query) if blobs else []
+    static_system, volatile_system = build_system_prompts(preset_id, prompt_override, context_chunks, extra_context, upload_chunks)
+    messages = build_chat_messages(static_system, volatile_system, history, user_message, summary)
+    return (messages, api_key, model_override, session_id, _session_saver(session_id, user_message, seed)), None
 
-    # コンテキストをシステムメッセージとして先頭に付与
-    file_context = get_context_text()
-    context_parts = ["【常に参照する情報】\n" + FIXED_CONTEXT]
-    preset_prompt = prompt_override if prompt_override else get_preset_prompt(preset_id)
-    if preset_prompt:
-        context_parts.append("【用途・指示】\n" + preset_prompt)
-    if file_context:
-        context_parts.append("【参考情報（フォルダから読み込み）】\n" + file_context)
-    if extra_context:
-        context_parts.append("【この会話で追加された参考情報】\n" + extra_context)
-    if context_parts:
-        system_content = (
-            "【重要】以下にコンテキスト情報を記載します。\n"
-            "・質問がコンテキストに記載されている内容（会社概要・議事録・会話メモ・Xのやり取り等）に関係する場合は、必ずコンテキストを読み込み、その内容を参照して回答すること。\n"
-            "・コンテキストにない話題や一般論の質問の場合はその限りではない。\n"
-            "・「用途・指示」がある場合は、その役割・トーンに従って応答すること。\n\n"
-            "--- コンテキスト ---\n\n"
-            + "\n\n".join(context_parts)
-        )
-    else:
-        system_content = "ユーザーの質問に丁寧に答えてください。"
 
-    messages = [{"role": "system", "content": system_content}]
-    for h in history:
-        messages.append({"role": "user", "content": h.get("user", "")})
-        messages.append({"role": "assistant", "content": h.get("assistant", "")})
-    messages.append({"role": "user", "content": user_message})
+@app.route("/api/chat", methods=["POST"])
+def chat():
+    """ユーザーメッセージを受け取り、ChatGPTの応答を返す（stream: true なら SSE で少しずつ返す）"""
+    data = request.get_json()
+    prepared, error = _prepare_chat(data)
+    if error:
+        return jsonify(error[0]), error[1]
+    messages, api_key, model_override, session_id, on_reply = prepared
+    use_cache = not data.get("no_cache")  # no_cache: true なら応答キャッシュを使わない
+    model = model_override or get_chat_model()
+    hedge_model = _hedge_model_for(data, model)  # hedge: true なら遅いときに別プロバイダーのモデルと競わせる
+
+    if data.get("stream"):
+        if hedge_model:
+            events = _iter_async(astream_chat_events(messages, api_key, model_override, use_cache, hedge_model, on_reply))
+        else:
+            events = stream_chat_events(messages, api_key, model_override, use_cache, on_reply)
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        if session_id:
+            headers["X-Session-Id"] = session_id
+        return Response(stream_with_context(events), mimetype="text/event-stream", headers=headers)
 
     try:
-        if use_gemini:
-            assistant_message, usage = call_gemini_api(messages, api_key, model_override)
+        started = time.perf_counter()
+        if hedge_model:
+            assistant_message, usage, model, started = _run_async(acall_hedged(messages, model, hedge_model, use_cache))
+        elif is_gemini_model(model_override):
+            assistant_message, usage = call_gemini_api(messages, api_key, model_override, use_cache=use_cache)
         else:
-            assistant_message, usage = call_chatgpt_api(messages, api_key, model=model_override or None)
-        return jsonify({"reply": assistant_message, "usage": usage})
+            assistant_message, usage = call_chatgpt_api(messages, api_key, model=model_override or None, use_cache=use_cache)
+        record_llm_usage(model, usage, time.perf_counter() - started)
+        if on_reply:
+            on_reply(assistant_message)
+        body = {"reply": assistant_message, "usage": usage}
+        if hedge_model:
+            body["model"] = model  # ヘッジ時は実際に応答したモデル
+        if session_id:
+            body["session_id"] = session_id
+        return jsonify(body)
     except urllib.error.HTTPError as e:
         err_body = e.read().decode("utf-8", errors="replace")
         return jsonify({"error": f"APIエラー: {err_body}"}), 500
@@ -965,6 +2827,267 @@ def chat():
         return jsonify({"error": f"APIエラー: {str(e)}"}), 500
 
 
+# 一括提案（/api/bulk）: 対象企業のリスト（/api/scrape の CSV や JSON の行）1行ごとに提案文を作る
+BULK_MAX_ROWS = int(os.environ.get("BULK_MAX_ROWS", "500"))
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", "4"))  # 同時に LLM に送る行数（リクエストの concurrency で変更可）
+BULK_MAX_CONCURRENCY = 16
+BULK_DEFAULT_INSTRUCTION = "以下の企業に向けた営業提案文を作成してください。"
+
+
+def _bulk_rows(data):
+    """rows（dict のリスト）か csv（ヘッダー付き CSV の文字列）から空でない行を取り出す"""
+    rows = data.get("rows")
+    if rows is None and data.get("csv"):
+        rows = list(csv.DictReader(io.StringIO(data["csv"].strip())))
+    return [row for row in rows or [] if isinstance(row, dict) and any(str(v or "").strip() for v in row.values())]
+
+
+def _bulk_row_message(instruction, row):
+    lines = [f"{key}: {str(value).strip()}" for key, value in row.items() if key and str(value or "").strip()]
+    return instruction + "\n\n" + "\n".join(lines)
+
+
+def _prepare_bulk(data):
+    """
+    /api/bulk のリクエストから (行のリスト, 行ごとの messages, モデル, 並列数) を作る。
+    システムプロンプト（固定の指示・用途・フォルダの参考情報）は全行で同じバイト列にして、プロンプトキャッシュを効かせる。
+    入力エラー時は (None, (JSON, ステータス)) を返す
+    """
+    try:
+        rows = _bulk_rows(data)
+    except csv.Error as e:
+        return None, ({"error": f"CSV を読み込めません: {e}"}, 400)
+    if not rows:
+        return None, ({"error": "rows か csv で対象を指定してください"}, 400)
+    if len(rows) > BULK_MAX_ROWS:
+        return None, ({"error": f"一度に処理できるのは {BULK_MAX_ROWS} 件までです"}, 400)
+    model = (data.get("model") or "").strip() or get_chat_model()
+    try:
+        _api_key_for(model)
+    except ValueError as e:
+        return None, ({"error": str(e)}, 500)
+    try:
+        concurrency = int(data.get("concurrency") or BULK_CONCURRENCY)
+    except (TypeError, ValueError):
+        concurrency = BULK_CONCURRENCY
+    concurrency = max(1, min(concurrency, BULK_MAX_CONCURRENCY))
+
+    instruction = (data.get("instruction") or "").strip() or BULK_DEFAULT_INSTRUCTION
+    preset_id = (data.get("preset_id") or "").strip()
+    prompt_override = (data.get("prompt_override") or "").strip()
+    extra_context = (data.get("extra_context") or "").strip()
+    # 参考情報は指示と列名で1回だけ選ぶ（行ごとに変えるとプロンプトの前半が揃わずキャッシュが効かない）
+    context_chunks = select_context_chunks(instruction + "\n" + " ".join(rows[0].keys()), model)
+    static_system, volatile_system = build_system_prompts(preset_id, prompt_override, context_chunks, extra_context)
+    messages_list = [build_chat_messages(static_system, volatile_system, [], _bulk_row_message(instruction, row)) for row in rows]
+    return (rows, messages_list, model, concurrency), None
+
+
+def _llm_error_text(e):
+    if isinstance(e, urllib.error.HTTPError):
+        return "APIエラー: " + e.read().decode("utf-8", errors="replace")
+    return f"APIエラー: {e}"
+
+
+async def abulk_events(rows, messages_list, model, concurrency, use_cache=True):
+    """
+    行ごとに LLM を呼び（同時に concurrency 件まで）、終わった順に row イベントを SSE で返す。
+    失敗した行は error を付けて返し、残りの行は続ける。最後に done（成功・失敗の件数と 1分あたりの提案数）
+    """
+    total = len(rows)
+    yield ": stream\n\n"
+    yield _sse_event("start", {"total": total, "model": model, "concurrency": concurrency})
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index):
+        async with semaphore:
+            row_started = time.perf_counter()
+            try:
+                reply, usage = await _acall_model(messages_list[index], model, use_cache)
+            except Exception as e:
+                return index, None, {}, _llm_error_text(e), time.perf_counter() - row_started
+            elapsed = time.perf_counter() - row_started
+            record_llm_usage(model, usage, elapsed)
+            return index, reply, usage, None, elapsed
+
+    tasks = [asyncio.ensure_future(run(i)) for i in range(total)]
+    succeeded = failed = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, reply, usage, error, elapsed = await next_done
+            payload = {"index": index, "row": rows[index], "elapsed_ms": round(elapsed * 1000)}
+            if error:
+                failed += 1
+                payload["error"] = error
+            else:
+                succeeded += 1
+                payload["reply"] = reply
+                payload["usage"] = usage
+            payload["progress"] = {"done": succeeded + failed, "total": total}
+            yield _sse_event("row", payload)
+    finally:
+        await _cancel_all([task for task in tasks if not task.done()])  # 途中で切断されたら残りは送らない
+    elapsed = time.perf_counter() - started
+    yield _sse_event("done", {
+        "total": total,
+        "succeeded": succeeded,
+        "failed": failed,
+        "elapsed_sec": round(elapsed, 2),
+        "proposals_per_min": round(succeeded * 60 / elapsed, 1) if elapsed else None,
+    })
+
+
+@app.route("/api/bulk", methods=["POST"])
+def api_bulk():
+    """対象企業のリストから提案文を一括で作り、1行終わるごとに SSE で返す"""
+    data = request.get_json() or {}
+    prepared, error = _prepare_bulk(data)
+    if error:
+        return jsonify(error[0]), error[1]
+    events = _iter_async(abulk_events(*prepared, use_cache=not data.get("no_cache")))
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def astream_chat_events(messages, api_key, model_override, use_cache=True, hedge_model=None, on_reply=None):
+    """stream_chat_events の async 版（ASGI 用）。hedge_model を渡すと astream_hedged で主モデルと競わせる"""
+    model = model_override or get_chat_model()
+    yield ": stream\n\n"
+    started = time.perf_counter()
+    first_token_sec = None
+    parts = []
+    usage = {}
+    try:
+        if hedge_model:
+            stream = astream_hedged(messages, model, hedge_model, use_cache=use_cache)
+        elif is_gemini_model(model_override):
+            stream = astream_gemini_api(messages, api_key, model_override, use_cache=use_cache)
+        else:
+            stream = astream_chatgpt_api(messages, api_key, model=model_override or None, use_cache=use_cache)
+        async for kind, value in stream:
+            if kind == "model":
+                model, started = value  # 応答したモデルと、そのモデルに送り始めた時刻
+                continue
+            if kind == "usage":
+                usage = value
+                continue
+            if first_token_sec is None:
+                first_token_sec = time.perf_counter() - started
+            parts.append(value)
+            yield _sse_event("delta", {"text": value})
+    except urllib.error.HTTPError as e:
+        err_body = e.read().decode("utf-8", errors="replace")
+        yield _sse_event("error", {"error": f"APIエラー: {err_body}"})
+        return
+    except Exception as e:
+        yield _sse_event("error", {"error": f"APIエラー: {str(e)}"})
+        return
+    record_llm_usage(model, usage, time.perf_counter() - started, first_token_sec or 0.0)
+    done = {"reply": "".join(parts).strip(), "usage": usage}
+    if on_reply:
+        await asyncio.get_running_loop().run_in_executor(None, on_reply, done["reply"])
+    if hedge_model:
+        done["model"] = model
+    yield _sse_event("done", done)
+
+
+async def _asgi_chat(data, send):
+    """/api/chat の async 版（リクエスト形式・応答形式は Flask 版と同じ）"""
+    # チャンク検索などの CPU 処理はスレッドで行い、イベントループを止めない
+    prepared, error = await asyncio.get_running_loop().run_in_executor(None, _prepare_chat, data)
+    if error:
+        return await _asgi_send_json(send, *error)
+    messages, api_key, model_override, session_id, on_reply = prepared
+    use_cache = not data.get("no_cache")  # no_cache: true なら応答キャッシュを使わない
+    model = model_override or get_chat_model()
+    hedge_model = _hedge_model_for(data, model)
+
+    if data.get("stream"):
+        headers = [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ]
+        if session_id:
+            headers.append((b"x-session-id", session_id.encode("ascii")))
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        async for event in astream_chat_events(messages, api_key, model_override, use_cache, hedge_model, on_reply):
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    try:
+        started = time.perf_counter()
+        if hedge_model:
+            assistant_message, usage, model, started = await acall_hedged(messages, model, hedge_model, use_cache)
+        elif is_gemini_model(model_override):
+            assistant_message, usage = await acall_gemini_api(messages, api_key, model_override, use_cache=use_cache)
+        else:
+            assistant_message, usage = await acall_chatgpt_api(messages, api_key, model=model_override or None, use_cache=use_cache)
+        record_llm_usage(model, usage, time.perf_counter() - started)
+        if on_reply:
+            await asyncio.get_running_loop().run_in_executor(None, on_reply, assistant_message)
+        body = {"reply": assistant_message, "usage": usage}
+        if hedge_model:
+            body["model"] = model
+        if session_id:
+            body["session_id"] = session_id
+        await _asgi_send_json(send, body)
+    except urllib.error.HTTPError as e:
+        err_body = e.read().decode("utf-8", errors="replace")
+        await _asgi_send_json(send, {"error": f"APIエラー: {err_body}"}, 500)
+    except Exception as e:
+        await _asgi_send_json(send, {"error": f"APIエラー: {str(e)}"}, 500)
+
+
+async def _asgi_bulk(data, send):
+    """/api/bulk の async 版"""
+    data = data or {}
+    prepared, error = await asyncio.get_running_loop().run_in_executor(None, _prepare_bulk, data)
+    if error:
+        return await _asgi_send_json(send, *error)
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+    async for event in abulk_events(*prepared, use_cache=not data.get("no_cache")):
+        await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+_ASGI_ROUTES = {
+    ("POST", "/api/chat"): _asgi_chat,
+    ("POST", "/api/scrape"): scrape_pipeline.asgi,
+    ("POST", "/api/bulk"): _asgi_bulk,
+}
+# ASGI アプリ本体（例: uvicorn app:asgi_app --workers 2）。上のルート以外は Flask アプリに渡す
+asgi_app = make_asgi_app(app, _ASGI_ROUTES, LLM_API_HOSTS)
+
+
+# gunicorn / Vercel から import されたときの起動時ウォームアップ
+# （python app.py 起動時は下の __main__ で実行。spawn の子プロセス（__mp_main__ 等）では実行しない）
+if CONTEXT_WARMUP and __name__ not in ("__main__", "__mp_main__") and multiprocessing.parent_process() is None:
+    start_context_warmup()
+if LLM_HTTP_PREWARM and __name__ not in ("__main__", "__mp_main__") and multiprocessing.parent_process() is None:
+    start_llm_http_prewarm(LLM_API_HOSTS)
+
+
 if __name__ == "__main__":
+    # debug=True ではリローダーが同じファイルを子プロセスでもう一度実行する。
+    # 親プロセスはファイルの変更を見張るだけなので、ウォームアップはリクエストを受ける子（WERKZEUG_RUN_MAIN=true）でだけ行う
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        if CONTEXT_WARMUP:
+            warm_context_cache(CONTEXT_WARMUP_WORKERS)
+        if LLM_HTTP_PREWARM:
+            start_llm_http_prewarm(LLM_API_HOSTS)
     # host="0.0.0.0" で同一ネットワーク内の他デバイスからアクセス可能
     app.run(host="0.0.0.0", debug=True, port=5000)
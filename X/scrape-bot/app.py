@@ -6,20 +6,28 @@ URL（一覧ページ）を指定し、指示に従ってデータを抽出し
 import os
 import sys
 import json
-import time
 import re
+import io
 import urllib.request
 import urllib.error
 import urllib.parse
 
 if sys.platform == "win32":
-    import io
     for name in ("stdout", "stderr"):
         stream = getattr(sys, name)
         if hasattr(stream, "buffer"):
             setattr(sys, name, io.TextIOWrapper(stream.buffer, encoding="utf-8", errors="replace", line_buffering=True))
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+
+# HTTP 取得・LLM API の接続とキャッシュ・レート制限・スクレイピングの流れ・ASGI の入口は X と共通（common.py）
+from common import (
+    LLM_EXPECTED_OUTPUT_TOKENS, LLM_HTTP_PREWARM, LLM_TEMPERATURE, SCRAPE_JOBS_ENABLED, SCRAPE_JOB_MAX_PENDING,
+    SCRAPE_JOB_TTL, SCRAPE_JOB_WORKERS, SCRAPE_STREAM_HEADERS, SCRAPE_STREAM_TYPES, ScrapeJobManager,
+    ScrapePipeline, ScrapeSite, _acached_reply, _acall_with_retries, _accept_encoding, _astore_reply, _cached_reply,
+    _call_with_retries, _detail_chunk_index, _fetch_detail_pages, _store_reply, allm_http, decode_html, http_cache,
+    llm_cache, llm_http, llm_scheduler, make_asgi_app, scrape_throttle, start_llm_http_prewarm,
+)
 
 try:
     from bs4 import BeautifulSoup
@@ -30,6 +38,7 @@ except ImportError as e:
     print(f"✗ BeautifulSoup4 インポート失敗: {e}", flush=True)
     print("  インストール: pip install beautifulsoup4", flush=True)
 
+
 app = Flask(__name__)
 app.config["JSON_AS_ASCII"] = False
 
@@ -41,8 +50,8 @@ if BeautifulSoup is None:
 SCRAPE_HTML_MAX_CHARS = 280000
 
 
-def fetch_url_html(url, max_bytes=2 * 1024 * 1024, timeout=15):
-    """URL を GET して HTML を文字列で返す。"""
+def fetch_url_html(url, max_bytes=2 * 1024 * 1024, timeout=15, throttle=None):
+    """URL を GET して HTML を文字列で返す（http_cache 経由）。throttle はキャッシュで済まずサーバーに送るときだけ入る。"""
     url = (url or "").strip()
     if not url.startswith("http://") and not url.startswith("https://"):
         url = "https://" + url
@@ -50,7 +59,7 @@ def fetch_url_html(url, max_bytes=2 * 1024 * 1024, timeout=15):
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
         "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
-        "Accept-Encoding": "gzip, deflate, br",
+        "Accept-Encoding": _accept_encoding(),
         "Connection": "keep-alive",
         "Upgrade-Insecure-Requests": "1",
         "Sec-Fetch-Dest": "document",
@@ -63,23 +72,8 @@ def fetch_url_html(url, max_bytes=2 * 1024 * 1024, timeout=15):
     elif "pokepara.jp" in url.lower():
         headers["Referer"] = "https://www.pokepara.jp/"
     req = urllib.request.Request(url, data=None, method="GET", headers=headers)
-    with urllib.request.urlopen(req, timeout=timeout) as res:
-        raw = res.read(max_bytes)
-    
-    # gzip解凍が必要な場合
-    if raw[:2] == b'\x1f\x8b':
-        try:
-            import gzip
-            raw = gzip.decompress(raw)
-        except:
-            pass
-    
-    for enc in ("utf-8", "cp932", "shift_jis", "iso-8859-1"):
-        try:
-            return raw.decode(enc)
-        except (UnicodeDecodeError, LookupError):
-            continue
-    return raw.decode("utf-8", errors="replace")
+    raw, content_type = http_cache.fetch(req, max_bytes, timeout, throttle)  # gzip / deflate / br は読みながら展開済み
+    return decode_html(raw, content_type, url)
 
 
 def _resolve_url(base_url, href):
@@ -546,68 +540,6 @@ def _parse_pokepara_detail_page(html):
     return result
 
 
-def _build_suntory_csv_from_chunks(chunks):
-    """サントリーバーナビのchunksからCSVを生成"""
-    rows = []
-    for label, html in chunks:
-        if "詳細" in label:
-            detail = _parse_suntory_detail_page(html)
-            if detail.get("name") or detail.get("phone"):
-                rows.append(detail)
-    
-    if not rows:
-        return ""
-    
-    # ゼロ幅文字を除去
-    _zw = "\u200b\u200c\u200d\ufeff"
-    def _s(s):
-        if s is None:
-            return ""
-        s = str(s).strip()
-        return "".join(c for c in s if c not in _zw)
-    
-    header = ["店舗名", "住所", "電話番号"]
-    buf = [",".join(header)]
-    for r in rows:
-        def q(s):
-            s = _s(s).replace('"', '""')
-            return f'"{s}"' if "," in s or "\n" in s or '"' in s else s
-        buf.append(",".join(q(r.get(k, "")) for k in ["name", "address", "phone"]))
-    
-    return "\r\n".join(buf)
-
-
-def _build_pokepara_csv_from_chunks(chunks):
-    """ポケパラのchunksからCSVを生成"""
-    rows = []
-    for label, html in chunks:
-        if "詳細" in label:
-            detail = _parse_pokepara_detail_page(html)
-            if detail.get("name") or detail.get("phone"):
-                rows.append(detail)
-    
-    if not rows:
-        return ""
-    
-    # ゼロ幅文字を除去
-    _zw = "\u200b\u200c\u200d\ufeff"
-    def _s(s):
-        if s is None:
-            return ""
-        s = str(s).strip()
-        return "".join(c for c in s if c not in _zw)
-    
-    header = ["店舗名", "地域・業態", "住所", "電話番号"]
-    buf = [",".join(header)]
-    for r in rows:
-        def q(s):
-            s = _s(s).replace('"', '""')
-            return f'"{s}"' if "," in s or "\n" in s or '"' in s else s
-        buf.append(",".join(q(r.get(k, "")) for k in ["name", "area_type", "address", "phone"]))
-    
-    return "\r\n".join(buf)
-
-
 def _parse_tabelog_detail_page(html):
     """食べログ店舗詳細HTMLから 店名・電話番号・住所 を抽出。JSON-LD Restaurant 優先。"""
     out = {"name": "", "phone": "", "address": ""}
@@ -659,53 +591,87 @@ def _parse_tabelog_detail_page(html):
     return out
 
 
-def _build_tabelog_csv_from_chunks(chunks):
-    """chunks（一覧・詳細のHTML）をパースしてCSV文字列を返す。"""
+# プログラムでパースできるサイト。一覧・詳細ページの HTML から CSV の行を作る（それ以外のサイトは AI で抽出する）
+_CSV_ZERO_WIDTH = "\u200b\u200c\u200d\ufeff"  # ゼロ幅文字などでJSON/表示が崩れないよう除去する
+
+
+def _csv_cell(value):
+    s = "".join(c for c in str(value if value is not None else "").strip() if c not in _CSV_ZERO_WIDTH)
+    s = s.replace('"', '""')
+    return f'"{s}"' if "," in s or "\n" in s or '"' in s else s
+
+
+def _csv_line(values):
+    return ",".join(_csv_cell(v) for v in values)
+
+
+def _tabelog_row(html, listing):
+    """食べログの詳細ページ1件を、同じ順の一覧ブロックと突き合わせて1行にする"""
+    det = _parse_tabelog_detail_page(html)
+    return [
+        det.get("name") or listing.get("name") or "",
+        det.get("phone") or "",
+        det.get("address") or "",
+        listing.get("area") or "",
+        listing.get("genre") or "",
+        listing.get("rating") or "",
+        listing.get("review_count") or "",
+        listing.get("price_range") or "",
+    ]
+
+
+def _suntory_row(html, listing):
+    """サントリーバーナビの詳細ページ1件を1行にする（店名も電話番号も無ければ None）"""
+    det = _parse_suntory_detail_page(html)
+    if not (det.get("name") or det.get("phone")):
+        return None
+    return [det.get(k, "") for k in ("name", "address", "phone")]
+
+
+def _pokepara_row(html, listing):
+    """ポケパラの詳細ページ1件を1行にする（店名も電話番号も無ければ None）"""
+    det = _parse_pokepara_detail_page(html)
+    if not (det.get("name") or det.get("phone")):
+        return None
+    return [det.get(k, "") for k in ("name", "area_type", "address", "phone")]
+
+
+# プログラムでパースできるサイト（ScrapeSite の各項目は common.py を参照）
+SCRAPE_SITES = (
+    ScrapeSite("tabelog.com", ("店名", "電話番号", "住所", "地域", "ジャンル", "評価", "口コミ数", "価格帯"), _parse_tabelog_list_blocks, _tabelog_row),
+    ScrapeSite("bar-navi.suntory.co.jp", ("店舗名", "住所", "電話番号"), None, _suntory_row),
+    ScrapeSite("pokepara.jp", ("店舗名", "地域・業態", "住所", "電話番号"), None, _pokepara_row),
+)
+
+
+def _build_site_csv_from_chunks(site, chunks):
+    """chunks（一覧・詳細のHTML）をパースしてCSV文字列を返す。一覧は詳細ページの URL の番号で突き合わせる（ジョブと同じ）。"""
     list_rows = []
-    detail_rows = []
+    lines = []
+    num_detail = 0
     for label, html in chunks:
-        if "一覧" in label:
-            parsed = _parse_tabelog_list_blocks(html)
-            print(f"[DEBUG] {label}: {len(parsed)}件抽出", flush=True)
-            list_rows.extend(parsed)
+        if "一覧" in label and site.parse_listing:
+            list_rows.extend(site.parse_listing(html))
         if "詳細" in label:
-            detail_rows.append(_parse_tabelog_detail_page(html))
-    print(f"[DEBUG] 一覧データ: {len(list_rows)}件, 詳細データ: {len(detail_rows)}件", flush=True)
-    rows = []
-    for i, det in enumerate(detail_rows):
-        lst = list_rows[i] if i < len(list_rows) else {}
-        rows.append({
-            "店名": det.get("name") or lst.get("name") or "",
-            "電話番号": det.get("phone") or "",
-            "住所": det.get("address") or "",
-            "地域": lst.get("area") or "",
-            "ジャンル": lst.get("genre") or "",
-            "評価": lst.get("rating") or "",
-            "口コミ数": lst.get("review_count") or "",
-            "価格帯": lst.get("price_range") or "",
-        })
-    print(f"[DEBUG] 最終データ行数: {len(rows)}件", flush=True)
-    if not rows:
+            index = _detail_chunk_index(label, num_detail)
+            row = site.parse_row(html, list_rows[index] if index < len(list_rows) else {})
+            num_detail += 1
+            if row is not None:
+                lines.append(_csv_line(row))
+    if DEBUG_MODE:
+        print(f"[DEBUG] {site.domain}: 一覧データ {len(list_rows)}件, 詳細 {num_detail}件, 出力 {len(lines)}行", flush=True)
+    if not lines:
         return ""
-    # ゼロ幅文字などでJSON/表示が崩れないよう正規化
-    _zw = "\u200b\u200c\u200d\ufeff"
-    def _s(s):
-        if s is None:
-            return ""
-        s = str(s).strip()
-        return "".join(c for c in s if c not in _zw)
-    header = ["店名", "電話番号", "住所", "地域", "ジャンル", "評価", "口コミ数", "価格帯"]
-    buf = [",".join(header)]
-    for r in rows:
-        def q(s):
-            s = _s(s).replace('"', '""')
-            return f'"{s}"' if "," in s or "\n" in s or '"' in s else s
-        buf.append(",".join(q(r.get(k, "")) for k in header))
-    return "\r\n".join(buf)
-
-
-def _fetch_pages_for_scrape(start_url, follow_details=True, max_detail_pages=15, follow_pages=True, max_pages=3, delay_sec=0.6):
-    """開始URLから一覧・次ページ・詳細をたどり、(ラベル付きHTMLリスト, エラーメッセージ) を返す。"""
+    return "\r\n".join([",".join(site.header)] + lines)
+
+
+def _fetch_pages_for_scrape(start_url, follow_details=True, max_detail_pages=15, follow_pages=True, max_pages=3, delay_sec=0.6, observer=None, keep_details=True):
+    """
+    開始URLから一覧・次ページ・詳細をたどり、(ラベル付きHTMLリスト, エラーメッセージ) を返す。
+    observer があれば listing_fetched(HTML)・details_found(URLリスト)・detail_fetched(番号, URL, HTML か None) で進み具合を知らせ、
+    observer.cancel（threading.Event）が立ったらそこで打ち切る。keep_details=False なら詳細ページは observer に渡すだけで返さない
+    """
+    cancel = observer.cancel if observer else None
     if not start_url.strip():
         return [], "URL が空です"
     base = start_url.strip()
@@ -716,18 +682,23 @@ def _fetch_pages_for_scrape(start_url, follow_details=True, max_detail_pages=15,
     next_url = base
     page_count = 0
     while next_url and page_count < max_pages:
+        if cancel is not None and cancel.is_set():
+            return all_html_chunks, "キャンセルされました"
         page_count += 1
         try:
-            html = fetch_url_html(next_url, max_bytes=1 * 1024 * 1024, timeout=25)
+            html = fetch_url_html(
+                next_url, max_bytes=1 * 1024 * 1024, timeout=25, throttle=scrape_throttle.slot(next_url, delay_sec)
+            )
         except Exception as e:
             return all_html_chunks, f"一覧の取得に失敗: {e!r}"
         all_html_chunks.append(("[一覧ページ " + str(page_count) + "] " + next_url + "\n", html))
+        if observer:
+            observer.listing_fetched(html)
         if follow_pages and BeautifulSoup:
             next_link = _extract_next_page_link(html, next_url)
             if next_link and next_link not in visited_listing:
                 visited_listing.add(next_link)
                 next_url = next_link
-                time.sleep(delay_sec)
                 continue
         break
     detail_urls = []
@@ -736,11 +707,13 @@ def _fetch_pages_for_scrape(start_url, follow_details=True, max_detail_pages=15,
             detail_urls.extend(_extract_detail_links(html, base, limit=max_detail_pages))
         detail_urls = list(dict.fromkeys(detail_urls))[:max_detail_pages]
         print(f"[DEBUG] 詳細URL抽出完了: {len(detail_urls)}件", flush=True)
-    for i, durl in enumerate(detail_urls):
-        time.sleep(delay_sec)
-        try:
-            html = fetch_url_html(durl, max_bytes=500 * 1024, timeout=20)
-        except Exception:
+    # 同じホストへは delay_sec 間隔・同時 SCRAPE_PER_HOST_CONCURRENCY 本までで並列に取得（取得できなかったページは飛ばす）
+    if observer:
+        observer.details_found(detail_urls)
+    on_page = observer.detail_fetched if observer else None
+    pages = _fetch_detail_pages(detail_urls, fetch_url_html, delay_sec, max_bytes=500 * 1024, timeout=20, on_page=on_page, cancel=cancel, keep=keep_details)
+    for i, (durl, html) in enumerate(zip(detail_urls, pages)):
+        if html is None:
             continue
         all_html_chunks.append(("[詳細ページ " + str(i + 1) + "] " + durl + "\n", html))
     return all_html_chunks, None
@@ -753,20 +726,65 @@ def get_api_key():
     return api_key
 
 
-def call_chatgpt_api(messages, api_key, model="gpt-4o-mini"):
-    """OpenAI Chat API を呼び出す。"""
+# LLM_HTTP_PREWARM のとき起動時に接続を張っておく LLM API のホスト
+LLM_API_HOSTS = ("api.openai.com",)
+
+
+def _estimate_request_tokens(messages):
+    """送信前のトークン数の見積もり（英数字 4 文字 ≒ 1、日本語 1 文字 ≒ 1 で概算）"""
+    total = LLM_EXPECTED_OUTPUT_TOKENS
+    for m in messages:
+        text = m.get("content") or ""
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        total += int(ascii_chars / 4 + (len(text) - ascii_chars)) + 1
+    return total
+
+
+def call_chatgpt_api(messages, api_key, model="gpt-4o-mini", use_cache=True):
+    """
+    OpenAI Chat API を呼び出す。use_cache=True なら同じ内容の応答を応答キャッシュから返す。
+    レート枠を待ち、429・5xx はリトライする
+    """
+    key, hit = _cached_reply("openai", model, messages, use_cache)
+    if hit:
+        return hit
     url = "https://api.openai.com/v1/chat/completions"
-    body = {"model": model, "messages": messages, "temperature": 0.7}
+    body = {"model": model, "messages": messages, "temperature": LLM_TEMPERATURE}
     body_bytes = json.dumps(body, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(
+    est_tokens = _estimate_request_tokens(messages)
+    _, _, raw = _call_with_retries(model, est_tokens, lambda: llm_http.request(
+        "POST",
         url,
-        data=body_bytes,
-        method="POST",
+        body=body_bytes,
         headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json; charset=utf-8"},
-    )
-    with urllib.request.urlopen(req) as res:
-        data = json.loads(res.read().decode("utf-8"))
-    return data["choices"][0]["message"]["content"], {}
+    ))
+    data = json.loads(raw.decode("utf-8"))
+    reply = data["choices"][0]["message"]["content"]
+    llm_scheduler.settle(model, est_tokens, data.get("usage"))
+    _store_reply(key, "openai", model, reply, data.get("usage"))
+    return reply, {}
+
+
+async def acall_chatgpt_api(messages, api_key, model="gpt-4o-mini", use_cache=True):
+    """call_chatgpt_api の async 版"""
+    key, hit = await _acached_reply("openai", model, messages, use_cache)
+    if hit:
+        return hit
+    url = "https://api.openai.com/v1/chat/completions"
+    body = {"model": model, "messages": messages, "temperature": LLM_TEMPERATURE}
+    body_bytes = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    est_tokens = _estimate_request_tokens(messages)
+    _, _, raw = await _acall_with_retries(model, est_tokens, lambda: allm_http.request(
+        "POST",
+        url,
+        body=body_bytes,
+        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json; charset=utf-8"},
+    ))
+    data = json.loads(raw.decode("utf-8"))
+    reply = data["choices"][0]["message"]["content"]
+    llm_scheduler.settle(model, est_tokens, data.get("usage"))
+    await _astore_reply(key, "openai", model, reply, data.get("usage"))
+    return reply, {}
 
 
 @app.route("/")
@@ -774,72 +792,81 @@ def index():
     return render_template("index.html")
 
 
-@app.route("/api/scrape", methods=["POST"])
-def api_scrape():
-    """URL を取得し、指示に従ってデータを抽出し CSV で返す。食べログはプログラムパース優先。"""
-    data = request.get_json() or {}
+@app.route("/api/stats", methods=["GET"])
+def api_stats():
+    """応答キャッシュのヒット率・レート制限の待ちとリトライ・OpenAI API への接続の再利用状況などを返す"""
+    return jsonify({
+        "llm_cache": llm_cache.stats(),
+        "scheduler": llm_scheduler.stats(),
+        "http": llm_http.stats(),
+        "http_async": allm_http.stats(),
+        "http_cache": http_cache.stats(),
+        "scrape_jobs": scrape_jobs.stats(),
+    })
+
+
+def _scrape_params(data):
+    """/api/scrape・/api/scrape/jobs の入力を読む。(params, None) か、入力エラーなら (None, (JSON, ステータス)) を返す"""
     url = (data.get("url") or "").strip()
     instruction = (data.get("instruction") or "").strip()
-    follow_details = data.get("follow_details", True)
-    follow_pages = data.get("follow_pages", True)
     is_tabelog_url = "tabelog.com" in (url or "").lower()
     default_details = 50 if is_tabelog_url else 15
-    max_detail_pages = min(max(1, int(data.get("max_detail_pages", default_details))), 1000)
-    max_pages = min(max(1, int(data.get("max_pages", 3))), 10)
     if not url:
-        return jsonify({"error": "url を入力してください"}), 400
+        return None, ({"error": "url を入力してください"}, 400)
     if not instruction:
-        return jsonify({"error": "指示を入力してください（例: 店名・電話番号・住所を取得）"}), 400
+        return None, ({"error": "指示を入力してください（例: 店名・電話番号・住所を取得）"}, 400)
+    return {
+        "url": url,
+        "instruction": instruction,
+        "follow_details": data.get("follow_details", True),
+        "follow_pages": data.get("follow_pages", True),
+        "max_detail_pages": min(max(1, int(data.get("max_detail_pages", default_details))), 1000),
+        "max_pages": min(max(1, int(data.get("max_pages", 3))), 10),
+        "use_cache": not data.get("no_cache"),
+    }, None
+
+
+def _prepare_scrape(data):
+    """
+    /api/scrape の前半（入力チェック・ページ取得・サイト別のプログラム抽出）。
+    そのまま返せる結果があれば ((JSON, ステータス), None)、AI 抽出が必要なら (None, (messages, api_key)) を返す
+    """
+    params, error = _scrape_params(data)
+    if error:
+        return error, None
+    url = params["url"]
     
-    print(f"[DEBUG] スクレイピング開始: URL={url}, follow_details={follow_details}, max_detail_pages={max_detail_pages}", flush=True)
+    print(f"[DEBUG] スクレイピング開始: URL={url}, follow_details={params['follow_details']}, max_detail_pages={params['max_detail_pages']}", flush=True)
     
     chunks, err = _fetch_pages_for_scrape(
         url,
-        follow_details=follow_details,
-        max_detail_pages=max_detail_pages,
-        follow_pages=follow_pages,
-        max_pages=max_pages,
+        follow_details=params["follow_details"],
+        max_detail_pages=params["max_detail_pages"],
+        follow_pages=params["follow_pages"],
+        max_pages=params["max_pages"],
     )
     
     print(f"[DEBUG] chunks取得完了: len(chunks)={len(chunks)}, err={err}", flush=True)
     
     if err and not chunks:
-        return jsonify({"error": err}), 500
-    
-    is_tabelog = "tabelog.com" in url.lower()
-    is_suntory = "bar-navi.suntory.co.jp" in url.lower()
-    is_pokepara = "pokepara.jp" in url.lower()
-    
-    if is_tabelog:
-        if DEBUG_MODE:
-            print(f"[DEBUG] 食べログとして処理開始", flush=True)
-        programmatic_csv = _build_tabelog_csv_from_chunks(chunks)
-        if DEBUG_MODE:
-            print(f"[DEBUG] CSV生成完了: 行数={programmatic_csv.count(chr(10)) if programmatic_csv else 0}, 文字数={len(programmatic_csv) if programmatic_csv else 0}", flush=True)
-        if programmatic_csv and programmatic_csv.count("\n") >= 1:
-            return jsonify({"csv": programmatic_csv})
+        return ({"error": err}, 500), None
     
-    if is_suntory:
-        if DEBUG_MODE:
-            print(f"[DEBUG] サントリーバーナビとして処理開始", flush=True)
-        programmatic_csv = _build_suntory_csv_from_chunks(chunks)
-        if DEBUG_MODE:
-            print(f"[DEBUG] CSV生成完了: 行数={programmatic_csv.count(chr(10)) if programmatic_csv else 0}, 文字数={len(programmatic_csv) if programmatic_csv else 0}", flush=True)
-        if programmatic_csv and programmatic_csv.count("\n") >= 1:
-            return jsonify({"csv": programmatic_csv})
-    
-    if is_pokepara:
-        if DEBUG_MODE:
-            print(f"[DEBUG] ポケパラとして処理開始", flush=True)
-        programmatic_csv = _build_pokepara_csv_from_chunks(chunks)
-        if DEBUG_MODE:
-            print(f"[DEBUG] CSV生成完了: 行数={programmatic_csv.count(chr(10)) if programmatic_csv else 0}, 文字数={len(programmatic_csv) if programmatic_csv else 0}", flush=True)
-        if programmatic_csv and programmatic_csv.count("\n") >= 1:
-            return jsonify({"csv": programmatic_csv})
+    site = scrape_pipeline.site(url)
+    if site:
+        programmatic_csv = _build_site_csv_from_chunks(site, chunks)
+        if programmatic_csv:
+            return ({"csv": programmatic_csv}, 200), None
+    return _scrape_llm_request(params, chunks)
+
+
+def _scrape_llm_request(params, chunks):
+    """AI 抽出のリクエストを組み立てる。(None, (messages, api_key)) か、API キーが無ければ ((JSON, ステータス), None)"""
     try:
         api_key = get_api_key()
     except ValueError as e:
-        return jsonify({"error": str(e)}), 500
+        return ({"error": str(e)}, 500), None
+    is_tabelog = "tabelog.com" in params["url"].lower()
+    instruction = params["instruction"]
     combined = ""
     for label, html in chunks:
         combined += label + html + "\n\n"
@@ -863,23 +890,74 @@ def api_scrape():
         {"role": "system", "content": system_content},
         {"role": "user", "content": user_content},
     ]
-    try:
-        csv_content, _ = call_chatgpt_api(messages, api_key, model="gpt-4o-mini")
-        csv_content = (csv_content or "").strip()
-        for prefix in ("```csv", "```CSV", "```"):
-            if csv_content.startswith(prefix):
-                csv_content = csv_content[len(prefix):].lstrip("\r\n")
-                break
-        if csv_content.endswith("```"):
-            csv_content = csv_content[:-3].rstrip("\r\n")
-        if not csv_content:
-            return jsonify({"error": "抽出結果が空でした"}), 500
-        return jsonify({"csv": csv_content})
-    except urllib.error.HTTPError as e:
-        err_body = e.read().decode("utf-8", errors="replace")
-        return jsonify({"error": f"APIエラー: {err_body}"}), 500
-    except Exception as e:
-        return jsonify({"error": f"抽出エラー: {str(e)}"}), 500
+    return None, (messages, api_key)
+
+
+# /api/scrape（stream あり・なし）・ジョブ・ASGI で共通の流れ（common.py）に、このアプリのパーサーと取得・抽出を渡す
+scrape_pipeline = ScrapePipeline(
+    SCRAPE_SITES, _csv_line, _fetch_pages_for_scrape, _scrape_params, _prepare_scrape, _scrape_llm_request,
+    call_chatgpt_api, acall_chatgpt_api,
+)
+
+
+@app.route("/api/scrape", methods=["POST"])
+def api_scrape():
+    """
+    URL を取得し、指示に従ってデータを抽出し CSV で返す。食べログはプログラムパース優先。
+    stream: "csv" / "ndjson" なら JSON ではなくその形式で返す（プログラムでパースできるサイトは詳細ページを取得するたびに1行ずつ）
+    """
+    data = request.get_json() or {}
+    chunks, result = scrape_pipeline.respond(data)
+    if chunks:
+        return Response(chunks, content_type=SCRAPE_STREAM_TYPES[data["stream"]], headers=SCRAPE_STREAM_HEADERS)
+    return jsonify(result[0]), result[1]
+
+
+scrape_jobs = ScrapeJobManager(scrape_pipeline, SCRAPE_JOB_WORKERS, SCRAPE_JOB_MAX_PENDING, SCRAPE_JOB_TTL)
+
+
+@app.route("/api/scrape/jobs", methods=["POST"])
+def api_scrape_job_create():
+    """/api/scrape と同じ入力でジョブを始め、すぐに job_id を返す（進み具合は GET /api/scrape/jobs/<job_id>）"""
+    if not SCRAPE_JOBS_ENABLED:
+        return jsonify({"error": "この環境ではジョブを使えません。/api/scrape を使ってください"}), 501
+    params, error = _scrape_params(request.get_json() or {})
+    if error:
+        return jsonify(error[0]), error[1]
+    job = scrape_jobs.submit(params)
+    if job is None:
+        return jsonify({"error": "実行中のスクレイピングが多すぎます。しばらくしてから再実行してください"}), 429
+    return jsonify(job.snapshot()), 202
+
+
+@app.route("/api/scrape/jobs/<job_id>", methods=["GET"])
+def api_scrape_job(job_id):
+    """ジョブの状態・取得ページ数・行数・残り時間の見込みと、ここまでの CSV を返す"""
+    job = scrape_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません（期限切れの可能性があります）"}), 404
+    return jsonify(job.snapshot())
+
+
+@app.route("/api/scrape/jobs/<job_id>", methods=["DELETE"])
+def api_scrape_job_cancel(job_id):
+    """ジョブを止める。それまでに取れた行は csv に残る"""
+    job = scrape_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません（期限切れの可能性があります）"}), 404
+    return jsonify(job.snapshot())
+
+
+_ASGI_ROUTES = {
+    ("POST", "/api/scrape"): scrape_pipeline.asgi,
+}
+# ASGI アプリ本体（例: uvicorn app:asgi_app --workers 2）。上のルート以外は Flask アプリに渡す
+asgi_app = make_asgi_app(app, _ASGI_ROUTES, LLM_API_HOSTS)
+
+
+# 起動時に OpenAI API への接続を張っておく（gunicorn の各ワーカーで実行）
+if LLM_HTTP_PREWARM:
+    start_llm_http_prewarm(LLM_API_HOSTS)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1853 @@
+"""
+X（営業提案チャット）と scrape-bot で共通の土台
+HTTP 取得（展開・ディスクキャッシュ・文字コード判定・ホストごとの間隔）、LLM API の接続プール・応答キャッシュ・
+レート制限とリトライ、スクレイピングのストリーム・ジョブ、ASGI の入口。サイトごとのパーサーは各アプリに置く。
+scrape-bot は別のルートディレクトリからデプロイするので、X/common.py をそのまま scrape-bot/common.py にコピーして使う
+（2つは同じ内容に保つ。tests/test_common.py で確認している）
+"""
+import os
+import sys
+import json
+import csv
+import time
+import re
+import io
+import hashlib
+import codecs
+import zlib
+import tempfile
+import threading
+import queue
+import collections
+import itertools
+import concurrent.futures
+import contextlib
+import secrets
+import asyncio
+import random
+import email.utils
+import ssl
+import http.client
+import base64
+import urllib.request
+import urllib.error
+import urllib.parse
+
+# Content-Encoding: br の展開用（オプション：無ければ br を受け付けない）
+try:
+    import brotli
+    # 展開後の大きさを制限できる（process の output_buffer_limit がある）のは brotli 1.2 以降。古い版では br を受け付けない
+    if not hasattr(brotli.Decompressor(), "can_accept_more_data"):
+        brotli = None
+except ImportError:
+    brotli = None
+
+
+HTTP_READ_CHUNK = 64 * 1024  # 本文を読む単位（展開もこの単位で行う）
+
+
+def _accept_encoding():
+    """送る Accept-Encoding（brotli 1.2 以降が入っていなければ br は受け付けない）"""
+    return "gzip, deflate, br" if brotli else "gzip, deflate"
+
+
+class _StreamDecoder:
+    """Content-Encoding（gzip / deflate / br）を読んだ分ずつ展開する"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._zlib = None
+        self._brotli = None
+        if encoding in ("gzip", "x-gzip"):
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "br":
+            if brotli is None:
+                raise ValueError("br（brotli）で圧縮された応答を展開できません。pip install 'brotli>=1.2' が必要です")
+            self._brotli = brotli.Decompressor()
+        elif encoding not in ("deflate", "", "identity"):
+            raise ValueError(f"未対応の Content-Encoding: {encoding}")
+
+    def decompress(self, data, limit):
+        """data を展開して返す（limit バイトまでしか展開しない。上限に達したら残りは捨てる前提）"""
+        if self.encoding == "deflate" and self._zlib is None:
+            # deflate は本来 zlib 形式だが、ヘッダー無しの生 deflate を返すサーバーもある
+            wrapped = len(data) >= 2 and data[0] & 0x0F == 8 and ((data[0] << 8) | data[1]) % 31 == 0
+            self._zlib = zlib.decompressobj(zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS)
+        if self._zlib is not None:
+            return self._zlib.decompress(data, limit)
+        if self._brotli is not None:
+            return self._brotli.process(data, output_buffer_limit=limit)
+        return data
+
+    def flush(self):
+        return self._zlib.flush() if self._zlib is not None else b""
+
+
+def read_decoded_body(res, max_bytes, chunk_size=HTTP_READ_CHUNK):
+    """
+    レスポンス本文を chunk_size ずつ読みながら展開し、(本文, 上限で打ち切ったか) を返す。
+    上限 max_bytes は展開後のバイト数にかかる（圧縮爆弾でもメモリは上限＋1回分で済む）
+    """
+    decoder = _StreamDecoder((res.headers.get("Content-Encoding") or "").strip().lower())
+    out = bytearray()
+    while len(out) <= max_bytes:
+        data = res.read(chunk_size)
+        if not data:
+            out += decoder.flush()
+            break
+        out += decoder.decompress(data, max_bytes + 1 - len(out))
+    return bytes(out[:max_bytes]), len(out) > max_bytes
+
+
+# fetch_url_html のディスクキャッシュ（期限内ならローカルから返し、期限切れなら ETag / Last-Modified で変更の有無だけ確認する）
+HTTP_CACHE_ENABLED = os.environ.get("HTTP_CACHE", "1") != "0"
+HTTP_CACHE_DIR = os.environ.get("HTTP_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "sales-proposal-app", "http")
+HTTP_CACHE_MAX_BYTES = int(os.environ.get("HTTP_CACHE_MAX_MB", "256")) * 1024 * 1024
+HTTP_CACHE_DEFAULT_TTL = float(os.environ.get("HTTP_CACHE_TTL", "600"))  # 秒（0 なら毎回確認する）
+HTTP_CACHE_VERSION = 2  # 保存形式を変えたら上げる（本文は Content-Encoding を展開した後のもの）
+# ホストごとの鮮度（秒。ホスト名の後方一致）。環境変数 HTTP_CACHE_TTLS="tabelog.com=3600,example.com=0" で先頭に追加・上書き
+HTTP_CACHE_TTLS = (
+    ("tabelog.com", 6 * 3600),
+)
+
+
+def _parse_host_ttls(value):
+    ttls = []
+    for item in (value or "").split(","):
+        host, _, ttl = item.strip().partition("=")
+        try:
+            ttls.append((host.strip().lower(), float(ttl)))
+        except ValueError:
+            continue
+    return tuple(t for t in ttls if t[0])
+
+
+class DiskLruCache:
+    """
+    1件1ファイルのディスクキャッシュの共通部分（HttpCache・LlmResponseCache が使う）。
+    一時ファイル → rename で書くので複数ワーカーから共有できる。使ったファイルは更新日時を今にし、
+    合計が max_bytes を超えたら更新日時の古い順（最近使われていない順）に容量の 9 割まで消す。
+    """
+
+    suffix = ""  # このキャッシュのファイルの拡張子（容量の集計と削除はこの拡張子のファイルだけ）
+
+    def __init__(self, cache_dir, max_bytes, counters):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._approx_bytes = None  # このプロセスから見た合計サイズの見積もり（超えたらフォルダを数え直す）
+        self._stats = dict.fromkeys(tuple(counters) + ("writes", "evictions"), 0)
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _touch(self, path):
+        with contextlib.suppress(OSError):
+            os.utime(path)  # 最近使った印（容量超過時に消す順番に使う）
+
+    def _write(self, path, data):
+        """data（bytes）を path に書き、容量を超えていれば古いものから消す。書けなければ何もしない"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self._count("writes")
+        with self._lock:
+            if self._approx_bytes is None:
+                self._approx_bytes = self._scan()[0]
+            else:
+                self._approx_bytes += len(data)
+            over = self._approx_bytes > self.max_bytes
+        if over:
+            self._evict()
+
+    def _scan(self):
+        """(合計サイズ, [(更新日時, サイズ, パス), ...]) を返す"""
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for e in it:
+                    if e.name.endswith(self.suffix):
+                        with contextlib.suppress(OSError):
+                            st = e.stat()
+                            entries.append((st.st_mtime, st.st_size, e.path))
+        except OSError:
+            pass
+        return sum(size for _, size, _ in entries), entries
+
+    def _evict(self):
+        """最近使われていない順に消して、容量の 9 割まで減らす"""
+        total, entries = self._scan()
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                total -= size
+                removed += 1
+        with self._lock:
+            self._approx_bytes = total
+            self._stats["evictions"] += removed
+
+    def stats(self):
+        with self._lock:
+            st = dict(self._stats)
+            approx_bytes = self._approx_bytes
+        return {**st, "approx_bytes": approx_bytes, "max_bytes": self.max_bytes}
+
+
+class HttpCache(DiskLruCache):
+    """
+    GET の応答本文（展開後）を URL ごとに zlib で圧縮して、ETag / Last-Modified と一緒に保存するディスクキャッシュ。
+    ホストごとの ttl 以内ならネットに出ずに返し、過ぎていれば If-None-Match / If-Modified-Since を付けて取り直す（304 なら保存分を使う）。
+    1件1ファイル（1行目がメタ情報の JSON、その後ろが圧縮した本文）。容量を超えたら最近使われていない順に消す
+    """
+
+    suffix = ".bin"
+
+    def __init__(self, cache_dir, max_bytes, default_ttl, host_ttls):
+        super().__init__(cache_dir, max_bytes, ("hits", "revalidated", "fetched", "bytes_saved"))
+        self.default_ttl = default_ttl
+        self.host_ttls = host_ttls
+
+    def ttl_for(self, url):
+        host = (urllib.parse.urlsplit(url).hostname or "").lower()
+        for suffix, ttl in self.host_ttls:
+            if host == suffix or host.endswith("." + suffix):
+                return ttl
+        return self.default_ttl
+
+    def _path(self, url):
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"v{HTTP_CACHE_VERSION}-{digest}.bin")
+
+    def _load(self, path):
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                body = zlib.decompress(f.read())
+        except (OSError, ValueError, zlib.error):
+            return None, None
+        return meta, body
+
+    def _store(self, path, meta, body):
+        self._write(path, json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n" + zlib.compress(body, 6))
+
+    def fetch(self, req, max_bytes, timeout, throttle=None):
+        """
+        urllib.request.Request（GET）をキャッシュ経由で送り、(本文 bytes, Content-Type) を返す。エラーは urlopen と同じく送出する。
+        throttle（context manager）はサーバーに送るときだけ入る（ホストごとの間隔あけ。ローカルから返すときは待たない）
+        """
+        url = req.full_url
+        path = self._path(url)
+        meta, body = self._load(path) if HTTP_CACHE_ENABLED else (None, None)
+        if meta and meta.get("truncated") and max_bytes > meta.get("max_bytes", 0):
+            meta = None  # 前回は上限で途中までしか読んでいないので使わない
+        if meta:
+            if time.time() - meta.get("stored", 0) < self.ttl_for(url):
+                self._touch(path)
+                self._count("hits")
+                self._count("bytes_saved", len(body))
+                return body[:max_bytes], meta.get("content_type", "")
+            if meta.get("etag"):
+                req.add_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified"):
+                req.add_header("If-Modified-Since", meta["last_modified"])
+        try:
+            with throttle or contextlib.nullcontext(), urllib.request.urlopen(req, timeout=timeout) as res:
+                raw, truncated = read_decoded_body(res, max_bytes)
+                headers = res.headers
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or not meta:
+                raise
+            meta["stored"] = time.time()
+            self._store(path, meta, body)
+            self._count("revalidated")
+            self._count("bytes_saved", len(body))
+            return body[:max_bytes], meta.get("content_type", "")
+        self._count("fetched")
+        if HTTP_CACHE_ENABLED and "no-store" not in (headers.get("Cache-Control") or "").lower():
+            self._store(path, {
+                "url": url,
+                "stored": time.time(),
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "content_type": headers.get("Content-Type") or "",
+                "max_bytes": max_bytes,
+                "truncated": truncated,
+            }, raw)
+        return raw, headers.get("Content-Type") or ""
+
+    def stats(self):
+        st = super().stats()
+        requests = st["hits"] + st["revalidated"] + st["fetched"]
+        return {
+            "enabled": HTTP_CACHE_ENABLED,
+            **st,
+            "local_ratio": round((st["hits"] + st["revalidated"]) / requests, 3) if requests else 0.0,
+        }
+
+
+http_cache = HttpCache(
+    HTTP_CACHE_DIR,
+    HTTP_CACHE_MAX_BYTES,
+    HTTP_CACHE_DEFAULT_TTL,
+    _parse_host_ttls(os.environ.get("HTTP_CACHE_TTLS")) + HTTP_CACHE_TTLS,
+)
+
+
+# 文字コードの判定（BOM → Content-Type の charset → 先頭の <meta charset> の順。どれも無ければ同じホストで前に判定したもの）
+HTML_SNIFF_BYTES = 4096
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+?charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)""", re.I)
+_CONTENT_TYPE_CHARSET_RE = re.compile(r"""charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)""", re.I)
+_CHARSET_BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+# 日本のサイトの Shift_JIS 表記は実際には Windows の拡張文字（①・髙など）を含む cp932 のことが多い
+_CHARSET_ALIASES = {
+    "shift_jis": "cp932", "shift-jis": "cp932", "sjis": "cp932", "x-sjis": "cp932", "windows-31j": "cp932",
+    "iso-8859-1": "cp1252", "latin1": "cp1252", "us-ascii": "cp1252",  # ブラウザと同じ扱い
+}
+_host_charsets = {}  # host -> 前に判定した文字コード（宣言の無いページに使う）
+HOST_CHARSET_MEMO_SIZE = 1024
+
+
+def _normalize_charset(label):
+    """charset のラベルを Python のコーデック名にする（知らない名前なら None）"""
+    label = (label or "").strip().lower()
+    try:
+        return codecs.lookup(_CHARSET_ALIASES.get(label, label)).name
+    except LookupError:
+        return None
+
+
+def detect_charset(raw, content_type):
+    """宣言から文字コードを決める（BOM → Content-Type → 先頭 HTML_SNIFF_BYTES バイトの <meta>）。宣言が無ければ None"""
+    for bom, encoding in _CHARSET_BOMS:
+        if raw.startswith(bom):
+            return encoding
+    m = _CONTENT_TYPE_CHARSET_RE.search(content_type or "")
+    if m and _normalize_charset(m.group(1)):
+        return _normalize_charset(m.group(1))
+    m = _META_CHARSET_RE.search(raw[:HTML_SNIFF_BYTES])
+    if m:
+        return _normalize_charset(m.group(1).decode("ascii", "ignore"))
+    return None
+
+
+def decode_html(raw, content_type, url):
+    """
+    本文を1回だけデコードする。宣言が無いときは同じホストで前に判定した文字コード、
+    それも無ければ UTF-8 として読み、UTF-8 でなければ cp932 とみなす。
+    ホストごとに覚えるのは宣言から決めたものと、UTF-8 として問題なく読めたものだけ（cp932 は推測なので覚えない）
+    """
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    encoding = detect_charset(raw, content_type)
+    memo = encoding
+    if encoding is None:
+        encoding = _host_charsets.get(host)
+    if encoding is None:
+        try:
+            # max_bytes で切れた本文は末尾の文字が途中で終わっていることがあるので、末尾の不完全なバイト列は無視する
+            text = codecs.getincrementaldecoder("utf-8")().decode(raw, final=False)
+            encoding = memo = "utf-8"
+        except UnicodeDecodeError:
+            text = raw.decode("cp932", errors="replace")
+    else:
+        text = raw.decode(encoding, errors="replace")
+    if memo and memo not in ("utf-8-sig", "utf-16") and _host_charsets.get(host) != memo:
+        if len(_host_charsets) >= HOST_CHARSET_MEMO_SIZE:
+            _host_charsets.clear()
+        _host_charsets[host] = memo
+    return text
+
+
+# 詳細ページの並列取得（ホストごとの同時接続数と、同じホストへのリクエスト開始間隔の下限を守る）
+SCRAPE_FETCH_WORKERS = int(os.environ.get("SCRAPE_FETCH_WORKERS", "8"))
+SCRAPE_PER_HOST_CONCURRENCY = int(os.environ.get("SCRAPE_PER_HOST_CONCURRENCY", "2"))
+
+
+class HostThrottle:
+    """
+    ホストごとに同時 max_concurrency 本まで、リクエストの開始間隔を min_interval 秒以上あける（プロセス全体で共有）。
+    開始時刻は予約制（次に開始してよい時刻を先に進めてから待つ）なので、待っている間ロックを持たない
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self._lock = threading.Lock()
+        self._hosts = {}  # host -> [同時接続数のセマフォ, 次に開始してよい時刻]
+
+    @contextlib.contextmanager
+    def slot(self, url, min_interval):
+        host = (urllib.parse.urlsplit(url).hostname or "").lower()
+        with self._lock:
+            entry = self._hosts.setdefault(host, [threading.BoundedSemaphore(self.max_concurrency), 0.0])
+        entry[0].acquire()
+        try:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, entry[1])
+                entry[1] = start + min_interval
+            if start > now:
+                time.sleep(start - now)
+            yield
+        finally:
+            entry[0].release()
+
+
+scrape_throttle = HostThrottle(SCRAPE_PER_HOST_CONCURRENCY)
+
+
+def _fetch_detail_pages(urls, fetch_html, delay_sec, max_bytes, timeout, on_page=None, cancel=None, keep=True):
+    """
+    詳細ページを fetch_html（各アプリの fetch_url_html）で並列に取得し、URL の順に HTML（失敗したページは None）のリストを返す。
+    on_page があれば取得が終わった順に on_page(番号, URL, HTML) を呼ぶ（on_page が戻るまで次の取得は増やさない）。
+    cancel（threading.Event）が立ったら残りは取得しない。
+    keep=False なら HTML は on_page に渡すだけで持っておかない（返すリストはすべて None）
+    """
+    @contextlib.contextmanager
+    def polite(url):
+        # サーバーに送るときだけホストごとの枠と間隔を守る（キャッシュから返せるページは待たない）
+        with scrape_throttle.slot(url, delay_sec):
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("キャンセルされました")
+            yield
+
+    def fetch(url):
+        if cancel is not None and cancel.is_set():
+            return None
+        try:
+            return fetch_html(url, max_bytes=max_bytes, timeout=timeout, throttle=polite(url))
+        except Exception:
+            return None
+
+    if not urls:
+        return []
+    # ホストごとに交互に投入する（同じホストの URL が続くと、空いたワーカーがそのホストの枠待ちで止まる）
+    by_host = collections.defaultdict(list)
+    for i, url in enumerate(urls):
+        by_host[(urllib.parse.urlsplit(url).hostname or "").lower()].append(i)
+    order = [i for group in itertools.zip_longest(*by_host.values()) for i in group if i is not None]
+    workers = min(SCRAPE_FETCH_WORKERS, SCRAPE_PER_HOST_CONCURRENCY * len(by_host), len(urls))
+    pages = [None] * len(urls)
+    queued = iter(order)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # 投入はワーカー数の2倍まで。on_page が待たされている間に、取得済みの HTML が溜まり続けないようにする
+        running = {pool.submit(fetch, urls[i]): i for i in itertools.islice(queued, max(1, workers) * 2)}
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                html = future.result()
+                if keep:
+                    pages[i] = html
+                if on_page:
+                    on_page(i, urls[i], html)
+                for j in itertools.islice(queued, 1):
+                    running[pool.submit(fetch, urls[j])] = j
+    return pages
+
+
+# LLM API 用の HTTP 接続プール（環境変数で件数・待ち時間を変更可能）
+LLM_HTTP_POOL_SIZE = int(os.environ.get("LLM_HTTP_POOL_SIZE", "8"))  # ホストごとに保持する待機中の接続数
+LLM_HTTP_IDLE_TIMEOUT = float(os.environ.get("LLM_HTTP_IDLE_TIMEOUT", "60"))  # これ以上使われなかった接続は捨てる（秒）
+LLM_HTTP_TIMEOUT = float(os.environ.get("LLM_HTTP_TIMEOUT", "180"))
+LLM_HTTP_PREWARM = int(os.environ.get("LLM_HTTP_PREWARM", "0"))  # 起動時に各ホストへ張っておく接続数（0 で無効）
+
+
+def _https_proxy_for(host):
+    """
+    urlopen と同じく環境変数（HTTPS_PROXY / NO_PROXY など）から host への接続に使うプロキシを決める。
+    使わないなら None、使うなら (プロキシのホスト, ポート, CONNECT に付けるヘッダー) を返す
+    """
+    proxy = urllib.request.getproxies().get("https")
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    parts = urllib.parse.urlsplit(proxy if "://" in proxy else "http://" + proxy)
+    headers = {}
+    if parts.username:
+        userpass = urllib.parse.unquote(parts.username) + ":" + urllib.parse.unquote(parts.password or "")
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(userpass.encode("utf-8")).decode("ascii")
+    return parts.hostname, parts.port or 80, headers
+
+
+class ProviderHttpClient:
+    """
+    LLM API（OpenAI / Gemini）への HTTPS 接続をホストごとにプールして keep-alive で使い回す。
+    urlopen だと毎回 DNS・TCP・TLS ハンドシェイクが走るため、接続を返却して次の呼び出しで再利用する。
+    1本の接続は同時に1スレッドしか使わない（取り出している間はプールに無い）。
+    HTTPS_PROXY / NO_PROXY は urlopen と同じく効く（プロキシには CONNECT でトンネルを張る）。
+    エラー応答（4xx/5xx）は urllib と同じく urllib.error.HTTPError、接続できなければ urllib.error.URLError を送出する。
+    """
+
+    # 再利用した接続がサーバー側で既に閉じられていたときの例外（新しい接続で1回だけやり直す）
+    _STALE_ERRORS = (http.client.BadStatusLine, ConnectionError, ssl.SSLEOFError)
+
+    def __init__(self, pool_size=8, idle_timeout=60.0, timeout=180.0):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}  # host -> deque[(conn, 返却時刻)]
+        self._pid = os.getpid()
+        self._ssl_context = ssl.create_default_context()
+        self._stats = {
+            "requests": 0, "connections_opened": 0, "connections_reused": 0,
+            "stale_retries": 0, "connect_sec": 0.0, "request_sec": 0.0,
+        }
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _new_connection(self, host):
+        proxy = _https_proxy_for(host)
+        if proxy:
+            proxy_host, proxy_port, proxy_headers = proxy
+            conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=self.timeout, context=self._ssl_context)
+            conn.set_tunnel(host, headers=proxy_headers)
+        else:
+            conn = http.client.HTTPSConnection(host, timeout=self.timeout, context=self._ssl_context)
+        started = time.perf_counter()
+        try:
+            conn.connect()  # ハンドシェイクの時間だけを測るため、送信前に明示的に接続する
+        except OSError as e:
+            conn.close()
+            raise urllib.error.URLError(e) from e  # urlopen と同じく、接続できなかったときは URLError
+        self._count("connect_sec", time.perf_counter() - started)
+        self._count("connections_opened")
+        return conn
+
+    def _acquire(self, host):
+        """(接続, 再利用かどうか) を返す。待機中の接続が無ければ新規に張る"""
+        now = time.monotonic()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = {}  # fork 前に張った接続は親と共有になるので使わない
+                self._pid = os.getpid()
+            idle = self._idle.get(host)
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._new_connection(host), False
+
+    def _release(self, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault(host, collections.deque())
+            if len(idle) < self.pool_size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def prewarm(self, hosts, count=1):
+        """起動時に各ホストへ count 本の接続を張ってプールに入れておく（失敗しても無視）"""
+        for host in hosts:
+            for _ in range(count):
+                try:
+                    self._release(host, self._new_connection(host))
+                except OSError as e:
+                    print(f"[http] {host} への事前接続に失敗: {e}", flush=True)
+                    break
+
+    def _send(self, method, url, body, headers):
+        """リクエストを送ってレスポンスヘッダーまで受け取り (ホスト, 接続, レスポンス) を返す"""
+        parts = urllib.parse.urlsplit(url)
+        host = parts.netloc
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = dict(headers or {})
+        started = time.perf_counter()
+        for attempt in range(2):
+            conn, reused = self._acquire(host)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                res = conn.getresponse()
+            except self._STALE_ERRORS:
+                conn.close()
+                if reused and attempt == 0:
+                    self._count("stale_retries")
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            if reused:
+                self._count("connections_reused")
+            self._count("requests")
+            self._count("request_sec", time.perf_counter() - started)
+            return host, conn, res
+
+    def _finish(self, host, conn, res):
+        """本文を読み切ったレスポンスの接続はプールへ返し、途中なら閉じる"""
+        if res.isclosed() and not res.will_close:
+            self._release(host, conn)
+        else:
+            conn.close()
+
+    def _raise_for_status(self, url, host, conn, res):
+        if res.status >= 400:
+            try:
+                data = res.read()
+            finally:
+                self._finish(host, conn, res)
+            raise urllib.error.HTTPError(url, res.status, res.reason, res.headers, io.BytesIO(data))
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        リクエストを送り (ステータス, レスポンスヘッダー, 本文 bytes) を返す。
+        本文を読み切った接続はプールへ返す。4xx/5xx は urllib.error.HTTPError。
+        """
+        host, conn, res = self._send(method, url, body, headers)
+        self._raise_for_status(url, host, conn, res)
+        try:
+            data = res.read()
+        finally:
+            self._finish(host, conn, res)
+        return res.status, res.headers, data
+
+    @contextlib.contextmanager
+    def stream(self, method, url, body=None, headers=None):
+        """
+        本文を読まずにレスポンスを返す（SSE などを少しずつ読むため）。
+        with を抜けた時点で本文を読み切っていれば接続をプールへ返し、途中で抜けた場合は閉じる。
+        """
+        host, conn, res = self._send(method, url, body, headers)
+        self._raise_for_status(url, host, conn, res)
+        try:
+            yield res
+        finally:
+            self._finish(host, conn, res)
+
+    def stats(self):
+        """接続の新規作成数・再利用数・ハンドシェイクとレスポンスヘッダー受信までの平均時間などを返す"""
+        with self._lock:
+            st = dict(self._stats)
+            idle = {host: len(conns) for host, conns in self._idle.items()}
+        attempts = st["connections_opened"] + st["connections_reused"]
+        return {
+            "requests": st["requests"],
+            "connections_opened": st["connections_opened"],
+            "connections_reused": st["connections_reused"],
+            "reuse_ratio": round(st["connections_reused"] / attempts, 3) if attempts else 0.0,
+            "stale_retries": st["stale_retries"],
+            "avg_connect_ms": round(st["connect_sec"] * 1000 / st["connections_opened"], 1) if st["connections_opened"] else None,
+            "avg_response_header_ms": round(st["request_sec"] * 1000 / st["requests"], 1) if st["requests"] else None,
+            "idle_connections": idle,
+        }
+
+
+llm_http = ProviderHttpClient(LLM_HTTP_POOL_SIZE, LLM_HTTP_IDLE_TIMEOUT, LLM_HTTP_TIMEOUT)
+
+
+def start_llm_http_prewarm(hosts):
+    """LLM API（hosts）への接続をバックグラウンドで事前に張る（リクエスト処理をブロックしない）"""
+    threading.Thread(
+        target=llm_http.prewarm, args=(hosts, LLM_HTTP_PREWARM), name="llm-http-prewarm", daemon=True
+    ).start()
+
+
+class _AsyncResponse:
+    """AsyncProviderClient のレスポンス。本文は read()（まとめて）か iter_chunks()（届いた順）で読む"""
+
+    def __init__(self, reader, status, reason, headers, timeout):
+        self._reader = reader
+        self._timeout = timeout
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._chunked = "chunked" in (headers.get("Transfer-Encoding") or "").lower()
+        length = headers.get("Content-Length")
+        self._remaining = None if self._chunked or length is None else int(length)
+        if status in (204, 304):
+            self._remaining = 0
+        self.will_close = (headers.get("Connection") or "").lower() == "close" or (
+            not self._chunked and self._remaining is None
+        )
+        self.finished = False  # 本文を最後まで読んだか（読み切った接続だけ再利用できる）
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self._timeout)
+
+    async def iter_chunks(self):
+        """本文を届いた順に bytes で返す（chunked は解いて返す）"""
+        if self.finished:
+            return
+        if self._chunked:
+            while True:
+                size_line = await self._read(self._reader.readline())
+                if not size_line:
+                    raise ConnectionResetError("本文の途中で接続が切れました")
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+                if size == 0:
+                    while (await self._read(self._reader.readline())) not in (b"\r\n", b"\n", b""):
+                        pass  # trailer は読み捨てる
+                    break
+                data = await self._read(self._reader.readexactly(size))
+                await self._read(self._reader.readexactly(2))
+                yield data
+        elif self._remaining is not None:
+            while self._remaining > 0:
+                data = await self._read(self._reader.read(min(self._remaining, 65536)))
+                if not data:
+                    raise ConnectionResetError("本文の途中で接続が切れました")
+                self._remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await self._read(self._reader.read(65536))
+                if not data:
+                    break
+                yield data
+        self.finished = True
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+
+class AsyncProviderClient:
+    """
+    ProviderHttpClient の asyncio 版。1つのイベントループの中で、スレッドを使わずに多数の LLM 呼び出しを同時に待てる。
+    接続はホストごとにプールして keep-alive で使い回す。接続は張ったループでしか使えないので、プールはイベントループごとに持ち
+    （ASGI のループと _run_async のループを行き来しても捨てない）、ループが終わるときにそのループの接続を閉じる。
+    統計は複数のスレッド・ループから更新されるのでロックを取る。
+    エラー応答（4xx/5xx）は同期版と同じく urllib.error.HTTPError を送出する。
+    """
+
+    _STALE_ERRORS = (ConnectionError, asyncio.IncompleteReadError)
+
+    def __init__(self, pool_size=8, idle_timeout=60.0, timeout=180.0):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pools = {}  # イベントループ -> {host -> deque[((reader, writer), 返却時刻)]}
+        self._closers = {}  # イベントループ -> ループの終了時にプールを閉じるタスク
+        self._ssl_context = ssl.create_default_context()
+        self._stats = {
+            "requests": 0, "connections_opened": 0, "connections_reused": 0,
+            "stale_retries": 0, "connect_sec": 0.0, "request_sec": 0.0,
+            "in_flight": 0, "max_in_flight": 0,
+        }
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _pool(self):
+        """実行中のイベントループのプール（host -> deque）。初めてのループなら作り、終了時に閉じるタスクを仕掛ける"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pool = self._pools.get(loop)
+            if pool is None:
+                pool = self._pools[loop] = {}
+                self._closers[loop] = loop.create_task(self._close_on_shutdown(loop, pool))
+        return pool
+
+    async def _close_on_shutdown(self, loop, pool):
+        """ループが止まるまで待ち、止まるとき（asyncio.run の終わりに残りのタスクとしてキャンセルされる）にプールの接続を閉じる"""
+        try:
+            await loop.create_future()
+        except asyncio.CancelledError:
+            with self._lock:
+                self._pools.pop(loop, None)
+                self._closers.pop(loop, None)
+            # ループはこの後すぐ止まるので、TLS の終了手順（相手の応答待ち）はせずに切る
+            for idle in pool.values():
+                for (_, writer), _ in idle:
+                    writer.transport.abort()
+            pool.clear()
+            raise
+
+    async def aclose(self):
+        """実行中のループのプールを閉じる（asyncio.run を使わず動かし続けるループを、止める前に片付けるとき用）"""
+        with self._lock:
+            closer = self._closers.get(asyncio.get_running_loop())
+        if closer is not None:
+            closer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await closer
+
+    async def _open_tunnel(self, host, proxy_host, proxy_port, proxy_headers):
+        """プロキシへ CONNECT でトンネルを張り、その中で host と TLS を始める"""
+        reader, writer = await asyncio.open_connection(proxy_host, proxy_port)
+        try:
+            target = host if ":" in host else host + ":443"
+            lines = [f"CONNECT {target} HTTP/1.1", f"Host: {target}"]
+            lines.extend(f"{k}: {v}" for k, v in proxy_headers.items())
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            await writer.drain()
+            status_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if status_line.split(b" ", 2)[1:2] != [b"200"]:
+                raise OSError(f"プロキシのトンネルを張れませんでした: {status_line.decode('latin-1').strip()}")
+            await writer.start_tls(self._ssl_context, server_hostname=host.rsplit(":", 1)[0])
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _new_connection(self, host):
+        started = time.perf_counter()
+        proxy = _https_proxy_for(host)
+        try:
+            if proxy:
+                opening = self._open_tunnel(host, *proxy)
+            else:
+                opening = asyncio.open_connection(host, 443, ssl=self._ssl_context, server_hostname=host)
+            conn = await asyncio.wait_for(opening, self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise urllib.error.URLError(e) from e  # 同期版と同じく、接続できなかったときは URLError
+        self._count("connect_sec", time.perf_counter() - started)
+        self._count("connections_opened")
+        return conn
+
+    async def _acquire(self, host):
+        """(接続, 再利用かどうか) を返す。待機中の接続が無ければ新規に張る"""
+        idle = self._pool().get(host)
+        now = time.monotonic()
+        while idle:
+            conn, released_at = idle.pop()
+            if now - released_at < self.idle_timeout and not conn[0].at_eof():
+                return conn, True
+            conn[1].close()
+        return await self._new_connection(host), False
+
+    def _release(self, host, conn):
+        idle = self._pool().setdefault(host, collections.deque())
+        if len(idle) < self.pool_size:
+            idle.append((conn, time.monotonic()))
+        else:
+            conn[1].close()
+
+    async def prewarm(self, hosts, count=1):
+        """各ホストへ count 本の接続を張ってプールに入れておく（失敗しても無視）"""
+        for host in hosts:
+            for _ in range(count):
+                try:
+                    self._release(host, await self._new_connection(host))
+                except (OSError, asyncio.TimeoutError) as e:
+                    print(f"[http] {host} への事前接続に失敗: {e}", flush=True)
+                    break
+
+    async def _send(self, method, url, body, headers):
+        """リクエストを送ってレスポンスヘッダーまで受け取り (ホスト, 接続, レスポンス) を返す"""
+        parts = urllib.parse.urlsplit(url)
+        host = parts.netloc
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host}", "Accept-Encoding: identity"]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        lines.extend(f"{k}: {v}" for k, v in (headers or {}).items())
+        payload = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+        started = time.perf_counter()
+        for attempt in range(2):
+            conn, reused = await self._acquire(host)
+            reader, writer = conn
+            try:
+                writer.write(payload)
+                await writer.drain()
+                status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not status_line:
+                    raise ConnectionResetError("接続が閉じられていました")
+                header_lines = []
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.timeout)
+                    header_lines.append(line)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+            except self._STALE_ERRORS:
+                writer.close()
+                if reused and attempt == 0:
+                    self._count("stale_retries")
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if reused:
+                self._count("connections_reused")
+            self._count("requests")
+            self._count("request_sec", time.perf_counter() - started)
+            _, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+            res_headers = http.client.parse_headers(io.BytesIO(b"".join(header_lines)))
+            return host, conn, _AsyncResponse(reader, int(status), reason, res_headers, self.timeout)
+
+    def _finish(self, host, conn, res):
+        """本文を読み切ったレスポンスの接続はプールへ返し、途中なら閉じる"""
+        if res.finished and not res.will_close:
+            self._release(host, conn)
+        else:
+            conn[1].close()
+
+    @contextlib.asynccontextmanager
+    async def _in_flight(self):
+        with self._lock:
+            st = self._stats
+            st["in_flight"] += 1
+            st["max_in_flight"] = max(st["max_in_flight"], st["in_flight"])
+        try:
+            yield
+        finally:
+            self._count("in_flight", -1)
+
+    async def _raise_for_status(self, url, host, conn, res):
+        if res.status >= 400:
+            try:
+                data = await res.read()
+            finally:
+                self._finish(host, conn, res)
+            raise urllib.error.HTTPError(url, res.status, res.reason, res.headers, io.BytesIO(data))
+
+    async def request(self, method, url, body=None, headers=None):
+        """リクエストを送り (ステータス, レスポンスヘッダー, 本文 bytes) を返す。4xx/5xx は urllib.error.HTTPError"""
+        async with self._in_flight():
+            host, conn, res = await self._send(method, url, body, headers)
+            await self._raise_for_status(url, host, conn, res)
+            try:
+                data = await res.read()
+            finally:
+                self._finish(host, conn, res)
+            return res.status, res.headers, data
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, body=None, headers=None):
+        """本文を読まずにレスポンスを返す（async with を抜けた時点で読み切っていれば接続を再利用する）"""
+        async with self._in_flight():
+            host, conn, res = await self._send(method, url, body, headers)
+            await self._raise_for_status(url, host, conn, res)
+            try:
+                yield res
+            finally:
+                self._finish(host, conn, res)
+
+    def stats(self):
+        """接続の新規作成数・再利用数・同時に待っている呼び出し数（最大値つき）などを返す"""
+        with self._lock:
+            st = dict(self._stats)
+            idle = collections.Counter()
+            for pool in self._pools.values():
+                for host, conns in list(pool.items()):
+                    idle[host] += len(conns)
+        attempts = st["connections_opened"] + st["connections_reused"]
+        return {
+            "requests": st["requests"],
+            "connections_opened": st["connections_opened"],
+            "connections_reused": st["connections_reused"],
+            "reuse_ratio": round(st["connections_reused"] / attempts, 3) if attempts else 0.0,
+            "stale_retries": st["stale_retries"],
+            "avg_connect_ms": round(st["connect_sec"] * 1000 / st["connections_opened"], 1) if st["connections_opened"] else None,
+            "avg_response_header_ms": round(st["request_sec"] * 1000 / st["requests"], 1) if st["requests"] else None,
+            "in_flight": st["in_flight"],
+            "max_in_flight": st["max_in_flight"],
+            "idle_connections": dict(idle),
+            "event_loops": len(self._pools),
+        }
+
+
+allm_http = AsyncProviderClient(LLM_HTTP_POOL_SIZE, LLM_HTTP_IDLE_TIMEOUT, LLM_HTTP_TIMEOUT)
+
+
+# LLM 応答のディスクキャッシュ（同じプリセット・コンテキスト・質問の繰り返しや、同じ URL の再抽出で API を呼ばないため）
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE", "1") != "0"
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "sales-proposal-app", "llm")
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", str(24 * 3600)))  # 秒
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_MB", "64")) * 1024 * 1024
+LLM_TEMPERATURE = 0.7
+
+
+class LlmResponseCache(DiskLruCache):
+    """
+    LLM の応答を (プロバイダー, モデル, messages, temperature) の正規化ハッシュで保存するディスクキャッシュ。
+    1件1ファイルの JSON。容量を超えたら最近使われていない順に消し、作成から ttl 秒を過ぎたものは使わない。
+    """
+
+    suffix = ".json"
+
+    def __init__(self, cache_dir, ttl, max_bytes):
+        super().__init__(cache_dir, max_bytes, ("hits", "misses", "expired"))
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(provider, model, messages, temperature):
+        canonical = json.dumps(
+            {
+                "provider": provider,
+                "model": model,
+                "messages": [{"role": m.get("role"), "content": m.get("content")} for m in messages],
+                "temperature": temperature,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        """保存済みの {"reply", "usage", ...} を返す。無い・期限切れなら None"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            self._count("expired")
+            self._count("misses")
+            return None
+        self._touch(path)
+        self._count("hits")
+        return entry
+
+    def put(self, key, provider, model, reply, usage):
+        data = json.dumps(
+            {"provider": provider, "model": model, "reply": reply, "usage": usage or {}, "created": time.time()},
+            ensure_ascii=False,
+        ).encode("utf-8")
+        self._write(self._path(key), data)
+
+    def stats(self):
+        st = super().stats()
+        lookups = st["hits"] + st["misses"]
+        return {
+            "enabled": LLM_CACHE_ENABLED,
+            **st,
+            "hit_ratio": round(st["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+
+llm_cache = LlmResponseCache(LLM_CACHE_DIR, LLM_CACHE_TTL, LLM_CACHE_MAX_BYTES)
+
+
+def _cached_reply(provider, model, messages, use_cache):
+    """応答キャッシュを引いて (キー, (本文, 利用量) or None) を返す。使わない設定ならキーも None"""
+    if not (use_cache and LLM_CACHE_ENABLED):
+        return None, None
+    key = LlmResponseCache.make_key(provider, model, messages, LLM_TEMPERATURE)
+    entry = llm_cache.get(key)
+    if entry is None:
+        return key, None
+    # API を呼んでいないので課金対象のトークンは 0。代わりに節約できたトークン数を付ける
+    saved = (entry.get("usage") or {}).get("total_tokens") or 0
+    usage = {
+        "input_tokens": 0, "output_tokens": 0, "total_tokens": 0, "cached_tokens": 0,
+        "response_cache": "hit", "saved_tokens": saved,
+    }
+    return key, (entry.get("reply") or "", usage)
+
+
+def _store_reply(key, provider, model, reply, usage):
+    if key and reply:
+        llm_cache.put(key, provider, model, reply, usage)
+
+
+async def _acached_reply(provider, model, messages, use_cache):
+    """_cached_reply の async 版（キャッシュファイルの読み出しでイベントループを止めないようスレッドで引く）"""
+    if not (use_cache and LLM_CACHE_ENABLED):
+        return None, None
+    return await asyncio.to_thread(_cached_reply, provider, model, messages, use_cache)
+
+
+async def _astore_reply(key, provider, model, reply, usage):
+    """_store_reply の async 版（書き込みと容量超過分の削除はスレッドで行う）"""
+    if key and reply:
+        await asyncio.to_thread(_store_reply, key, provider, model, reply, usage)
+
+
+# モデルごとの RPM（1分あたりリクエスト数）・TPM（1分あたりトークン数）の上限（モデル名の前方一致）。
+# 上限はアカウントの Tier で大きく違うので、環境変数 LLM_RATE_LIMITS="gpt-4o-mini=500:200000,gemini-=1000:1000000" を
+# 設定したモデルだけ手元で整形する。設定の無いモデルは上限なしで送り、429 の Retry-After だけを守る
+LLM_UNLIMITED_RATE = (10 ** 9, 10 ** 12)  # 実質上限なし（429 のときの一時停止にだけバケツを使う）
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "0.5"))  # 秒。リトライごとに倍（ジッターあり）
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "30"))
+LLM_EXPECTED_OUTPUT_TOKENS = 500  # 送信前の見積もりに足す出力トークン数（応答後に実際の利用量で精算する）
+# リトライする HTTP ステータス（レート制限・一時的なサーバーエラー）と通信エラー
+LLM_RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+LLM_RETRY_ERRORS = (ConnectionError, TimeoutError, asyncio.TimeoutError, http.client.IncompleteRead)
+
+
+def _parse_rate_limits(value):
+    limits = []
+    for item in (value or "").split(","):
+        prefix, _, numbers = item.strip().partition("=")
+        rpm, _, tpm = numbers.partition(":")
+        if prefix and rpm.strip().isdigit() and tpm.strip().isdigit():
+            limits.append((prefix.strip().lower(), int(rpm), int(tpm)))
+    return tuple(limits)
+
+
+class TokenBucket:
+    """
+    容量 capacity、毎秒 rate ずつ回復するトークンバケツ。
+    reserve は先に量を引いてから「足りるまでの待ち秒数」を返す予約制なので、待つ側はロックを持たずに sleep できる。
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)  # 容量を超える1回分は、満タンになるまで待てば通す
+        return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount, now):
+        """予約した量と実際の量の差を精算する（amount が正なら追加で引く、負なら返す）"""
+        self._refill(now)
+        self.level -= amount
+
+    def block_for(self, seconds, now):
+        """サーバーから待てと言われたとき、seconds 秒後まで空にしておく"""
+        self._refill(now)
+        self.level = min(self.level, -seconds * self.rate)
+
+
+class ProviderScheduler:
+    """
+    LLM 呼び出しをモデルごとの RPM / TPM のトークンバケツで整形し、429・5xx は Retry-After を守ってリトライする。
+    送信前に messages から見積もったトークン数を予約し、応答の利用量（usage）で差額を精算する。
+    """
+
+    def __init__(self, limits, default_limit):
+        self.limits = limits
+        self.default_limit = default_limit
+        self._lock = threading.Lock()
+        self._buckets = {}  # model -> (リクエスト数のバケツ, トークン数のバケツ)
+        self._stats = {}
+
+    def _limit_for(self, model):
+        model = (model or "").lower()
+        for prefix, rpm, tpm in self.limits:
+            if model.startswith(prefix):
+                return rpm, tpm
+        return self.default_limit
+
+    def _entry(self, model):
+        if model not in self._buckets:
+            rpm, tpm = self._limit_for(model)
+            self._buckets[model] = (TokenBucket(rpm, rpm / 60.0), TokenBucket(tpm, tpm / 60.0))
+            self._stats[model] = {
+                "requests": 0, "throttled": 0, "wait_sec": 0.0, "retries": 0,
+                "rate_limited": 0, "server_errors": 0, "network_errors": 0, "gave_up": 0,
+                "reserved_tokens": 0, "actual_tokens": 0,
+            }
+        return self._buckets[model], self._stats[model]
+
+    def reserve(self, model, est_tokens):
+        """1回分の枠を予約し、送信してよくなるまでの待ち秒数を返す"""
+        now = time.monotonic()
+        with self._lock:
+            (requests, tokens), st = self._entry(model)
+            wait = max(requests.reserve(1, now), tokens.reserve(est_tokens, now))
+            st["requests"] += 1
+            st["reserved_tokens"] += est_tokens
+            if wait > 0:
+                st["throttled"] += 1
+                st["wait_sec"] += wait
+        return wait
+
+    def settle(self, model, est_tokens, usage):
+        """応答の利用量で予約との差額を精算する（利用量が取れなかったら見積もりのまま）"""
+        actual = (usage or {}).get("total_tokens") or 0
+        if not actual:
+            return
+        now = time.monotonic()
+        with self._lock:
+            (_, tokens), st = self._entry(model)
+            tokens.adjust(actual - est_tokens, now)
+            st["actual_tokens"] += actual
+
+    def refund(self, model, est_tokens):
+        """失敗して処理されなかったリクエストの予約トークンを返す"""
+        with self._lock:
+            (_, tokens), st = self._entry(model)
+            tokens.adjust(-est_tokens, time.monotonic())
+            st["reserved_tokens"] -= est_tokens
+
+    def retry_delay(self, model, attempt, error):
+        """
+        リトライすべきエラーなら待ち秒数を、そうでなければ None を返す。
+        Retry-After（または Gemini の retryDelay）があればそれを守り、無ければ指数バックオフ（フルジッター）
+        """
+        if isinstance(error, urllib.error.HTTPError):
+            if error.code not in LLM_RETRY_STATUSES:
+                return None
+            key = "rate_limited" if error.code == 429 else "server_errors"
+        elif isinstance(error, LLM_RETRY_ERRORS) or (
+            isinstance(error, urllib.error.URLError) and isinstance(error.reason, LLM_RETRY_ERRORS)
+        ):
+            key = "network_errors"
+        else:
+            return None
+        with self._lock:
+            (requests, tokens), st = self._entry(model)
+            st[key] += 1
+            if attempt >= LLM_MAX_RETRIES:
+                st["gave_up"] += 1
+                return None
+            st["retries"] += 1
+        retry_after = _retry_after_seconds(error) if isinstance(error, urllib.error.HTTPError) else None
+        if retry_after is None:
+            return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+        retry_after = min(LLM_BACKOFF_MAX, retry_after)
+        if key != "rate_limited":
+            return retry_after + random.uniform(0, LLM_BACKOFF_BASE)
+        # 同じモデルへの他のリクエストも、指定の時間までは送らない。
+        # 待つのは次の reserve（バケツが空いてから）なので、ここではジッターだけ返す（二重に待たない）
+        with self._lock:
+            now = time.monotonic()
+            requests.block_for(retry_after, now)
+            tokens.block_for(retry_after, now)
+        return random.uniform(0, LLM_BACKOFF_BASE)
+
+    def stats(self):
+        with self._lock:
+            stats = {model: dict(st) for model, st in self._stats.items()}
+            limits = {model: (b[0].capacity, b[1].capacity) for model, b in self._buckets.items()}
+        for model, st in stats.items():
+            st["wait_sec"] = round(st["wait_sec"], 3)
+            st["rpm_limit"], st["tpm_limit"] = (int(v) if v < LLM_UNLIMITED_RATE[0] else None for v in limits[model])
+        return stats
+
+
+def _retry_after_seconds(error):
+    """429/503 応答の Retry-After（秒・日時）、retry-after-ms、Gemini 本文の retryDelay から待ち秒数を読む"""
+    headers = error.headers
+    if headers is not None:
+        ms = headers.get("retry-after-ms")
+        if ms:
+            with contextlib.suppress(ValueError):
+                return max(0.0, float(ms) / 1000)
+        value = headers.get("Retry-After")
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                with contextlib.suppress(TypeError, ValueError):
+                    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    try:
+        body = error.read()
+        error.fp.seek(0)  # 呼び出し元がエラー本文を読めるように戻す
+    except (AttributeError, OSError, ValueError):
+        return None
+    m = re.search(rb'"retryDelay"\s*:\s*"([\d.]+)s"', body or b"")
+    return float(m.group(1)) if m else None
+
+
+llm_scheduler = ProviderScheduler(_parse_rate_limits(os.environ.get("LLM_RATE_LIMITS")), LLM_UNLIMITED_RATE)
+
+
+def _call_with_retries(model, est_tokens, send):
+    """レート枠を待ってから send() を呼び、429・5xx・通信エラーはバックオフしてやり直す"""
+    attempt = 0
+    while True:
+        wait = llm_scheduler.reserve(model, est_tokens)
+        if wait:
+            time.sleep(wait)
+        try:
+            return send()
+        except Exception as e:
+            llm_scheduler.refund(model, est_tokens)
+            delay = llm_scheduler.retry_delay(model, attempt, e)
+            if delay is None:
+                raise
+        time.sleep(delay)
+        attempt += 1
+
+
+async def _acall_with_retries(model, est_tokens, send):
+    """_call_with_retries の async 版（send は awaitable を返す関数）"""
+    attempt = 0
+    while True:
+        wait = llm_scheduler.reserve(model, est_tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        try:
+            return await send()
+        except Exception as e:
+            llm_scheduler.refund(model, est_tokens)
+            delay = llm_scheduler.retry_delay(model, attempt, e)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+# スクレイピング（各アプリはサイトごとのパーサー・ページ取得・AI 抽出のリクエストを ScrapePipeline に渡す）
+# domain: URL に含まれていればこのサイト / parse_listing: 一覧HTML → 一覧ブロックのリスト（不要なら None）
+# parse_row: (詳細HTML, 同じ順の一覧ブロック) → CSV の1行（出さないなら None）
+ScrapeSite = collections.namedtuple("ScrapeSite", "domain header parse_listing parse_row")
+SCRAPE_LLM_MODEL = "gpt-4o-mini"  # AI 抽出に使うモデル
+
+
+def _detail_chunk_index(label, default):
+    """「[詳細ページ N] URL」のラベルから詳細ページの URL の番号（0 始まり）を取り出す"""
+    m = re.match(r"\[詳細ページ (\d+)\]", label)
+    return int(m.group(1)) - 1 if m else default
+
+
+def _scrape_result_from_reply(csv_content):
+    """AI の応答からコードブロックの囲みを外し、/api/scrape の (JSON, ステータス) にする"""
+    csv_content = (csv_content or "").strip()
+    for prefix in ("```csv", "```CSV", "```"):
+        if csv_content.startswith(prefix):
+            csv_content = csv_content[len(prefix):].lstrip("\r\n")
+            break
+    if csv_content.endswith("```"):
+        csv_content = csv_content[:-3].rstrip("\r\n")
+    if not csv_content:
+        return {"error": "抽出結果が空でした"}, 500
+    return {"csv": csv_content}, 200
+
+
+
+# /api/scrape の stream: "csv" / "ndjson"。プログラムでパースできるサイトは、詳細ページを取得・パースできるたびに1行ずつ返す
+SCRAPE_STREAM_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson; charset=utf-8"}
+SCRAPE_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+SCRAPE_STREAM_BUFFER_ROWS = 32  # クライアントに送れていない行をこれ以上溜めない（溜まったら詳細ページの取得を待たせる）
+
+
+class _ScrapeRowQueue:
+    """
+    ScrapePipeline.row_stream でのページ取得の observer。詳細ページが届くたびに CSV の行にしてキューに入れる。
+    キューが一杯（クライアントの読み出しが遅い）ならクロールのスレッドを待たせ、その間に切断されたら行を捨てて戻る
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self.list_rows = []
+        # ("row", URL, 行) … 最後に ("end", エラーメッセージか None, 一覧ページのチャンク)
+        self.rows = queue.Queue(maxsize=SCRAPE_STREAM_BUFFER_ROWS)
+        self.cancel = threading.Event()
+        # 1行も取れないうちは詳細ページを持っておき、AI 抽出に切り替えるときに使う（1行取れたら捨てる）
+        self.held = []
+
+    def listing_fetched(self, html):
+        if self.site.parse_listing:
+            self.list_rows.extend(self.site.parse_listing(html))
+
+    def details_found(self, urls):
+        pass
+
+    def detail_fetched(self, index, url, html):
+        if html is None:
+            return
+        row = self.site.parse_row(html, self.list_rows[index] if index < len(self.list_rows) else {})
+        if row is not None:
+            self.held = None
+            self.put(("row", url, row))
+        elif self.held is not None:
+            self.held.append(("[詳細ページ " + str(index + 1) + "] " + url + "\n", html))
+
+    def put(self, item):
+        """キューに空きができるまで待って入れる。待っている間に cancel が立ったら入れずに戻る"""
+        while not self.cancel.is_set():
+            try:
+                self.rows.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+
+
+class ScrapePipeline:
+    """
+    /api/scrape（stream あり・なし）とスクレイピングジョブに共通の流れ。アプリごとに違うところは関数で受け取る。
+    sites: プログラムでパースできるサイト（ScrapeSite のタプル） / csv_line: 値のリスト → CSV の1行 /
+    fetch_pages: 一覧・詳細ページの取得（_fetch_pages_for_scrape） / scrape_params・prepare_scrape・llm_request:
+    入力の読み取りと AI 抽出のリクエストの組み立て / call_llm・acall_llm: (messages, api_key, model, use_cache) で
+    (本文, 利用量) を返す LLM の呼び出し（同期・async）
+    """
+
+    def __init__(self, sites, csv_line, fetch_pages, scrape_params, prepare_scrape, llm_request, call_llm, acall_llm):
+        self.sites = sites
+        self.csv_line = csv_line
+        self.fetch_pages = fetch_pages
+        self.scrape_params = scrape_params
+        self.prepare_scrape = prepare_scrape
+        self.llm_request = llm_request
+        self.call_llm = call_llm
+        self.acall_llm = acall_llm
+
+    def site(self, url):
+        """URL がプログラムでパースできるサイトならその ScrapeSite、そうでなければ None"""
+        url = (url or "").lower()
+        return next((site for site in self.sites if site.domain in url), None)
+
+    def stream_line(self, fmt, header, row, url=None):
+        if fmt == "csv":
+            return self.csv_line(row) + "\r\n"
+        item = dict(zip(header, row))
+        if url:
+            item["url"] = url
+        return json.dumps(item, ensure_ascii=False) + "\n"
+
+    def row_stream(self, params, fmt):
+        """
+        プログラムでパースできるサイトのスクレイピング結果を、できた行から返すジェネレーター。
+        クロールはスレッドで始め、最初の行ができるか取得が終わるまで待つ。
+        最初の行ができたら (チャンクのジェネレーター, None, None) を返す。CSV はヘッダーとその行から始まり、
+        続けて詳細ページを取得・パースできた順に1行ずつ返す（NDJSON は1行1オブジェクトで url 付き）。
+        1行も取れずに終わったら prepare_scrape と同じく (None, (JSON, ステータス), None) か
+        AI 抽出のリクエスト (None, None, (messages, api_key)) を返す。
+        詳細ページの HTML は行にしたら捨てるので、結果全体をメモリに持たない。途中で切断されたら残りの取得をやめる
+        """
+        observer = _ScrapeRowQueue(self.site(params["url"]))
+
+        def run():
+            chunks = []
+            try:
+                chunks, err = self.fetch_pages(
+                    params["url"],
+                    follow_details=params["follow_details"],
+                    max_detail_pages=params["max_detail_pages"],
+                    follow_pages=params["follow_pages"],
+                    max_pages=params["max_pages"],
+                    observer=observer,
+                    keep_details=False,
+                )
+            except Exception as e:
+                err = f"抽出エラー: {str(e)}"
+            observer.put(("end", err, chunks))
+
+        threading.Thread(target=run, daemon=True).start()
+        kind, value, extra = observer.rows.get()
+        if kind == "row":
+            return self._row_chunks(observer, fmt, value, extra), None, None
+        chunks = extra + sorted(observer.held or [], key=lambda c: _detail_chunk_index(c[0], 0))
+        if value and not chunks:
+            return None, ({"error": value}, 500), None
+        result, llm_request = self.llm_request(params, chunks)
+        return None, result, llm_request
+
+    def _row_chunks(self, observer, fmt, url, row):
+        """row_stream の続き。最初の行 (url, row) から、クロールが終わるまで1行ずつ返す"""
+        header = observer.site.header
+        try:
+            if fmt == "csv":
+                yield self.csv_line(header) + "\r\n"
+            yield self.stream_line(fmt, header, row, url)
+            while True:
+                kind, value, row = observer.rows.get()
+                if kind == "end":
+                    # 応答はもう始まっていて、CSV には書く場所が無いので、エラーは NDJSON のときだけ最後の行で知らせる
+                    if value and fmt == "ndjson":
+                        yield json.dumps({"error": value}, ensure_ascii=False) + "\n"
+                    return
+                yield self.stream_line(fmt, header, row, value)
+        finally:
+            observer.cancel.set()
+
+    def csv_stream(self, csv_text, fmt):
+        """AI で抽出した CSV 全体を、stream の形式（CSV / NDJSON）のチャンクにする"""
+        if fmt == "csv":
+            yield csv_text.rstrip("\r\n") + "\r\n"
+            return
+        rows = list(csv.reader(io.StringIO(csv_text)))
+        for row in rows[1:]:
+            yield self.stream_line(fmt, rows[0], row)
+
+    def stream_start(self, data):
+        """
+        /api/scrape の stream の受け付け。行ができるたびに返せるサイトは (チャンクのジェネレーター, None, None)、
+        それ以外は prepare_scrape と同じく (None, (JSON, ステータス), None) か (None, None, (messages, api_key)) を返す
+        """
+        fmt = data.get("stream")
+        if fmt not in SCRAPE_STREAM_TYPES:
+            return None, ({"error": "stream には csv か ndjson を指定してください"}, 400), None
+        params, error = self.scrape_params(data)
+        if error:
+            return None, error, None
+        if self.site(params["url"]):
+            return self.row_stream(params, fmt)
+        return (None,) + self.prepare_scrape(data)
+
+    def extract(self, llm_request, use_cache):
+        """AI 抽出のリクエスト (messages, api_key) を送り、/api/scrape の (JSON, ステータス) を返す"""
+        messages, api_key = llm_request
+        try:
+            csv_content, _ = self.call_llm(messages, api_key, model=SCRAPE_LLM_MODEL, use_cache=use_cache)
+            return _scrape_result_from_reply(csv_content)
+        except urllib.error.HTTPError as e:
+            err_body = e.read().decode("utf-8", errors="replace")
+            return {"error": f"APIエラー: {err_body}"}, 500
+        except Exception as e:
+            return {"error": f"抽出エラー: {str(e)}"}, 500
+
+    async def aextract(self, llm_request, use_cache):
+        """extract の async 版"""
+        messages, api_key = llm_request
+        try:
+            csv_content, _ = await self.acall_llm(messages, api_key, model=SCRAPE_LLM_MODEL, use_cache=use_cache)
+            return _scrape_result_from_reply(csv_content)
+        except urllib.error.HTTPError as e:
+            err_body = e.read().decode("utf-8", errors="replace")
+            return {"error": f"APIエラー: {err_body}"}, 500
+        except Exception as e:
+            return {"error": f"抽出エラー: {str(e)}"}, 500
+
+    def respond(self, data):
+        """
+        /api/scrape の本体。stream: "csv" / "ndjson" で結果があれば (チャンクのジェネレーター, None)、
+        それ以外は (None, (JSON, ステータス)) を返す
+        """
+        fmt = data.get("stream")
+        if fmt:
+            chunks, result, llm_request = self.stream_start(data)
+            if chunks:
+                return chunks, None
+        else:
+            result, llm_request = self.prepare_scrape(data)
+        payload, status = result or self.extract(llm_request, not data.get("no_cache"))
+        if fmt and status == 200:
+            return self.csv_stream(payload["csv"], fmt), None
+        return None, (payload, status)
+
+    async def asgi(self, data, send):
+        """/api/scrape の async 版（ページ取得はスレッドで行い、AI 抽出の待ちだけを asyncio にする）"""
+        data = data or {}
+        fmt = data.get("stream")
+        loop = asyncio.get_running_loop()
+        try:
+            if fmt:
+                chunks, result, llm_request = await loop.run_in_executor(None, self.stream_start, data)
+            else:
+                chunks = None
+                result, llm_request = await loop.run_in_executor(None, self.prepare_scrape, data)
+        except Exception as e:
+            return await _asgi_send_json(send, {"error": f"抽出エラー: {str(e)}"}, 500)
+        if chunks:
+            return await _asgi_send_chunks(send, SCRAPE_STREAM_TYPES[fmt], chunks)
+        payload, status = result or await self.aextract(llm_request, not data.get("no_cache"))
+        if fmt and status == 200:
+            return await _asgi_send_chunks(send, SCRAPE_STREAM_TYPES[fmt], self.csv_stream(payload["csv"], fmt))
+        await _asgi_send_json(send, payload, status)
+
+
+# 非同期のスクレイピングジョブ（/api/scrape/jobs）。取得・パース・AI 抽出をワーカースレッドで行い、進み具合と途中までの CSV を
+# ポーリングで返すので、HTTP リクエストの時間制限で詳細ページの件数が決まらない。
+# ジョブはプロセス内に持つ（gunicorn で動かすときはワーカー1つ・スレッド複数にする）。
+# Vercel などのサーバーレスでは応答を返すとスレッドが止まり、次のポーリングが別インスタンスに届くので既定で無効にする
+# （無効のときは 501 を返し、画面は /api/scrape で1回のリクエストとして実行する）
+SCRAPE_JOBS_ENABLED = os.environ.get("SCRAPE_JOBS", "0" if os.environ.get("VERCEL") else "1").lower() in ("1", "true", "yes")
+SCRAPE_JOB_WORKERS = int(os.environ.get("SCRAPE_JOB_WORKERS", "2"))
+SCRAPE_JOB_MAX_PENDING = int(os.environ.get("SCRAPE_JOB_MAX_PENDING", "20"))  # 待ち・実行中のジョブの上限
+SCRAPE_JOB_TTL = int(os.environ.get("SCRAPE_JOB_TTL", "3600"))  # 終わったジョブを残す秒数
+
+
+class ScrapeJob:
+    """
+    スクレイピングジョブ1件の状態。ページ取得（pipeline.fetch_pages）の observer として進み具合を受け取り、
+    プログラムでパースできるサイトは詳細ページが届くたびに CSV の行にしておく
+    """
+
+    def __init__(self, params, pipeline):
+        self.id = secrets.token_urlsafe(12)
+        self.params = params
+        self.pipeline = pipeline
+        self.site = pipeline.site(params["url"])
+        self.state = "queued"  # queued → running → done / failed / cancelled
+        self.started = None
+        self.finished = None
+        self.listing_pages = 0
+        self.detail_total = None
+        self.detail_done = 0
+        self.detail_failed = 0
+        self.details_started = None
+        self.list_rows = []
+        self.rows = {}  # 詳細ページの番号 -> CSV の1行
+        self.csv = None
+        self.error = None
+        self.cancel = threading.Event()
+        self.future = None
+        self._lock = threading.Lock()
+
+    def listing_fetched(self, html):
+        rows = self.site.parse_listing(html) if self.site and self.site.parse_listing else []
+        with self._lock:
+            self.listing_pages += 1
+            self.list_rows.extend(rows)
+
+    def details_found(self, urls):
+        with self._lock:
+            self.detail_total = len(urls)
+            self.details_started = time.monotonic()
+
+    def detail_fetched(self, index, url, html):
+        row = None
+        if html is not None and self.site:
+            row = self.site.parse_row(html, self.list_rows[index] if index < len(self.list_rows) else {})
+        with self._lock:
+            self.detail_done += 1
+            if html is None:
+                self.detail_failed += 1
+            if row is not None:
+                self.rows[index] = self.pipeline.csv_line(row)
+
+    def partial_csv(self):
+        """ここまでに取れた行の CSV（詳細ページの順）。プログラムでパースしないサイトや行が無いときは空文字"""
+        with self._lock:
+            lines = [self.rows[i] for i in sorted(self.rows)]
+        if not self.site or not lines:
+            return ""
+        return "\r\n".join([",".join(self.site.header)] + lines)
+
+    def snapshot(self):
+        """GET /api/scrape/jobs/<job_id> で返す内容"""
+        with self._lock:
+            done, failed, total = self.detail_done, self.detail_failed, self.detail_total
+            rows = len(self.rows)
+        eta = None
+        if self.state == "running" and total and done:
+            eta = round((time.monotonic() - self.details_started) / done * (total - done), 1)
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0.0
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "url": self.params["url"],
+            "pages_fetched": self.listing_pages + done - failed,
+            "listing_pages": self.listing_pages,
+            "detail_pages": {"total": total, "done": done, "failed": failed},
+            "rows": rows,
+            "elapsed_sec": round(elapsed, 1),
+            "eta_sec": eta,
+            "csv": self.csv if self.csv is not None else self.partial_csv(),
+            "error": self.error,
+        }
+
+
+class ScrapeJobManager:
+    """スクレイピングジョブをワーカースレッドで実行し、終わったジョブは ttl 秒だけ結果を残す"""
+
+    def __init__(self, pipeline, workers, max_pending, ttl):
+        self.pipeline = pipeline
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="scrape-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, params):
+        """ジョブを登録して返す。待ち・実行中のジョブが max_pending 件あれば None"""
+        with self._lock:
+            self._prune()
+            if sum(1 for job in self._jobs.values() if job.state in ("queued", "running")) >= self.max_pending:
+                return None
+            job = ScrapeJob(params, self.pipeline)
+            self._jobs[job.id] = job
+            job.future = self._pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """ジョブを止める。実行中なら取得中のページが終わったところで止まり、それまでの行は残る"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel.set()
+        if job.future.cancel():  # まだ始まっていなかった
+            job.state = "cancelled"
+            job.finished = time.time()
+        return job
+
+    def stats(self):
+        with self._lock:
+            states = collections.Counter(job.state for job in self._jobs.values())
+        return {"workers": self._pool._max_workers, "jobs": dict(states)}
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [job.id for job in self._jobs.values() if job.finished and now - job.finished > self.ttl]:
+            del self._jobs[job_id]
+
+    def _run(self, job):
+        job.started = time.time()
+        job.state = "running"
+        params = job.params
+        try:
+            chunks, err = self.pipeline.fetch_pages(
+                params["url"],
+                follow_details=params["follow_details"],
+                max_detail_pages=params["max_detail_pages"],
+                follow_pages=params["follow_pages"],
+                max_pages=params["max_pages"],
+                observer=job,
+            )
+            if job.cancel.is_set():
+                job.state = "cancelled"
+                return
+            if err and not chunks:
+                job.error, job.state = err, "failed"
+                return
+            payload, status = self._result(job, chunks)
+            if status == 200:
+                job.csv, job.state = payload["csv"], "done"
+            else:
+                job.error, job.state = payload["error"], "failed"
+        except Exception as e:
+            job.error, job.state = f"抽出エラー: {str(e)}", "failed"
+        finally:
+            job.finished = time.time()
+
+    def _result(self, job, chunks):
+        """取得し終えたジョブの (JSON, ステータス)。プログラムで行が取れていればそれを、取れなければ AI で抽出する"""
+        csv_text = job.partial_csv()
+        if csv_text:
+            return {"csv": csv_text}, 200
+        result, llm_request = self.pipeline.llm_request(job.params, chunks)
+        return result or self.pipeline.extract(llm_request, job.params["use_cache"])
+
+
+# ASGI の入口（uvicorn などで動かすとき。各アプリで asgi_app = make_asgi_app(app, _ASGI_ROUTES, LLM_API_HOSTS)）
+async def _asgi_send_json(send, payload, status=200):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("latin-1"))],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _asgi_send_chunks(send, content_type, chunks):
+    """同期のジェネレーターをスレッドで進めながら、できたチャンクから送る（閉じるとジェネレーター側の後始末が走る）"""
+    loop = asyncio.get_running_loop()
+    headers = [(b"content-type", content_type.encode("latin-1"))]
+    headers += [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in SCRAPE_STREAM_HEADERS.items()]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    end = object()
+    try:
+        while (chunk := await loop.run_in_executor(None, next, chunks, end)) is not end:
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+    except Exception as e:
+        # 応答はもう始まっているので JSON のエラーは返せない。ログに残してそこで打ち切る
+        print(f"[scrape stream] 途中で打ち切り: {e!r}", file=sys.stderr, flush=True)
+    finally:
+        chunks.close()
+    with contextlib.suppress(Exception):
+        await send({"type": "http.response.body", "body": b""})
+
+
+
+def _wsgi_environ(scope, body):
+    """ASGI の scope から WSGI の environ を作る"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def _run_wsgi(app, environ):
+    """Flask アプリを WSGI として呼び出し (ステータス, ヘッダー, 本文) を返す"""
+    response = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+        return chunks.append
+
+    result = app(environ, start_response)
+    try:
+        chunks.extend(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], b"".join(chunks)
+
+
+def make_asgi_app(app, routes, hosts):
+    """
+    ASGI アプリを作る。routes（(メソッド, パス) → async def handler(data, send)）は asyncio で処理し、
+    それ以外は Flask アプリ app を WSGI としてスレッドで呼ぶ。LLM_HTTP_PREWARM なら起動時に hosts への接続を張っておく
+    """
+    async def asgi_app(scope, receive, send):
+        """ASGI アプリ本体（例: uvicorn app:asgi_app --workers 2）"""
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    if LLM_HTTP_PREWARM:
+                        asyncio.get_running_loop().create_task(allm_http.prewarm(hosts, LLM_HTTP_PREWARM))
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        handler = routes.get((scope["method"], scope["path"]))
+        if handler is None:
+            status, headers, content = await asyncio.get_running_loop().run_in_executor(
+                None, _run_wsgi, app, _wsgi_environ(scope, body)
+            )
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+            })
+            await send({"type": "http.response.body", "body": content})
+            return
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            return await _asgi_send_json(send, {"error": "JSON の形式が正しくありません"}, 400)
+        await handler(data, send)
+
+    return asgi_app
@@ -0,0 +1,16 @@
+"""
+テストの共通設定。app / common を import する前に、キャッシュ・アップロード・セッションの保存先を一時ディレクトリに向ける
+（環境変数は import 時に読まれるため、ここで先に設定しておく）
+"""
+import os
+import sys
+import tempfile
+
+_TMP = tempfile.mkdtemp(prefix="sales-proposal-app-test-")
+os.environ["CONTEXT_CACHE_DIR"] = os.path.join(_TMP, "context")
+os.environ["HTTP_CACHE_DIR"] = os.path.join(_TMP, "http")
+os.environ["LLM_CACHE_DIR"] = os.path.join(_TMP, "llm")
+os.environ["UPLOAD_DIR"] = os.path.join(_TMP, "uploads")
+os.environ["SESSION_DB"] = os.path.join(_TMP, "sessions.sqlite3")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
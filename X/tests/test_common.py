@@ -0,0 +1,10 @@
+"""common.py は X と scrape-bot でデプロイのルートが違うのでコピーして使う。2つが同じ内容かを確かめる"""
+import pathlib
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+def test_scrape_bot_common_is_same_as_x():
+    assert (ROOT / "scrape-bot" / "common.py").read_bytes() == (ROOT / "common.py").read_bytes(), (
+        "scrape-bot/common.py が X/common.py と違います。X/common.py を scrape-bot/ にコピーしてください"
+    )
@@ -0,0 +1,82 @@
+"""フォルダコンテキストのチャンク分割・トークン予算・BM25 検索"""
+import types
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def char_tokens(monkeypatch):
+    """トークン数を文字数で数える（tiktoken の有無で結果が変わらないようにする）"""
+    monkeypatch.setattr(app, "estimate_tokens", len)
+
+
+def _snapshot(texts):
+    chunks = [app._make_chunk(f"doc{i}.txt", text) for i, text in enumerate(texts)]
+    return types.SimpleNamespace(chunks=chunks, index=app._build_bm25_index(chunks))
+
+
+def test_ngram_tokens_splits_japanese_into_char_bigrams():
+    assert app._ngram_tokens("営業提案 GPT-4o") == ["営業", "業提", "提案", "gpt", "4o"]
+
+
+def test_ngram_tokens_normalizes_width_and_keeps_single_chars():
+    assert app._ngram_tokens("第３期ＡＢＣ") == ["第", "3", "期", "abc"]
+
+
+def test_search_context_ranks_matching_chunk_first():
+    snapshot = _snapshot([
+        "会社概要と沿革。創業は2010年です。",
+        "料金プランは月額1万円からです。",
+        "導入事例：製造業での営業効率化。",
+    ])
+    ranked = app.search_context(snapshot, "料金はいくらですか？")
+    assert ranked[0][1].text == "料金プランは月額1万円からです。"
+    assert [chunk.doc for _, chunk in app.search_context(snapshot, "営業の事例")][:1] == ["doc2.txt"]
+
+
+def test_search_context_prefers_shorter_chunk_for_same_term():
+    snapshot = _snapshot([
+        "提案書の書き方について、背景・課題・解決策・効果・費用・スケジュールの順に詳しく説明します。",
+        "提案書のテンプレート。",
+    ])
+    ranked = app.search_context(snapshot, "提案書")
+    assert [chunk.doc for _, chunk in ranked] == ["doc1.txt", "doc0.txt"]
+    assert ranked[0][0] > ranked[1][0]
+
+
+def test_search_context_without_match_or_top_k():
+    snapshot = _snapshot(["料金プランは月額1万円からです。"])
+    assert app.search_context(snapshot, "沿革") == []
+    assert app.search_context(snapshot, "料金", top_k=0) == []
+    assert app.search_context(_snapshot([]), "料金") == []
+
+
+def test_chunk_sections_packs_sections_and_splits_on_sentences(monkeypatch, char_tokens):
+    monkeypatch.setattr(app, "CONTEXT_CHUNK_TOKENS", 12)
+    chunks = app._chunk_sections("a.txt", ["あああああ。", "", "いいいいい。", "ううううううううう。えええええええええ。"])
+    assert [chunk.text for chunk in chunks] == ["あああああ。\nいいいいい。", "ううううううううう。", "えええええええええ。"]
+    assert {chunk.doc for chunk in chunks} == {"a.txt"}
+    assert chunks[0].tokens == len(chunks[0].text)
+
+
+def test_chunk_sections_cuts_long_sentence_without_punctuation(monkeypatch, char_tokens):
+    monkeypatch.setattr(app, "CONTEXT_CHUNK_TOKENS", 12)
+    chunks = app._chunk_sections("a.txt", ["か" * 30])
+    assert [len(chunk.text) for chunk in chunks] == [12, 12, 6]
+    assert "".join(chunk.text for chunk in chunks) == "か" * 30
+
+
+def test_chunk_sections_skips_empty_input():
+    assert app._chunk_sections("a.txt", ["", "  \n"]) == []
+    assert app._chunk_sections("a.txt", None) == []
+
+
+def test_fill_token_budget_skips_chunks_that_do_not_fit():
+    chunks = [app.ContextChunk("a.txt", str(tokens), tokens, str(tokens)) for tokens in (100, 50, 10)]
+    # 1件ごとに見出し行のぶん 8 トークンを足して数える
+    assert [c.tokens for c in app.fill_token_budget(chunks, 70)] == [50]
+    assert [c.tokens for c in app.fill_token_budget(chunks, 76)] == [50, 10]
+    assert [c.tokens for c in app.fill_token_budget(chunks, 184)] == [100, 50, 10]
+    assert app.fill_token_budget(chunks, 10) == []
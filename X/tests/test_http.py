@@ -0,0 +1,160 @@
+"""HTTP 取得の土台（common.py）：Content-Encoding の展開、文字コードの判定、ディスクキャッシュの再検証"""
+import gzip
+import http.server
+import io
+import threading
+import urllib.request
+import zlib
+
+import pytest
+
+import common
+
+
+class FakeResponse:
+    def __init__(self, body, encoding=""):
+        self.headers = {"Content-Encoding": encoding}
+        self._body = io.BytesIO(body)
+
+    def read(self, n):
+        return self._body.read(n)
+
+
+def test_read_decoded_body_gzip_limits_decompressed_size():
+    data = b"x" * 200000
+    body, truncated = common.read_decoded_body(FakeResponse(gzip.compress(data), "gzip"), 1000, chunk_size=512)
+    assert (body, truncated) == (b"x" * 1000, True)
+    body, truncated = common.read_decoded_body(FakeResponse(gzip.compress(data), "gzip"), len(data))
+    assert (body, truncated) == (data, False)
+
+
+@pytest.mark.parametrize("wbits", [zlib.MAX_WBITS, -zlib.MAX_WBITS])
+def test_read_decoded_body_deflate_with_and_without_zlib_header(wbits):
+    data = "営業提案".encode("utf-8") * 100
+    compressor = zlib.compressobj(wbits=wbits)
+    raw = compressor.compress(data) + compressor.flush()
+    assert common.read_decoded_body(FakeResponse(raw, "deflate"), 10 ** 6) == (data, False)
+
+
+def test_read_decoded_body_identity():
+    assert common.read_decoded_body(FakeResponse(b"abcdef"), 4) == (b"abcd", True)
+
+
+def test_stream_decoder_rejects_unknown_encoding():
+    with pytest.raises(ValueError):
+        common._StreamDecoder("compress")
+
+
+@pytest.mark.skipif(common.brotli is None, reason="brotli 1.2 以降が入っていない")
+def test_read_decoded_body_brotli():
+    data = b"<html>" + b"y" * 100000 + b"</html>"
+    raw = common.brotli.compress(data)
+    assert "br" in common._accept_encoding()
+    assert common.read_decoded_body(FakeResponse(raw, "br"), 10 ** 6) == (data, False)
+    assert common.read_decoded_body(FakeResponse(raw, "br"), 100) == (data[:100], True)
+
+
+@pytest.mark.skipif(common.brotli is not None, reason="brotli が入っている")
+def test_brotli_is_not_accepted_without_library():
+    assert "br" not in common._accept_encoding()
+    with pytest.raises(ValueError):
+        common._StreamDecoder("br")
+
+
+@pytest.fixture
+def host_charsets(monkeypatch):
+    memo = {}
+    monkeypatch.setattr(common, "_host_charsets", memo)
+    return memo
+
+
+def test_detect_charset_order():
+    html = b'<html><head><meta charset="EUC-JP"></head></html>'
+    assert common.detect_charset(b"\xef\xbb\xbf" + html, "text/html; charset=Shift_JIS") == "utf-8-sig"
+    assert common.detect_charset(html, "text/html; charset=Shift_JIS") == "cp932"
+    assert common.detect_charset(html, "text/html") == "euc_jp"
+    assert common.detect_charset(b'<meta http-equiv="Content-Type" content="text/html; charset=x-sjis">', "") == "cp932"
+    assert common.detect_charset(b"<html></html>", "text/html; charset=unknown-charset") is None
+
+
+def test_decode_html_falls_back_to_cp932_without_remembering_it(host_charsets):
+    raw = "髙橋①".encode("cp932")
+    assert common.decode_html(raw, "text/html", "https://a.example/") == "髙橋①"
+    assert "a.example" not in host_charsets
+
+
+def test_decode_html_uses_charset_remembered_for_host(host_charsets):
+    declared = '<meta charset="euc-jp">日本語'.encode("euc_jp")
+    assert common.decode_html(declared, "text/html", "https://b.example/1") == '<meta charset="euc-jp">日本語'
+    assert host_charsets["b.example"] == "euc_jp"
+    assert common.decode_html("住所".encode("euc_jp"), "text/html", "https://b.example/2") == "住所"
+
+
+def test_decode_html_ignores_utf8_cut_in_the_middle(host_charsets):
+    raw = "日本語".encode("utf-8")[:-1]
+    assert common.decode_html(raw, "text/html", "https://c.example/") == "日本"
+    assert host_charsets["c.example"] == "utf-8"
+
+
+class _EtagHandler(http.server.BaseHTTPRequestHandler):
+    etag = '"v1"'
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        type(self).requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = gzip.compress("<html>本文</html>".encode("utf-8"))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def etag_server(monkeypatch):
+    monkeypatch.setenv("no_proxy", "127.0.0.1")
+    _EtagHandler.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _EtagHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/page"
+    server.shutdown()
+    server.server_close()
+
+
+def _get(url):
+    return urllib.request.Request(url, method="GET", headers={"Accept-Encoding": "gzip"})
+
+
+def test_http_cache_revalidates_with_etag(tmp_path, etag_server):
+    cache = common.HttpCache(str(tmp_path), 10 ** 6, 0, ())
+    first = cache.fetch(_get(etag_server), 10 ** 6, 5)
+    second = cache.fetch(_get(etag_server), 10 ** 6, 5)
+    assert first == second == ("<html>本文</html>".encode("utf-8"), "text/html; charset=utf-8")
+    assert _EtagHandler.requests == [None, '"v1"']
+    stats = cache.stats()
+    assert (stats["fetched"], stats["revalidated"], stats["hits"]) == (1, 1, 0)
+
+
+def test_http_cache_serves_fresh_entry_without_request(tmp_path, etag_server):
+    cache = common.HttpCache(str(tmp_path), 10 ** 6, 600, ())
+    cache.fetch(_get(etag_server), 10 ** 6, 5)
+    body, _ = cache.fetch(_get(etag_server), 10 ** 6, 5)
+    assert body == "<html>本文</html>".encode("utf-8")
+    assert _EtagHandler.requests == [None]
+    assert cache.stats()["hits"] == 1
+
+
+def test_http_cache_refetches_when_previous_body_was_truncated(tmp_path, etag_server):
+    cache = common.HttpCache(str(tmp_path), 10 ** 6, 600, ())
+    assert cache.fetch(_get(etag_server), 6, 5)[0] == b"<html>"
+    assert cache.fetch(_get(etag_server), 10 ** 6, 5)[0] == "<html>本文</html>".encode("utf-8")
+    assert _EtagHandler.requests == [None, None]
@@ -0,0 +1,79 @@
+"""LLM 呼び出しのレート制限（トークンバケツ・Retry-After）"""
+import email.message
+import email.utils
+import io
+import time
+import urllib.error
+
+import pytest
+
+import common
+
+
+def _http_error(code, headers=None, body=b""):
+    msg = email.message.Message()
+    for name, value in (headers or {}).items():
+        msg[name] = value
+    return urllib.error.HTTPError("https://api.openai.com/v1/chat/completions", code, "error", msg, io.BytesIO(body))
+
+
+def test_token_bucket_returns_wait_until_refilled():
+    bucket = common.TokenBucket(2, 1.0)
+    now = bucket.updated
+    assert bucket.reserve(1, now) == 0
+    assert bucket.reserve(1, now) == 0
+    assert bucket.reserve(1, now) == pytest.approx(1.0)
+    assert bucket.reserve(1, now + 1.0) == pytest.approx(1.0)
+
+
+def test_token_bucket_lets_oversized_request_through_when_full():
+    bucket = common.TokenBucket(10, 2.0)
+    now = bucket.updated
+    assert bucket.reserve(50, now) == 0
+    assert bucket.reserve(1, now) == pytest.approx(0.5)
+
+
+def test_token_bucket_adjust_and_block_for():
+    bucket = common.TokenBucket(100, 10.0)
+    now = bucket.updated
+    bucket.reserve(100, now)
+    bucket.adjust(-40, now)  # 見積もりより 40 少なかった
+    assert bucket.level == pytest.approx(40)
+    bucket.block_for(3, now)
+    assert bucket.reserve(10, now) == pytest.approx(4.0)
+
+
+def test_retry_after_seconds_from_headers():
+    assert common._retry_after_seconds(_http_error(429, {"Retry-After": "7"})) == 7.0
+    assert common._retry_after_seconds(_http_error(429, {"retry-after-ms": "1500", "Retry-After": "7"})) == 1.5
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < common._retry_after_seconds(_http_error(503, {"Retry-After": date})) <= 30
+    assert common._retry_after_seconds(_http_error(503, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert common._retry_after_seconds(_http_error(503, {"Retry-After": "soon"})) is None
+
+
+def test_retry_after_seconds_from_gemini_body_keeps_body_readable():
+    body = b'{"error": {"code": 429, "details": [{"retryDelay": "12s"}]}}'
+    error = _http_error(429, body=body)
+    assert common._retry_after_seconds(error) == 12.0
+    assert error.read() == body
+    assert common._retry_after_seconds(_http_error(429, body=b"{}")) is None
+
+
+def test_scheduler_holds_model_after_429():
+    scheduler = common.ProviderScheduler((("gpt-4o-mini", 600, 10 ** 6),), common.LLM_UNLIMITED_RATE)
+    assert scheduler.reserve("gpt-4o-mini", 100) == 0
+    delay = scheduler.retry_delay("gpt-4o-mini", 0, _http_error(429, {"Retry-After": "10"}))
+    assert 0 <= delay <= common.LLM_BACKOFF_BASE
+    assert scheduler.reserve("gpt-4o-mini", 100) == pytest.approx(10, abs=0.5)
+    stats = scheduler.stats()["gpt-4o-mini"]
+    assert (stats["rate_limited"], stats["retries"], stats["rpm_limit"]) == (1, 1, 600)
+
+
+def test_scheduler_does_not_retry_client_errors_or_after_max_retries():
+    scheduler = common.ProviderScheduler((), common.LLM_UNLIMITED_RATE)
+    assert scheduler.retry_delay("gpt-4o-mini", 0, _http_error(400)) is None
+    assert scheduler.retry_delay("gpt-4o-mini", 0, ValueError("bad")) is None
+    assert scheduler.retry_delay("gpt-4o-mini", common.LLM_MAX_RETRIES, _http_error(503)) is None
+    assert scheduler.retry_delay("gpt-4o-mini", 0, ConnectionResetError()) is not None
+    assert scheduler.stats()["gpt-4o-mini"]["gave_up"] == 1
@@ -0,0 +1,85 @@
+"""会話履歴の保存（ChatSessionStore）：最初のターンでの作成、古いターンの要約への畳み込み、期限切れ"""
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "estimate_tokens", len)  # トークン数を文字数で数える
+    return app.ChatSessionStore(str(tmp_path / "sessions.sqlite3"), 3600, 100, 1000, 2)
+
+
+def _turn(n):
+    return f"質問{n}です。", "回答" * 17 + "。"  # 6 + 35 = 41 トークン
+
+
+def test_open_does_not_create_row_until_first_turn(store):
+    session_id, summary, history = store.open()
+    assert (summary, history) == ("", [])
+    assert store.get(session_id) is None
+    store.append_turn(session_id, *_turn(1), seed=[])
+    assert store.get(session_id) == {"summary": "", "history": [{"user": "質問1です。", "assistant": _turn(1)[1]}]}
+    assert store.open(session_id)[0] == session_id
+
+
+def test_append_turn_inserts_seed_before_first_turn(store):
+    session_id, _, _ = store.open()
+    store.append_turn(session_id, "今回", "応答", seed=[{"user": "前", "assistant": "前の応答"}])
+    assert [h["user"] for h in store.get(session_id)["history"]] == ["前", "今回"]
+    assert store.stats()["created"] == 1
+
+
+def test_append_turn_without_seed_skips_deleted_session(store):
+    session_id, _, _ = store.open()
+    store.append_turn(session_id, *_turn(1))
+    assert store.get(session_id) is None
+    assert store.stats()["sessions"] == 0
+
+
+def test_old_turns_are_folded_into_summary(store):
+    session_id, _, _ = store.open()
+    store.append_turn(session_id, *_turn(1), seed=[])
+    for n in (2, 3, 4):
+        store.append_turn(session_id, *_turn(n))
+    saved = store.get(session_id)
+    # 直近 keep_turns（2）ターンは残し、それより古いターンは1行ずつ要約になる
+    assert [h["user"] for h in saved["history"]] == ["質問3です。", "質問4です。"]
+    assert saved["summary"].split("\n")[0].startswith("・Q: 質問1です。 → A: 回答")
+    assert len(saved["summary"].split("\n")) == 2
+    stats = store.stats()
+    assert (stats["turns"], stats["compactions"], stats["folded_turns"], stats["stored_turns"]) == (4, 2, 2, 2)
+
+
+def test_fold_history_matches_stored_folding(store):
+    history = [{"user": u, "assistant": a} for u, a in map(_turn, (1, 2, 3))]
+    summary, remaining = store.fold_history(history)
+    assert summary.startswith("・Q: 質問1です。")
+    assert remaining == history[1:]
+    assert store.fold_history(history[:2]) == ("", history[:2])
+
+
+def test_summary_is_trimmed_to_summary_tokens(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "estimate_tokens", len)
+    store = app.ChatSessionStore(str(tmp_path / "s.sqlite3"), 3600, 100, 60, 2)
+    session_id, _, _ = store.open()
+    store.append_turn(session_id, *_turn(1), seed=[])
+    for n in range(2, 7):
+        store.append_turn(session_id, *_turn(n))
+    summary = store.get(session_id)["summary"]
+    assert len(summary) <= 60
+    assert summary.startswith("・Q: 質問4です。")
+
+
+def test_expired_session_is_not_returned_and_is_purged(store):
+    session_id, _, _ = store.open()
+    store.append_turn(session_id, *_turn(1), seed=[])
+    store._conn().execute("UPDATE chat_sessions SET updated = ?", (time.time() - 7200,))
+    assert store.open(session_id) is None
+    assert store.get(session_id) is None
+    store._last_purge = 0.0
+    store.open()  # 新しいセッションを払い出すときに期限切れの行を消す
+    stats = store.stats()
+    assert (stats["sessions"], stats["stored_turns"]) == (0, 0)